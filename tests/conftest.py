@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of utils/ import each other by name; e.g. `from tissue import tissue_mask`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils'))
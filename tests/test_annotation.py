@@ -0,0 +1,93 @@
+'''Rasterized and indexed annotations against the skimage polygon test, on polygons with holes.'''
+import json
+
+import numpy as np
+import pytest
+from skimage.measure import points_in_poly
+
+from annotation import (LABEL_NEG, LABEL_POS, RASTER_TOLERANCE, LesionAnnotations, check_tumor_mask,
+                        json_to_store)
+
+
+def star_polygon(rng: np.random.Generator, center: tuple, radius: float, num_vertices: int) -> np.ndarray:
+    '''Irregular polygon of vertices around the center; the radius varies from vertex to vertex.'''
+    angles = np.sort(rng.uniform(0, 2 * np.pi, size=num_vertices))
+    radii = radius * rng.uniform(0.5, 1.0, size=num_vertices)
+
+    return np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+
+
+def random_annotations(seed: int, slide_size: int) -> dict:
+    '''Positive polygons, some overlapping, with negative holes inside; the dict of the json annotation.'''
+    rng = np.random.default_rng(seed)
+    lesion_annots = {'pos': [], 'neg': []}
+    for i in range(6):
+        center = rng.uniform(0.2, 0.8, size=2) * slide_size
+        radius = rng.uniform(0.05, 0.2) * slide_size
+        pos = star_polygon(rng, center, radius, int(rng.integers(3, 200)))
+        lesion_annots['pos'].append({'name': f'_0_{i}', 'coords': pos.tolist()})
+        if i % 2 == 0:
+            neg = star_polygon(rng, center, radius * 0.4, int(rng.integers(3, 50)))
+            lesion_annots['neg'].append({'name': f'_2_{i}', 'coords': neg.tolist()})
+
+    return lesion_annots
+
+
+def reference_labels(lesion_annots: dict, points: np.ndarray) -> np.ndarray:
+    '''Inside a positive polygon and outside every negative one; tested by skimage.'''
+    inside = {}
+    for (class_, annots) in lesion_annots.items():
+        inside[class_] = np.zeros(len(points), dtype=bool)
+        for annot in annots:
+            inside[class_] |= points_in_poly(points, np.asarray(annot['coords']))
+
+    return inside['pos'] & ~inside['neg']
+
+
+@pytest.fixture(params=[('json', 0), ('store', 0), ('json', 1), ('json', 2)])
+def annot_path(request, tmp_path):
+    annot_format, seed = request.param
+    json_path = str(tmp_path / 'tumor_001.json')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(random_annotations(seed, slide_size=8192), f)
+    if annot_format == 'store':
+        return json_to_store(json_path)
+
+    return json_path
+
+
+@pytest.mark.parametrize('resolution', [16, 37.5])
+def test_tumor_mask(annot_path, resolution):
+    lesion_annots = LesionAnnotations(annot_path)
+    with open(annot_path.replace('.annots', '.json'), 'r', encoding='utf-8') as f:
+        annots = json.load(f)
+
+    mask_shape = (int(8192 // resolution), int(8192 // resolution))
+    grid_x, grid_y = np.meshgrid(np.arange(mask_shape[0]), np.arange(mask_shape[1]), indexing='ij')
+    grid_points = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)
+    points = grid_points * resolution
+
+    expected = reference_labels(annots, points)
+    assert expected.any() and not expected.all()
+
+    tumor_mask = lesion_annots.tumor_mask(mask_shape, resolution)
+    assert tumor_mask.shape == mask_shape
+    raster_labels = tumor_mask[grid_points[:, 0], grid_points[:, 1]]
+    assert np.count_nonzero(raster_labels != expected) / len(points) <= RASTER_TOLERANCE
+
+    labels = lesion_annots.label_points(points)
+    assert np.count_nonzero((labels == LABEL_POS) != expected) / len(points) <= RASTER_TOLERANCE
+    # Holes are labeled negative, not unlabeled
+    assert np.any(labels == LABEL_NEG)
+
+    assert check_tumor_mask(lesion_annots, points, mask_shape, resolution, tumor_mask=tumor_mask)
+
+
+def test_tumor_mask_tiles(annot_path):
+    lesion_annots = LesionAnnotations(annot_path)
+    tumor_mask = lesion_annots.tumor_mask((512, 512), resolution=16)
+
+    # Tiles of the mask are the same as the slices of the whole mask
+    for origin in [(0, 0), (100, 37), (448, 480)]:
+        tile = lesion_annots.tumor_mask((64, 32), resolution=16, origin=origin)
+        assert np.array_equal(tile, tumor_mask[origin[0]:origin[0] + 64, origin[1]:origin[1] + 32])
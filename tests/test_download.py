@@ -0,0 +1,153 @@
+'''Resumed and restarted downloads against a local http server with Range support.'''
+import http.server
+import os
+import socket
+import threading
+
+import pytest
+
+from download import PART_EXT, download_file
+
+DATA = bytes(range(256)) * 64 # 16KB file on the server
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    '''Serve DATA at any path; ranges are answered with 206 unless the server ignores them.'''
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        server = self.server
+        if server.no_head:
+            self.send_error(405)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(server.head_size or len(DATA)))
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        server = self.server
+        range_header = self.headers.get('Range')
+        server.ranges.append(range_header)
+
+        start = 0
+        if range_header and not server.ignore_range:
+            start = int(range_header[len('bytes='):].split('-')[0])
+            if start >= len(DATA):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(DATA) - 1}/{len(DATA)}')
+        else:
+            self.send_response(200)
+        body = DATA[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        # Drop the connection in the middle of the transfer
+        if server.num_drops > 0:
+            server.num_drops -= 1
+            self.wfile.write(body[:len(body) // 3])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.daemon_threads = True
+    server.no_head = False
+    server.ignore_range = False
+    server.head_size = None
+    server.num_drops = 0
+    server.ranges = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def url_of(server) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}/slide.tif'
+
+
+def download(server, path_out: str, max_retries: int = 3) -> bool:
+    return download_file(url_of(server), path_out, max_retries=max_retries, retry_wait=0.0, timeout=5)
+
+
+def read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download(server, tmp_path):
+    path_out = str(tmp_path / 'slide.tif')
+
+    assert download(server, path_out)
+    assert read(path_out) == DATA
+    assert not os.path.exists(path_out + PART_EXT)
+    # A complete file is not downloaded again
+    assert not download(server, path_out)
+    assert server.ranges == [None]
+
+
+def test_resume_from_part(server, tmp_path):
+    path_out = str(tmp_path / 'slide.tif')
+    with open(path_out + PART_EXT, 'wb') as f:
+        f.write(DATA[:1000])
+
+    assert download(server, path_out)
+    assert read(path_out) == DATA
+    assert server.ranges == ['bytes=1000-']
+
+
+def test_resume_dropped_connections(server, tmp_path):
+    path_out = str(tmp_path / 'slide.tif')
+    server.num_drops = 2
+
+    assert download(server, path_out)
+    assert read(path_out) == DATA
+    assert len(server.ranges) == 3
+    assert server.ranges[0] is None
+    # Every retry resumes after the bytes received so far
+    offsets = [int(range_header[len('bytes='):-1]) for range_header in server.ranges[1:]]
+    assert 0 < offsets[0] < offsets[1] < len(DATA)
+
+
+def test_restart_if_range_is_ignored(server, tmp_path):
+    path_out = str(tmp_path / 'slide.tif')
+    with open(path_out + PART_EXT, 'wb') as f:
+        f.write(b'\xff' * 1000) # not a prefix of the file; overwritten by the whole file
+    server.ignore_range = True
+
+    assert download(server, path_out)
+    assert read(path_out) == DATA
+    assert server.ranges == ['bytes=1000-']
+
+
+def test_reject_size_mismatch(server, tmp_path):
+    path_out = str(tmp_path / 'slide.tif')
+    server.head_size = len(DATA) + 100 # the transfer ends before the size told by the server
+
+    with pytest.raises(OSError):
+        download(server, path_out, max_retries=1)
+    assert not os.path.exists(path_out)
+    assert read(path_out + PART_EXT) == DATA
+
+
+def test_head_not_allowed(server, tmp_path):
+    path_out = str(tmp_path / 'slide.tif')
+    server.no_head = True
+    server.num_drops = 1
+
+    # The size is taken from the transfers; Content-Range of the resumed one
+    assert download(server, path_out)
+    assert read(path_out) == DATA
+    assert len(server.ranges) == 2
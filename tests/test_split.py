@@ -0,0 +1,59 @@
+'''Split manifests and their materialized links in the wsi directory.'''
+import os
+
+import pytest
+
+from mask import list_slides
+from manifest import list_files
+from split import SPLITS_DIRNAME, list_class_slides, load_split, make_folds, materialize_split, save_split
+
+
+@pytest.fixture
+def wsi_dir(tmp_path):
+    '''Dataset root of train/{class}/{patient_id}.tif.'''
+    for class_ in ('tumor', 'normal'):
+        os.makedirs(tmp_path / 'train' / class_)
+        for i in range(1, 6):
+            (tmp_path / 'train' / class_ / f'{class_}_{i:03d}.tif').write_bytes(class_.encode())
+
+    return tmp_path
+
+
+def split_root(wsi_dir, link: str) -> str:
+    slides = list_class_slides([str(wsi_dir / 'train')])
+    fold = make_folds(slides, valid_ratio=0.4, seed=0)[0]
+    split_path = str(wsi_dir / SPLITS_DIRNAME / 'valid0.4_seed0.json')
+    save_split(split_path, slides, fold, valid_ratio=0.4, seed=0)
+    materialize_split(split_path, str(wsi_dir / SPLITS_DIRNAME / 'valid0.4_seed0'), link=link)
+
+    return split_path
+
+
+def test_folds_are_stratified(wsi_dir):
+    slides = list_class_slides([str(wsi_dir / 'train')])
+    fold = make_folds(slides, valid_ratio=0.4, seed=0)[0]
+
+    assert sorted(fold['train'] + fold['valid']) == sorted(slides)
+    assert sorted(slides[patient_id][0] for patient_id in fold['valid']) == ['normal'] * 2 + ['tumor'] * 2
+
+
+def test_load_split(wsi_dir):
+    split_path = split_root(wsi_dir, 'symlink')
+    train = load_split(split_path, ['train'])
+    valid = load_split(split_path, ['valid'])
+
+    assert not set(train) & set(valid)
+    assert len(train) + len(valid) == 10
+    for (class_, wsi_path) in {**train, **valid}.values():
+        assert os.path.dirname(wsi_path) == str(wsi_dir / 'train' / class_)
+
+
+@pytest.mark.parametrize('link', ['hardlink', 'symlink'])
+def test_list_root_with_materialized_split(wsi_dir, link):
+    split_root(wsi_dir, link)
+    slides = list_slides([str(wsi_dir)])
+
+    assert len(slides) == 10
+    for (patient_id, wsi_path) in slides:
+        assert wsi_path == os.path.join(str(wsi_dir), 'train', patient_id.split('_')[0], f'{patient_id}.tif')
+    assert all(rel_path.startswith('train') for rel_path in list_files(str(wsi_dir)))
@@ -0,0 +1,75 @@
+'''Equivalence of the chunked tissue detector with the rgb2hsv and threshold_otsu reference.'''
+import numpy as np
+import pytest
+
+from tissue import TissueHistograms, reference_tissue_mask, tissue_mask
+
+
+def detect(rgb_image: np.ndarray, chunk_size: int, tile_width: int = None) -> tuple:
+    '''Thresholds and mask of the kernel; histograms accumulated tile by tile if tile_width is given.'''
+    tissue_histograms = TissueHistograms()
+    tile_width = tile_width or rgb_image.shape[0]
+    for x in range(0, rgb_image.shape[0], tile_width):
+        tissue_histograms.update(rgb_image[x:x + tile_width], chunk_size)
+    thresholds = tissue_histograms.thresholds()
+
+    return tissue_mask(rgb_image, thresholds, chunk_size=chunk_size), thresholds
+
+
+def assert_equivalent(rgb_image: np.ndarray, chunk_size: int = 1 << 20, tile_width: int = None) -> None:
+    roi_mask, thresholds = detect(rgb_image, chunk_size, tile_width)
+    reference_mask, reference_thresholds = reference_tissue_mask(rgb_image)
+
+    assert tuple(thresholds) == tuple(reference_thresholds)
+    assert np.array_equal(roi_mask, reference_mask)
+
+
+def random_images(seed: int = 0) -> list:
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(4):
+        width, height = rng.integers(1, 256, size=2)
+        images.append((rng.beta(2, 5, size=(width, height, 3)) * 255).astype(np.uint8))
+        images.append(rng.integers(0, 256, size=(width, height, 3), dtype=np.uint8))
+        images.append(rng.normal(180, 30, size=(width, height, 3)).clip(0, 255).astype(np.uint8))
+
+    return images
+
+
+@pytest.mark.parametrize('rgb_image', random_images())
+def test_random_images(rgb_image):
+    assert_equivalent(rgb_image)
+
+
+@pytest.mark.parametrize('value', [0, 50, 200, 255])
+def test_uniform_images(value):
+    assert_equivalent(np.full((64, 48, 3), value, dtype=np.uint8))
+
+
+def test_single_value_channels():
+    rgb_image = np.random.default_rng(1).integers(0, 256, size=(97, 61, 3), dtype=np.uint8)
+    rgb_image[..., 1] = 120
+
+    assert_equivalent(rgb_image)
+
+
+def test_single_saturation():
+    # Gray pixels of every brightness; saturation is 0 everywhere
+    gray = np.random.default_rng(2).integers(0, 256, size=(80, 70), dtype=np.uint8)
+
+    assert_equivalent(np.repeat(gray[..., None], 3, axis=-1))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 203, 204, 4096])
+def test_chunk_boundaries(chunk_size):
+    # Chunks of whole columns; 203 pixels is one column, 7 rounds up to a column
+    rgb_image = (np.random.default_rng(3).beta(2, 5, size=(301, 203, 3)) * 255).astype(np.uint8)
+
+    assert_equivalent(rgb_image, chunk_size=chunk_size)
+
+
+@pytest.mark.parametrize('tile_width', [1, 64, 100])
+def test_tiled_histograms(tile_width):
+    rgb_image = (np.random.default_rng(4).beta(2, 5, size=(301, 203, 3)) * 255).astype(np.uint8)
+
+    assert_equivalent(rgb_image, chunk_size=4096, tile_width=tile_width)
@@ -2,29 +2,34 @@ import json
 import os
 import xml.etree.ElementTree as ET
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import Sequence
 
 import numpy as np
-from skimage.measure import points_in_poly
+
+from coords import save_coords_cache
+from storage import open_array, write_array
 
 
 class Annotation:
     '''Represents an annotation using a coordinates array of shape (n, 2).'''
 
-    def __init__(self, name: str, coords: np.ndarray) -> None:
+    def __init__(self, name: str, coords: np.ndarray, bbox: np.ndarray = None) -> None:
         '''Initialize a Annotation object.
 
         - Args
             name: Name of the Annotation object
             coords: Numpy array containing coordinates;
                     [(x1,y1), (x2,y2), ... ,(xn,yn)] of shape (n, 2)
+            bbox: Bounding box of the vertices; (x_min, y_min, x_max, y_max), computed if None
 
         - Returns
             None
         '''
         self.name = name
         self.coords = coords
+        self._bbox = bbox
 
     def coordinates(self) -> None:
         '''Returns annotation coordinates; vertices'''
@@ -33,6 +38,14 @@ class Annotation:
     def __repr__(self) -> str:
         return self.name
 
+    @property
+    def bbox(self) -> np.ndarray:
+        '''Bounding box of the vertices; (x_min, y_min, x_max, y_max).'''
+        if self._bbox is None:
+            self._bbox = polygon_bboxes(np.asarray(self.coords, dtype=np.float64).reshape(-1, 2), [0, len(self.coords)])[0]
+
+        return self._bbox
+
     def does_contain(self, points: list) -> Sequence[bool]:
         '''Check if the Annotation object contains the given coordinate.
 
@@ -43,6 +56,8 @@ class Annotation:
             True if the given coorindate is inside the Annotation object,
             False otherwise
         '''
+        from skimage.measure import points_in_poly # skimage is slow to import; load it on the first test
+
         return points_in_poly(points, self.coords)
 
 
@@ -50,44 +65,64 @@ class LesionAnnotations:
     '''Represents an annotation drawn on a whole slide image.'''
 
     def __init__(self, annot_path: str) -> None:
-        '''Init LesionAnnotations.'''
+        '''Init LesionAnnotations.
+
+        The vertices of every annotation are kept in a single float64 array of shape (num_vertices, 2);
+        each Annotation holds a view of it. An annotation store is memory-mapped without copies,
+        a json annotation is converted once.
+
+        - Args
+            annot_path: Path to the json annotation or the annotation store; see save_annotation_store()
 
+        - Returns
+            None
+        '''
         self.annot_path = annot_path
         self.annot_fname = Path(self.annot_path).name
-        self.patient_id = self.annot_fname.rstrip('.json')
-
-        with open(annot_path, 'r', encoding='utf-8') as f:
-            lesion_annots = json.load(f)
+        self.patient_id = os.path.splitext(self.annot_fname)[0]
+
+        if os.path.splitext(annot_path)[1] == ANNOTATION_STORE_EXT:
+            self.vertices, header_dict = open_array(annot_path, mmap=True)
+            assert header_dict.get('kind') == 'annotations', f'{annot_path} is not an annotation store'
+            assert header_dict.get('version') == ANNOTATION_STORE_VERSION, \
+                f'Unsupported annotation store version: {header_dict.get("version")}'
+            names = header_dict['names']
+            self.is_pos = np.array(header_dict['is_pos'], dtype=bool)
+            self.offsets = np.array(header_dict['offsets'], dtype=np.int64)
+            self.bboxes = np.array(header_dict['bboxes'], dtype=np.float64).reshape(-1, 4)
+        else:
+            with open(annot_path, 'r', encoding='utf-8') as f:
+                lesion_annots = json.load(f)
+            names, self.is_pos, self.vertices, self.offsets = pack_annotations(lesion_annots)
+            self.bboxes = polygon_bboxes(self.vertices, self.offsets)
 
-        # Parse positive annotations
+        # Annotations are views of the vertices
         self.pos_annots = []
-        for annot in lesion_annots['pos']:
-            annot_name = annot['name']
-            coords = annot['coords'] # annot['vertices'], originally in ncrf code
-            pos_annot = Annotation(name=annot_name, coords=coords)
-            self.pos_annots.append(pos_annot)
-
-        # Parse negative annotations
         self.neg_annots = []
-        for annot in lesion_annots['neg']:
-            annot_name = annot['name']
-            coords = annot['coords']
-            neg_annot = Annotation(name=annot_name, coords=coords)
-            self.neg_annots.append(neg_annot)
+        for (i, annot_name) in enumerate(names):
+            annot = Annotation(name=annot_name,
+                               coords=self.vertices[self.offsets[i]:self.offsets[i + 1]],
+                               bbox=self.bboxes[i])
+            if self.is_pos[i]:
+                self.pos_annots.append(annot)
+            else:
+                self.neg_annots.append(annot)
 
         self.annots_dict = {
             'pos': self.pos_annots,
             'neg': self.neg_annots,
         }
+        self._index = None
 
-    def filter_tumor_coords(self, save_path: str,
-                            points: np.ndarray, is_pos: bool = True) -> np.ndarray:
+    def filter_tumor_coords(self, save_path: str, points: np.ndarray,
+                            is_pos: bool = True, fingerprint: str = '') -> np.ndarray:
         '''Filter tumor coords from the given points.
 
         - Args
-            save_dir: Path to json file to save the tumor coordinates
+            save_path: Path to save the binary cache of the tumor coordinates; not saved if None
             points: Roi points to check if each of them is a tumor
             is_pos: True if to filter positive tumor, False otherwise
+            fingerprint: Fingerprint of the sources saved with the cache; see coords.source_fingerprint()
 
         - Returns
             A numpy array which contains tumor coordinates; points inside annotations
@@ -97,21 +132,99 @@ class LesionAnnotations:
         else:
             annots = self.neg_annots
 
-        tumor_coords_dict = defaultdict(list)
-        tumor_coords_dict['patient_id'] = self.patient_id
-        tumor_coords_dict['num_coords'] = 0
+        points = np.asarray(points).reshape(-1, 2)
 
+        tumor_coords = []
         for annot in annots:
             tumor_coords_mask = annot.does_contain(points)
-            tumor_coords = points[tumor_coords_mask]
-            tumor_coords = tumor_coords.tolist()
-            tumor_coords_dict['tumor_coords'].extend(tumor_coords)
-            tumor_coords_dict['num_coords'] += len(tumor_coords)
+            tumor_coords.append(points[tumor_coords_mask])
+
+        if tumor_coords:
+            tumor_coords = np.concatenate(tumor_coords).astype(np.int32)
+        else:
+            tumor_coords = np.empty((0, 2), dtype=np.int32)
+
+        if save_path is not None:
+            save_coords_cache(save_path, tumor_coords, fingerprint)
+
+        return tumor_coords
+
+    def tumor_mask(self, mask_shape: tuple, resolution: float = 1, origin: tuple = (0, 0)) -> np.ndarray:
+        '''Rasterize the positive annotations minus the negative ones at the resolution of a mask.
+
+        - Args
+            mask_shape: Shape of the mask, or of a tile of it; (width, height)
+            resolution: Pixels of the annotation coordinates per mask pixel
+            origin: Top left (x, y) of the tile in mask pixels
+
+        - Returns
+            Binary mask of shape (width, height); True on the tumor
+        '''
+        pos_offsets = np.concatenate([[0], np.cumsum([len(annot.coords) for annot in self.pos_annots])])
+        neg_offsets = np.concatenate([[0], np.cumsum([len(annot.coords) for annot in self.neg_annots])])
+        pos_vertices = np.concatenate([np.empty((0, 2))] + [annot.coords for annot in self.pos_annots])
+        neg_vertices = np.concatenate([np.empty((0, 2))] + [annot.coords for annot in self.neg_annots])
 
-        with open(save_path, 'w+', encoding='utf-8') as f:
-            json.dump(tumor_coords_dict, f, indent=4)
+        tumor_mask = rasterize_polygons(pos_vertices, pos_offsets, mask_shape, resolution, origin)
+        if len(self.neg_annots) and tumor_mask.any():
+            tumor_mask &= ~rasterize_polygons(neg_vertices, neg_offsets, mask_shape, resolution, origin)
 
-        return tumor_coords_dict['tumor_coords']
+        return tumor_mask
+
+    def contains_tumor(self, points: np.ndarray) -> np.ndarray:
+        '''Test the points against the polygons; inside a positive annotation and outside every negative one.
+
+        Only the points in the bounding box of an annotation are tested against it.
+
+        - Args
+            points: Points of shape (n, 2); (x, y)
+
+        - Returns
+            A binary array of shape (n,)
+        '''
+        points = np.asarray(points).reshape(-1, 2)
+
+        inside = {}
+        for (class_, annots) in self.annots_dict.items():
+            inside[class_] = np.zeros(len(points), dtype=bool)
+            for annot in annots:
+                x_min, y_min, x_max, y_max = annot.bbox
+                in_bbox = np.flatnonzero((points[:, 0] >= x_min) & (points[:, 0] <= x_max)
+                                         & (points[:, 1] >= y_min) & (points[:, 1] <= y_max))
+                if len(in_bbox):
+                    inside[class_][in_bbox] |= annot.does_contain(points[in_bbox])
+
+        return inside['pos'] & ~inside['neg']
+
+    @property
+    def index(self) -> 'AnnotationIndex':
+        '''Grid index over the bounding boxes of the annotations; built on the first query.'''
+        if self._index is None:
+            self._index = AnnotationIndex(self.vertices, self.offsets, self.bboxes)
+
+        return self._index
+
+    def label_points(self, points: np.ndarray) -> np.ndarray:
+        '''Label every point with the annotations containing it.
+
+        Negative annotations are holes of the positive ones; a point inside a negative annotation is negative.
+
+        - Args
+            points: Points of shape (n, 2); (x, y)
+
+        - Returns
+            A uint8 array of shape (n,); LABEL_NONE, LABEL_POS or LABEL_NEG
+        '''
+        points = np.asarray(points).reshape(-1, 2)
+        point_ids, polygon_ids = self.index.query(points)
+        pos_points = point_ids[self.is_pos[polygon_ids]]
+        neg_points = point_ids[~self.is_pos[polygon_ids]]
+
+        labels = np.full(len(points), LABEL_NONE, dtype=np.uint8)
+        labels[pos_points] = LABEL_POS
+        labels[neg_points] = LABEL_NEG
+
+        return labels
 
     def does_contain(self, points: Sequence[tuple], is_pos: bool = True) -> bool:
         '''Check if the Annotation object contains the given coordinate.
@@ -125,6 +238,8 @@ class LesionAnnotations:
             False otherwise
         '''
         num_points = len(points)
+        point_ids, polygon_ids = self.index.query(points)
+        class_polygons = np.flatnonzero(self.is_pos == is_pos)
 
         coords_mask_dict = defaultdict(list)
         if num_points > 1:
@@ -133,22 +248,14 @@ class LesionAnnotations:
             else:
                 annots = self.neg_annots
 
-            for annot in annots:
-                coords_mask = annot.does_contain(points=points)
+            for (annot, polygon) in zip(annots, class_polygons):
+                coords_mask = np.zeros(num_points, dtype=bool)
+                coords_mask[point_ids[polygon_ids == polygon]] = True
                 coords_mask_dict[annot.name] = coords_mask
 
             return coords_mask_dict
 
-        if is_pos:
-            annots = self.pos_annots
-        else:
-            annots = self.neg_annots
-
-        for annot in annots:
-            if annot.does_contain(points=points): # Warn: repair to coord=coord
-                return True
-
-        return False
+        return bool(np.isin(polygon_ids, class_polygons).any())
 
     def __repr__(self):
         return self.annot_fname
@@ -182,97 +289,565 @@ class LesionAnnotations:
         return self.annots_dict
 
 
-def xml_to_json(xml_path_in: str, json_path_out: str) -> None:
-    '''Convert xml annotation to json
-    
+# PartOfGroup of the annotations of each class; positive annotations are listed in this order of groups
+POS_GROUPS = ('Tumor', '_0', '_1')
+NEG_GROUPS = ('_2',)
+
+ANNOTATION_STORE_VERSION = 1
+ANNOTATION_STORE_EXT = '.annots'
+
+# Labels of LesionAnnotations.label_points()
+LABEL_NONE = 0
+LABEL_POS = 1
+LABEL_NEG = 2
+
+GRID_CELL_SIZE = 2048 # width/height of a cell of AnnotationIndex in the coordinates of the annotations
+
+RASTER_TOLERANCE = 1e-3 # fraction of the points the raster may label differently from the polygon test
+
+
+def polygon_bboxes(vertices: np.ndarray, offsets) -> np.ndarray:
+    '''Bounding box of every polygon of the flat vertices; float64 array of shape (num_polygons, 4).
+
     - Args
-        xml_in_path: Path to the input xml annotation file
-        json_out_path: Path to save the output json annotation file
+        vertices: Vertices of every polygon of shape (num_vertices, 2)
+        offsets: Polygon i is vertices[offsets[i]:offsets[i + 1]]
+
+    - Returns
+        (x_min, y_min, x_max, y_max) of every polygon; nan for a polygon without vertices
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    bboxes = np.full((len(offsets) - 1, 4), np.nan)
+    non_empty = offsets[1:] > offsets[:-1]
+    if non_empty.any():
+        starts = offsets[:-1][non_empty]
+        bboxes[non_empty, :2] = np.minimum.reduceat(vertices, starts, axis=0)
+        bboxes[non_empty, 2:] = np.maximum.reduceat(vertices, starts, axis=0)
+
+    return bboxes
+
+
+def rasterize_polygon(polygon: np.ndarray, out: np.ndarray) -> None:
+    '''Set the grid points of the mask inside or on the border of the polygon, a scanline of y at a time.
+
+    The crossings of every scanline are computed with the arithmetic of the even-odd test, and the points on
+    the edges and vertices are set as points_in_poly() counts them inside; the raster agrees with the test
+    of the grid points but for rounding of the crossings.
+
+    - Args
+        polygon: Vertices in mask pixels of shape (n, 2); (x, y)
+        out: Binary mask of shape (width, height) to set the points inside the polygon
 
     - Returns
         None
     '''
+    mask_width, mask_height = out.shape
+    if not len(polygon):
+        return
+
+    # Edge i joins vertex i - 1 and vertex i
+    x_i, y_i = polygon[:, 0], polygon[:, 1]
+    x_j, y_j = np.roll(x_i, 1), np.roll(y_i, 1)
+
+    # Scanlines crossed by every edge; y_min <= y < y_max
+    row_starts = np.clip(np.ceil(np.minimum(y_i, y_j)), 0, mask_height).astype(np.int64)
+    row_ends = np.clip(np.ceil(np.maximum(y_i, y_j)), 0, mask_height).astype(np.int64)
+    num_rows = np.maximum(row_ends - row_starts, 0)
+
+    edges = np.repeat(np.arange(len(polygon)), num_rows)
+    rows = np.arange(len(edges)) - np.repeat(np.cumsum(num_rows) - num_rows, num_rows) + row_starts[edges]
+    crossings = (x_j[edges] - x_i[edges]) * (rows - y_i[edges]) / (y_j[edges] - y_i[edges]) + x_i[edges]
+
+    # Every scanline crosses the polygon an even number of times; points from the 2k-th to the 2k+1-th crossing
+    # are inside or on an edge
+    order = np.lexsort((crossings, rows))
+    crossings = crossings[order]
+    span_rows = [rows[order][0::2]]
+    span_starts = [np.ceil(crossings[0::2])]
+    span_ends = [np.floor(crossings[1::2]) + 1]
+
+    # Horizontal edges on a scanline and the vertices on the grid
+    horizontal = (y_i == y_j) & (y_i == np.round(y_i))
+    span_rows.append(y_i[horizontal].astype(np.int64))
+    span_starts.append(np.ceil(np.minimum(x_i, x_j)[horizontal]))
+    span_ends.append(np.floor(np.maximum(x_i, x_j)[horizontal]) + 1)
+
+    on_grid = (x_i == np.round(x_i)) & (y_i == np.round(y_i))
+    span_rows.append(y_i[on_grid].astype(np.int64))
+    span_starts.append(x_i[on_grid])
+    span_ends.append(x_i[on_grid] + 1)
+
+    rows = np.concatenate(span_rows)
+    x_starts = np.clip(np.concatenate(span_starts), 0, mask_width).astype(np.int64)
+    x_ends = np.clip(np.concatenate(span_ends), 0, mask_width).astype(np.int64)
+    spans = (x_starts < x_ends) & (rows >= 0) & (rows < mask_height)
+    rows, x_starts, x_ends = rows[spans], x_starts[spans], x_ends[spans]
+    if not len(rows):
+        return
+
+    # Fill the spans in the bounding box with a difference array along x
+    x0, x1 = x_starts.min(), x_ends.max()
+    y0, y1 = rows.min(), rows.max() + 1
+    diff = np.zeros((x1 - x0 + 1, y1 - y0), dtype=np.int32)
+    np.add.at(diff, (x_starts - x0, rows - y0), 1)
+    np.add.at(diff, (x_ends - x0, rows - y0), -1)
+    out[x0:x1, y0:y1] |= np.cumsum(diff, axis=0)[:-1] > 0
+
+
+def rasterize_polygons(vertices: np.ndarray, offsets, mask_shape: tuple, resolution: float = 1,
+                       origin: tuple = (0, 0)) -> np.ndarray:
+    '''Rasterize the union of the polygons at the resolution of a mask, or of a tile of it.
 
-    xml_annot = ET.parse(xml_path_in)
-    xml_annot_root = xml_annot.getroot()
-    
-    tumor_annot_route = './Annotations/Annotation[@PartOfGroup="Tumor"]'
-    tumor_annots = xml_annot_root.findall(tumor_annot_route)
-    
-    cls_0_annot_route = './Annotations/Annotation[@PartOfGroup="_0"]'
-    cls_0_annots = xml_annot_root.findall(cls_0_annot_route)
-
-    cls_1_annot_route = './Annotations/Annotation[@PartOfGroup="_1"]'
-    cls_1_annots = xml_annot_root.findall(cls_1_annot_route)
-
-    cls_2_annot_route = './Annotations/Annotation[@PartOfGroup="_2"]'
-    cls_2_annots = xml_annot_root.findall(cls_2_annot_route)
-
-    pos_annots = tumor_annots + cls_0_annots + cls_1_annots
-    neg_annots = cls_2_annots
-
-    json_annot = defaultdict(list)
-    json_annot['pos'] = []
-    json_annot['neg'] = []
-    # Parse positive annotations
-    for annot in pos_annots:
-        coords = annot.findall('./Coordinates/Coordinate')
-        x_coords = []
-        y_coords = []
-        for coord in coords:
-            # Parse x coordinates
-            x_coord = coord.get('X') # type(x_coord) == 'str'
-            x_coord = float(x_coord) # type(x_coord) == 'float'
-            x_coord = int(x_coord) # type(x_coord) == 'int'
-            x_coords.append(x_coord)
-
-            # Parse y coordinates
-            y_coord = coord.get('Y') # type(x_coord) == 'str'
-            y_coord = float(y_coord) # type(x_coord) == 'float'
-            y_coord = int(y_coord) # type(x_coord) == 'int'
-            y_coords.append(y_coord)
-        
-        # Concat x=[x1, x2, ...], y=[y1, y2, ...] to coords=[(x1,y1), (x2,y2), ...]
-        coords = np.c_[x_coords, y_coords]
-        coords = coords.tolist() # because np.ndarray is not json serializable
-        annot_name = annot.attrib['Name']
-        json_annot['pos'].append({
-            'name': f'Annotation{annot_name}',
-            'coords': coords,
-        })
+    - Args
+        vertices: Vertices of every polygon of shape (num_vertices, 2); see pack_annotations()
+        offsets: Polygon i is vertices[offsets[i]:offsets[i + 1]]
+        mask_shape: Shape of the mask or the tile; (width, height)
+        resolution: Pixels of the coordinates of the vertices per mask pixel
+        origin: Top left (x, y) of the tile in mask pixels
+
+    - Returns
+        Binary mask of shape (width, height); mask[x, y] is True if (origin + (x, y)) * resolution is inside a polygon
+    '''
+    out = np.zeros(mask_shape, dtype=bool)
+    origin = np.asarray(origin, dtype=np.float64)
+    for i in range(len(offsets) - 1):
+        polygon = np.asarray(vertices[offsets[i]:offsets[i + 1]], dtype=np.float64) / resolution - origin
+        # Polygons outside the tile
+        if not len(polygon) or (polygon.max(axis=0) < 0).any() or (polygon.min(axis=0) > np.subtract(mask_shape, 1)).any():
+            continue
+        rasterize_polygon(polygon, out)
+
+    return out
+
+
+def edge_point_pairs(sorted_ys: np.ndarray, y_starts: np.ndarray, y_ends: np.ndarray, right: bool = False) -> tuple:
+    '''Pair every edge with the points whose y is in its range; y_start <= y < y_end, or y_start <= y <= y_end if right.
+
+    - Args
+        sorted_ys: y of the points sorted in ascending order
+        y_starts: Lower end of the range of every edge
+        y_ends: Upper end of the range of every edge
+        right: Include the upper end of the ranges
+
+    - Returns
+        A tuple of (edge indices, indices of the points in sorted_ys)
+    '''
+    starts = np.searchsorted(sorted_ys, y_starts, side='left')
+    ends = np.searchsorted(sorted_ys, y_ends, side='right' if right else 'left')
+    counts = np.maximum(ends - starts, 0)
+
+    edges = np.repeat(np.arange(len(y_starts)), counts)
+    sorted_indices = np.arange(len(edges)) - np.repeat(np.cumsum(counts) - counts, counts) + starts[edges]
+
+    return edges, sorted_indices
+
+
+def points_in_polygon(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    '''Test the points against a polygon with the even-odd rule; points on the edges and vertices are inside.
+
+    Every edge is only tested against the points in its range of y, found by binary search on the sorted points,
+    so the cost follows the crossings of the polygon rather than points x vertices.
+
+    - Args
+        points: Points of shape (n, 2); (x, y)
+        polygon: Vertices of shape (m, 2)
+
+    - Returns
+        A binary array of shape (n,); the same as points_in_poly() but for rounding on the edges
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    inside = np.zeros(len(points), dtype=bool)
+    if not len(points) or not len(polygon):
+        return inside
+
+    # Work on the points sorted by y; inside is in the order of the sorted points until the end
+    order = np.argsort(points[:, 1], kind='stable')
+    sorted_xs = points[order, 0]
+    sorted_ys = points[order, 1]
+
+    # Edge i joins vertex i - 1 and vertex i
+    x_i, y_i = polygon[:, 0], polygon[:, 1]
+    x_j, y_j = np.roll(x_i, 1), np.roll(y_i, 1)
+    dx, dy = x_j - x_i, y_j - y_i
+
+    # Crossings of the ray to +x with the edges; y_min <= y < y_max
+    edges, indices = edge_point_pairs(sorted_ys, np.minimum(y_i, y_j), np.maximum(y_i, y_j))
+    point_xs = sorted_xs[indices]
+    crossings = dx[edges] * (sorted_ys[indices] - y_i[edges]) / dy[edges] + x_i[edges]
+
+    sorted_inside = np.bincount(indices[point_xs < crossings], minlength=len(points)) % 2 == 1
+    sorted_inside[indices[point_xs == crossings]] = True
+
+    # Points on the horizontal edges and on the vertices
+    horizontal = np.flatnonzero(dy == 0)
+    edges, indices = edge_point_pairs(sorted_ys, y_i[horizontal], y_i[horizontal], right=True)
+    point_xs = sorted_xs[indices]
+    x_min = np.minimum(x_i, x_j)[horizontal][edges]
+    x_max = np.maximum(x_i, x_j)[horizontal][edges]
+    sorted_inside[indices[(x_min <= point_xs) & (point_xs <= x_max)]] = True
+
+    vertices, indices = edge_point_pairs(sorted_ys, y_i, y_i, right=True)
+    sorted_inside[indices[sorted_xs[indices] == x_i[vertices]]] = True
+
+    inside[order] = sorted_inside
 
-    # Parse negative annotations
-    for annot in neg_annots:
-        coords = annot.findall('./Coordinates/Coordinate')
-        x_coords = []
-        y_coords = []
-        for coord in coords:
-            # Parse x coordinates
-            x_coord = coord.get('X') # type(x_coord) == 'str'
-            x_coord = float(x_coord) # type(x_coord) == 'float'
-            x_coord = int(x_coord) # type(x_coord) == 'int'
-            x_coords.append(x_coord)
-
-            # Parse y coordinates
-            y_coord = coord.get('Y') # type(y_coord) == 'str'
-            y_coord = float(y_coord) # type(y_coord) == 'float'
-            y_coord = int(y_coord) # type(y_coord) == 'int'
-            y_coords.append(y_coord)
-
-        # Concat x=[x1, x2, ...], y=[y1, y2, ...] to coords=[(x1,y1), (x2,y2), ...]
-        coords = np.c_[x_coords, y_coords]
-        coords = coords.tolist() # because np.ndarray is not json serializable
-        annot_name = annot.attrib['Name']
-        if 'Annotation' not in annot_name:
+    return inside
+
+
+class AnnotationIndex:
+    '''Uniform grid over the bounding boxes of the polygons of a slide for batch point queries.'''
+
+    def __init__(self, vertices: np.ndarray, offsets, bboxes: np.ndarray, cell_size: float = GRID_CELL_SIZE) -> None:
+        '''Initialize the AnnotationIndex.
+
+        - Args
+            vertices: Vertices of every polygon of shape (num_vertices, 2); see pack_annotations()
+            offsets: Polygon i is vertices[offsets[i]:offsets[i + 1]]
+            bboxes: Bounding box of every polygon of shape (num_polygons, 4); see polygon_bboxes()
+            cell_size: Width/height of a cell of the grid
+
+        - Returns
+            None
+        '''
+        self.vertices = vertices
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self.cell_size = float(cell_size)
+
+        polygons = np.flatnonzero(~np.isnan(self.bboxes).any(axis=1))
+        if len(polygons):
+            self.origin = self.bboxes[polygons, :2].min(axis=0)
+            grid_end = self.bboxes[polygons, 2:].max(axis=0)
+        else:
+            self.origin = grid_end = np.zeros(2)
+        self.grid_shape = tuple(int(size) for size in np.floor((grid_end - self.origin) / self.cell_size) + 1)
+
+        # Cells covered by the bounding box of every polygon, in the order of the cells
+        cell_starts = self.cell_of(self.bboxes[polygons, :2])
+        cell_ends = self.cell_of(self.bboxes[polygons, 2:]) + 1
+        cell_ids, polygon_ids = [], []
+        for (polygon, (cx0, cy0), (cx1, cy1)) in zip(polygons, cell_starts, cell_ends):
+            cxs, cys = np.meshgrid(np.arange(cx0, cx1), np.arange(cy0, cy1), indexing='ij')
+            cell_ids.append((cxs * self.grid_shape[1] + cys).ravel())
+            polygon_ids.append(np.full(cxs.size, polygon))
+        cell_ids = np.concatenate([np.empty(0, dtype=np.int64)] + cell_ids)
+        polygon_ids = np.concatenate([np.empty(0, dtype=np.int64)] + polygon_ids)
+
+        order = np.argsort(cell_ids, kind='stable')
+        self.cell_polygons = polygon_ids[order]
+        self.cell_offsets = np.searchsorted(cell_ids[order], np.arange(self.grid_shape[0] * self.grid_shape[1] + 1))
+
+    @property
+    def num_polygons(self) -> int:
+        return len(self.offsets) - 1
+
+    def cell_of(self, points: np.ndarray) -> np.ndarray:
+        '''Return the (x, y) cell of every point; may be outside the grid.'''
+        return np.floor((np.asarray(points, dtype=np.float64).reshape(-1, 2) - self.origin) / self.cell_size).astype(np.int64)
+
+    def candidates(self, points: np.ndarray) -> tuple:
+        '''Pair every point with the polygons whose bounding box contains it.
+
+        - Args
+            points: Points of shape (n, 2); (x, y)
+
+        - Returns
+            A tuple of (point indices, polygon indices)
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        cells = self.cell_of(points)
+        in_grid = np.flatnonzero((cells >= 0).all(axis=1) & (cells < self.grid_shape).all(axis=1))
+        cell_ids = cells[in_grid, 0] * self.grid_shape[1] + cells[in_grid, 1]
+
+        starts = self.cell_offsets[cell_ids]
+        counts = self.cell_offsets[cell_ids + 1] - starts
+        point_ids = np.repeat(in_grid, counts)
+        polygon_ids = self.cell_polygons[np.arange(len(point_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+                                         + np.repeat(starts, counts)]
+
+        bboxes = self.bboxes[polygon_ids]
+        xs, ys = points[point_ids, 0], points[point_ids, 1]
+        in_bbox = (bboxes[:, 0] <= xs) & (xs <= bboxes[:, 2]) & (bboxes[:, 1] <= ys) & (ys <= bboxes[:, 3])
+
+        return point_ids[in_bbox], polygon_ids[in_bbox]
+
+    def query(self, points: np.ndarray) -> tuple:
+        '''Pair every point with the polygons containing it; see points_in_polygon().
+
+        - Args
+            points: Points of shape (n, 2); (x, y)
+
+        - Returns
+            A tuple of (point indices, polygon indices)
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        point_ids, polygon_ids = self.candidates(points)
+
+        order = np.argsort(polygon_ids, kind='stable')
+        point_ids, polygon_ids = point_ids[order], polygon_ids[order]
+        bounds = np.searchsorted(polygon_ids, np.arange(self.num_polygons + 1))
+
+        contained = np.zeros(len(point_ids), dtype=bool)
+        for polygon in np.unique(polygon_ids):
+            start, end = bounds[polygon], bounds[polygon + 1]
+            polygon_vertices = self.vertices[self.offsets[polygon]:self.offsets[polygon + 1]]
+            contained[start:end] = points_in_polygon(points[point_ids[start:end]], polygon_vertices)
+
+        return point_ids[contained], polygon_ids[contained]
+
+    def __repr__(self) -> str:
+        return f'AnnotationIndex(polygons={self.num_polygons}, grid_shape={self.grid_shape}, cell_size={self.cell_size})'
+
+
+def check_tumor_mask(lesion_annots: LesionAnnotations, points: np.ndarray, mask_shape: tuple,
+                     resolution: float = 1, tumor_mask: np.ndarray = None,
+                     tolerance: float = RASTER_TOLERANCE) -> bool:
+    '''Compare the labels of LesionAnnotations.tumor_mask() with LesionAnnotations.contains_tumor() on the points.
+
+    - Args
+        lesion_annots: Annotations of the slide
+        points: Points on the grid of the mask of shape (n, 2); multiples of resolution, e.g. the roi coordinates
+        mask_shape: Shape of the mask; (width, height)
+        resolution: Pixels of the annotation coordinates per mask pixel
+        tumor_mask: Raster to check; rasterized if None
+        tolerance: Maximum fraction of the points labeled differently, e.g. on the border of the polygons
+
+    - Returns
+        True if the fraction of the points labeled differently is within the tolerance
+    '''
+    if tumor_mask is None:
+        tumor_mask = lesion_annots.tumor_mask(mask_shape, resolution)
+
+    points = np.asarray(points).reshape(-1, 2)
+    grid_points = (points // resolution).astype(np.int64)
+    raster_labels = tumor_mask[grid_points[:, 0], grid_points[:, 1]]
+    exact_labels = lesion_annots.contains_tumor(points)
+
+    num_different = int(np.count_nonzero(raster_labels != exact_labels))
+    fraction = num_different / max(len(points), 1)
+    if num_different:
+        print(f'{lesion_annots}: {num_different} of {len(points)} points are labeled differently ({fraction:.2e})')
+
+    return fraction <= tolerance
+
+
+def pack_annotations(lesion_annots: dict) -> tuple:
+    '''Flatten the positive and negative annotations to a single array of vertices.
+
+    - Args
+        lesion_annots: Dict of the json annotation; {'pos': [{'name', 'coords'}, ...], 'neg': [...]}
+
+    - Returns
+        A tuple of (names, is_pos flags, float64 vertices of shape (num_vertices, 2), offsets of shape (num_polygons + 1,))
+    '''
+    annots = [(annot, True) for annot in lesion_annots['pos']] + [(annot, False) for annot in lesion_annots['neg']]
+
+    names = [annot['name'] for (annot, _) in annots]
+    is_pos = np.array([is_pos for (_, is_pos) in annots], dtype=bool)
+    coords_list = [np.asarray(annot['coords'], dtype=np.float64).reshape(-1, 2) for (annot, _) in annots]
+    offsets = np.zeros(len(annots) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(coords) for coords in coords_list])
+    vertices = np.concatenate([np.empty((0, 2))] + coords_list)
+
+    return names, is_pos, vertices, offsets
+
+
+def save_annotation_store(store_path: str, lesion_annots: dict) -> None:
+    '''Save the annotations of a slide as a single array of vertices; see storage.write_array().
+
+    The names, pos/neg flags, offsets and bounding boxes of the polygons are saved in the header.
+
+    - Args
+        store_path: Path to save the annotation store
+        lesion_annots: Dict of the json annotation; {'pos': [{'name', 'coords'}, ...], 'neg': [...]}
+
+    - Returns
+        None
+    '''
+    names, is_pos, vertices, offsets = pack_annotations(lesion_annots)
+    bboxes = polygon_bboxes(vertices, offsets)
+    meta = {
+        'kind': 'annotations',
+        'version': ANNOTATION_STORE_VERSION,
+        'names': names,
+        'is_pos': is_pos.tolist(),
+        'offsets': offsets.tolist(),
+        'bboxes': np.where(np.isnan(bboxes), None, bboxes).tolist(),
+    }
+    write_array(store_path, vertices, meta)
+
+
+def annotation_path(annots_dir: str, patient_id: str) -> str:
+    '''Return the path to the annotation of the given patient; the annotation store if there is one.'''
+    store_path = os.path.join(annots_dir, f'{patient_id}{ANNOTATION_STORE_EXT}')
+    if os.path.exists(store_path):
+        return store_path
+
+    return os.path.join(annots_dir, f'{patient_id}.json')
+
+
+def parse_coords(x_coords: list, y_coords: list) -> np.ndarray:
+    '''Parse the X, Y attributes of the vertices at once; truncated to int like int(float(value)).'''
+    coords = np.empty((len(x_coords), 2), dtype=np.int64)
+    coords[:, 0] = np.array(x_coords, dtype=np.float64)
+    coords[:, 1] = np.array(y_coords, dtype=np.float64)
+
+    return coords
+
+
+def iter_xml_annotations(xml_path_in: str):
+    '''Stream the annotations of an ASAP xml file; every element is cleared once it is parsed.
+
+    - Args
+        xml_path_in: Path to the xml annotation file
+
+    - Returns
+        A generator of tuples; (name, PartOfGroup, vertices of shape (n, 2)) in the order of the file
+    '''
+    path = [] # tags from the root to the current element
+    x_coords, y_coords = [], []
+    for (event, elem) in ET.iterparse(xml_path_in, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+
+        # ./Annotations/Annotation/Coordinates/Coordinate
+        if path[1:] == ['Annotations', 'Annotation', 'Coordinates', 'Coordinate']:
+            x_coords.append(elem.get('X'))
+            y_coords.append(elem.get('Y'))
+            elem.clear()
+        # ./Annotations/Annotation
+        elif path[1:] == ['Annotations', 'Annotation']:
+            yield elem.get('Name'), elem.get('PartOfGroup'), parse_coords(x_coords, y_coords)
+            x_coords, y_coords = [], []
+            elem.clear()
+
+        path.pop()
+
+
+def read_xml_annotations(xml_path_in: str) -> dict:
+    '''Read the positive and negative annotations of an xml annotation in a single streaming pass.
+
+    - Args
+        xml_path_in: Path to the xml annotation file
+
+    - Returns
+        A dict of the json annotation; {'pos': [{'name', 'coords'}, ...], 'neg': [...]} with int64 coords of shape (n, 2)
+    '''
+    group_annots = {group: [] for group in POS_GROUPS + NEG_GROUPS}
+    for (annot_name, group, coords) in iter_xml_annotations(xml_path_in):
+        if group not in group_annots:
+            continue
+
+        if group in POS_GROUPS:
+            annot_name = f'Annotation{annot_name}'
+        elif 'Annotation' not in annot_name:
             annot_name = f'Annotation{annot_name}'
 
-        json_annot['neg'].append({
+        group_annots[group].append({
             'name': annot_name,
             'coords': coords,
         })
 
-    with open(json_path_out, 'w', encoding='utf-8') as f:
+    return {
+        'pos': [annot for group in POS_GROUPS for annot in group_annots[group]],
+        'neg': [annot for group in NEG_GROUPS for annot in group_annots[group]],
+    }
+
+
+def xml_to_json(xml_path_in: str, json_path_out: str) -> None:
+    '''Convert xml annotation to json
+    
+    The file is parsed in a single streaming pass; memory follows the largest annotation, not the file.
+
+    - Args
+        xml_in_path: Path to the input xml annotation file
+        json_out_path: Path to save the output json annotation file
+
+    - Returns
+        None
+    '''
+    lesion_annots = read_xml_annotations(xml_path_in)
+    json_annot = {
+        class_: [{'name': annot['name'], 'coords': annot['coords'].tolist()} # because np.ndarray is not json serializable
+                 for annot in annots]
+        for (class_, annots) in lesion_annots.items()
+    }
+
+    tmp_path = f'{json_path_out}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(json_annot, f, indent=1)
+    os.replace(tmp_path, json_path_out)
+
+
+def xml_to_store(xml_path_in: str, store_path_out: str) -> None:
+    '''Convert xml annotation to the annotation store; see save_annotation_store().'''
+    save_annotation_store(store_path_out, read_xml_annotations(xml_path_in))
+
+
+def json_to_store(json_path_in: str, store_path_out: str = None) -> str:
+    '''Convert json annotation to the annotation store; saved next to the json annotation if store_path_out is None.'''
+    if store_path_out is None:
+        store_path_out = f'{os.path.splitext(json_path_in)[0]}{ANNOTATION_STORE_EXT}'
+
+    with open(json_path_in, 'r', encoding='utf-8') as f:
+        save_annotation_store(store_path_out, json.load(f))
+
+    return store_path_out
+
+
+# Output format -> (extension, converter)
+ANNOTATION_FORMATS = {
+    'json': ('.json', xml_to_json),
+    'store': (ANNOTATION_STORE_EXT, xml_to_store),
+}
+
+
+def convert_xml_annotations(xml_dir_in: str, json_dir_out: str, overwrite: bool = False,
+                            num_workers: int = 1, output_format: str = 'json') -> int:
+    '''Convert every xml annotation of the directory to json, over a process pool if num_workers > 1.
+
+    - Args
+        xml_dir_in: Path to the directory of the xml annotations
+        json_dir_out: Path to the directory to save the json annotations
+        overwrite: Convert the annotations already converted again if True
+        num_workers: Number of worker processes; convert in this process if 1
+        output_format: 'json', or 'store' to save the annotation stores; see save_annotation_store()
+
+    - Returns
+        The number of converted annotations
+    '''
+    assert output_format in ANNOTATION_FORMATS, f'Unknown output format: {output_format}'
+    annot_ext, convert = ANNOTATION_FORMATS[output_format]
+    os.makedirs(json_dir_out, exist_ok=True)
+
+    xml_annot_fnames = sorted(fname for fname in os.listdir(xml_dir_in) if fname.endswith('.xml'))
+    tasks = []
+    for xml_fname in xml_annot_fnames:
+        patient_id = os.path.splitext(xml_fname)[0]
+        json_path = os.path.join(json_dir_out, f'{patient_id}{annot_ext}')
+        if (not overwrite) and os.path.exists(json_path):
+            continue
+        tasks.append((os.path.join(xml_dir_in, xml_fname), json_path))
+
+    num_converted = 0
+    if num_workers <= 1:
+        for (xml_path, json_path) in tasks:
+            convert(xml_path, json_path)
+            num_converted += 1
+            print(f'Converted {Path(xml_path).name} to {Path(json_path).name}')
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(convert, xml_path, json_path): (xml_path, json_path)
+                       for (xml_path, json_path) in tasks}
+            for future in as_completed(futures):
+                future.result()
+                xml_path, json_path = futures[future]
+                num_converted += 1
+                print(f'Converted {Path(xml_path).name} to {Path(json_path).name}')
+
+    return num_converted
 
 
 if __name__ == '__main__':
@@ -287,29 +862,7 @@ if __name__ == '__main__':
     TEST_JSON_ANNOTS_DIR = os.path.join(TEST_ANNOTS_DIR, 'json')
 
     # Convert training annotations
-    os.makedirs(TRAIN_JSON_ANNOTS_DIR, exist_ok=True)
-    train_json_annot_fnames = os.listdir(TRAIN_JSON_ANNOTS_DIR)
-
-    train_xml_annot_fnames = os.listdir(TRAIN_XML_ANNOTS_DIR)
-    train_xml_annot_fnames = [fname.strip('.xml') for fname in train_xml_annot_fnames]
-    train_xml_annot_fnames = sorted(train_xml_annot_fnames)
-    for fname in train_xml_annot_fnames:
-        if f'{fname}.json' not in train_json_annot_fnames:
-            xml_path = os.path.join(TRAIN_XML_ANNOTS_DIR, f'{fname}.xml')
-            json_path = os.path.join(TRAIN_JSON_ANNOTS_DIR, f'{fname}.json')
-            xml_to_json(xml_path_in=xml_path, json_path_out=json_path)
-            print(f'Converted {fname}.xml to {fname}.json')
+    convert_xml_annotations(xml_dir_in=TRAIN_XML_ANNOTS_DIR, json_dir_out=TRAIN_JSON_ANNOTS_DIR)
 
     # Convert test annotations
-    os.makedirs(TEST_JSON_ANNOTS_DIR, exist_ok=True)
-    test_json_annot_fnames = os.listdir(TEST_JSON_ANNOTS_DIR)
-
-    test_xml_annot_fnames = os.listdir(TEST_XML_ANNOTS_DIR)
-    test_xml_annot_fnames = [fname.strip('.xml') for fname in test_xml_annot_fnames]
-    test_xml_annot_fnames = sorted(test_xml_annot_fnames)
-    for fname in test_xml_annot_fnames:
-        if f'{fname}.json' not in test_json_annot_fnames:
-            xml_path = os.path.join(TEST_XML_ANNOTS_DIR, f'{fname}.xml')
-            json_path = os.path.join(TEST_JSON_ANNOTS_DIR, f'{fname}.json')
-            xml_to_json(xml_path_in=xml_path, json_path_out=json_path)
-            print(f'Converted {fname}.xml to {fname}.json')
+    convert_xml_annotations(xml_dir_in=TEST_XML_ANNOTS_DIR, json_dir_out=TEST_JSON_ANNOTS_DIR)
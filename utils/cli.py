@@ -0,0 +1,210 @@
+'''Entry point of fake-doctors; python cli.py <command> [args]
+
+Only argparse is imported to parse the command; each command imports its modules when it runs,
+so `--help` and the commands which do not need slides or skimage start fast.
+'''
+import argparse
+import os
+import sys
+
+PROG = 'fake-doctors'
+
+
+def run_download(args: argparse.Namespace) -> None:
+    from dataset import BASE_URL, Camelyon16
+
+    downloader = Camelyon16(urls_dir_in=args.urls_dir,
+                            wsi_dir_out=args.wsi_dir,
+                            annots_dir_out=args.annots_dir,
+                            base_url=args.base_url or BASE_URL,
+                            num_workers=args.num_workers,
+                            max_retries=args.max_retries)
+    downloader.download_trainset()
+    downloader.split_train_valid(ratio=args.valid_ratio, seed=args.seed, num_folds=args.num_folds, link=args.link)
+    if not args.skip_test:
+        downloader.download_testset()
+    if not args.skip_manifest:
+        downloader.update_manifests()
+
+
+def run_verify(args: argparse.Namespace) -> None:
+    from manifest import update_manifest, verify_manifest
+
+    failed = False
+    for root_dir in args.dirs:
+        if args.update:
+            update_manifest(root_dir, num_workers=args.num_workers)
+            continue
+        try:
+            stats = verify_manifest(root_dir, num_workers=args.num_workers, full=args.full)
+        except FileNotFoundError as e:
+            print(e)
+            failed = True
+            continue
+        # Untracked files fail too; a lost manifest entry must not pass silently, --update records new files
+        for key in ('missing', 'corrupt', 'untracked'):
+            for rel_path in stats[key]:
+                print(f'{key}: {os.path.join(root_dir, rel_path)}')
+        failed = failed or bool(stats['missing'] or stats['corrupt'] or stats['untracked'])
+    if failed:
+        sys.exit(1)
+
+
+def run_annotations(args: argparse.Namespace) -> None:
+    from annotation import convert_xml_annotations
+
+    num_converted = convert_xml_annotations(xml_dir_in=args.xml_dir,
+                                            json_dir_out=args.json_dir,
+                                            overwrite=args.overwrite,
+                                            num_workers=args.num_workers,
+                                            output_format=args.output_format)
+    print(f'Converted {num_converted} annotations to {args.json_dir}')
+
+
+def patch_sampler(args: argparse.Namespace):
+    '''Make the PatchSampler of the arguments of add_sampler_arguments().'''
+    from sampling import PatchSampler
+
+    return PatchSampler(wsi_dir_in=args.wsi_dir,
+                        masks_dir_in=args.masks_dir,
+                        annots_dir_in=args.annots_dir,
+                        tumor_coords_dir_in=args.tumor_coords_dir,
+                        normal_coords_dir_in=args.normal_coords_dir,
+                        patches_dir_out=args.patches_dir,
+                        max_open_slides=args.max_open_slides,
+                        tumor_labeling=args.tumor_labeling,
+                        split_path=args.split,
+                        subset=args.subset)
+
+
+def run_coords(args: argparse.Namespace) -> None:
+    sampler = patch_sampler(args)
+    if args.migrate_json:
+        sampler.migrate_json_caches(wsi_level=args.wsi_level, remove_json=args.remove_json)
+
+    coord_index = sampler.build_coordinate_index(wsi_level=args.wsi_level,
+                                                 patch_size=args.patch_size,
+                                                 min_tissue_fraction=args.min_tissue_fraction)
+    print(f'Coordinates are cached: {coord_index}')
+
+
+def run_sample(args: argparse.Namespace) -> None:
+    sampler = patch_sampler(args)
+    sampler.sample_patches(num_patches=args.num_patches,
+                           wsi_level=args.wsi_level,
+                           patch_size=args.patch_size,
+                           num_workers=args.num_workers,
+                           seed=args.seed,
+                           output_format=args.output_format,
+                           shard_size=args.shard_size,
+                           resume=not args.restart,
+                           append=args.append,
+                           max_region_size=args.max_region_size,
+                           min_tissue_fraction=args.min_tissue_fraction)
+
+
+def add_sampler_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--wsi-dir', required=True, help='directory of the wsi; tumor/ and normal/')
+    parser.add_argument('--masks-dir', required=True, help='directory of the roi masks')
+    parser.add_argument('--annots-dir', required=True, help='directory of the json annotations or annotation stores')
+    parser.add_argument('--tumor-coords-dir', required=True, help='directory of the tumor coordinates caches')
+    parser.add_argument('--normal-coords-dir', required=True, help='directory of the normal coordinates caches')
+    parser.add_argument('--patches-dir', required=True, help='directory to save the patches')
+    parser.add_argument('--split', default=None, help='split manifest to sample the wsi of instead of --wsi-dir')
+    parser.add_argument('--subset', default='train', help='subset of the split manifest; e.g. train or valid')
+    parser.add_argument('--max-open-slides', type=int, default=16, help='maximum number of wsi kept open')
+    parser.add_argument('--tumor-labeling', choices=['raster', 'check', 'exact'], default='raster',
+                        help='rasterize the annotations, check the raster against the polygon test too, '
+                             'or test every roi point against the polygons')
+    parser.add_argument('--wsi-level', type=int, default=0, help='level of the wsi')
+    parser.add_argument('--patch-size', type=int, default=300, help='size of the patch')
+    parser.add_argument('--min-tissue-fraction', type=float, default=0.0,
+                        help='drop the candidate patches with less tissue under them')
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog=PROG, description='Camelyon16 data preparation tools.')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    download_parser = subparsers.add_parser('download', help='download the Camelyon16 wsi and annotations')
+    download_parser.add_argument('--urls-dir', required=True, help='directory to cache the download urls')
+    download_parser.add_argument('--wsi-dir', required=True, help='directory to save the wsi')
+    download_parser.add_argument('--annots-dir', required=True, help='directory to save the annotations')
+    download_parser.add_argument('--valid-ratio', type=float, default=0.2,
+                                 help='ratio of the training wsi of the validation set of the split manifest')
+    download_parser.add_argument('--num-folds', type=int, default=1,
+                                 help='save a split manifest per fold instead of a --valid-ratio split')
+    download_parser.add_argument('--seed', type=int, default=0, help='seed of the split')
+    download_parser.add_argument('--link', choices=['hardlink', 'symlink'], default=None,
+                                 help='also link the wsi of every split into a train/valid directory layout')
+    download_parser.add_argument('--skip-test', action='store_true', help='do not download the test set')
+    download_parser.add_argument('--base-url', default=None,
+                                 help='ftp or http(s) url of the CAMELYON16 directory; the GigaDB ftp server if none')
+    download_parser.add_argument('--num-workers', type=int, default=4, help='number of concurrent transfers')
+    download_parser.add_argument('--max-retries', type=int, default=5, help='number of retries of a file')
+    download_parser.add_argument('--skip-manifest', action='store_true',
+                                 help='do not hash the downloaded files into the manifests')
+    download_parser.set_defaults(run=run_download)
+
+    verify_parser = subparsers.add_parser('verify', help='verify the files of directories against their manifests; '
+                                                         'exits with 1 on missing, corrupt or untracked files')
+    verify_parser.add_argument('dirs', nargs='+', help='directories with a manifest.json; e.g. --wsi-dir, --annots-dir')
+    verify_parser.add_argument('--full', action='store_true', help='hash the files with unchanged size/mtime too')
+    verify_parser.add_argument('--update', action='store_true', help='hash the new or changed files into the manifests')
+    verify_parser.add_argument('--num-workers', type=int, default=8, help='number of concurrent reads')
+    verify_parser.set_defaults(run=run_verify)
+
+    # Arguments of masks are parsed by mask.main(); see main()
+    subparsers.add_parser('masks', help='generate the roi masks of slide directories', add_help=False)
+
+    annots_parser = subparsers.add_parser('annotations', help='convert xml annotations to json or annotation stores')
+    annots_parser.add_argument('xml_dir', help='directory of the xml annotations')
+    annots_parser.add_argument('json_dir', help='directory to save the converted annotations')
+    annots_parser.add_argument('--overwrite', action='store_true', help='convert the converted annotations again')
+    annots_parser.add_argument('--num-workers', type=int, default=1, help='number of worker processes')
+    annots_parser.add_argument('--output-format', choices=['json', 'store'], default='json',
+                               help='save json or the binary annotation stores')
+    annots_parser.set_defaults(run=run_annotations)
+
+    coords_parser = subparsers.add_parser('coords', help='build the coordinates caches of the sampler')
+    add_sampler_arguments(coords_parser)
+    coords_parser.add_argument('--migrate-json', action='store_true',
+                               help='convert the json caches of the older versions first')
+    coords_parser.add_argument('--remove-json', action='store_true', help='remove the converted json caches')
+    coords_parser.set_defaults(run=run_coords)
+
+    sample_parser = subparsers.add_parser('sample', help='sample and extract patches')
+    add_sampler_arguments(sample_parser)
+    sample_parser.add_argument('num_patches', type=int, help='number of patches')
+    sample_parser.add_argument('--num-workers', type=int, default=1, help='number of worker processes')
+    sample_parser.add_argument('--seed', type=int, default=None, help='seed of the sampling')
+    sample_parser.add_argument('--output-format', choices=['png', 'shard'], default='png',
+                               help='save each patch as png or the patches as shards')
+    sample_parser.add_argument('--shard-size', type=int, default=4096, help='number of patches of a shard')
+    sample_parser.add_argument('--restart', action='store_true', help='discard the progress of the previous runs')
+    sample_parser.add_argument('--append', action='store_true',
+                               help='sample more patches if the existing list has less than num_patches')
+    sample_parser.add_argument('--max-region-size', type=int, default=2048,
+                               help='maximum width/height of a region read at once')
+    sample_parser.set_defaults(run=run_sample)
+
+    return parser
+
+
+def main(argv: list = None) -> None:
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # masks has its own parser; forward every argument after the command
+    if argv and argv[0] == 'masks':
+        from mask import main as masks_main
+
+        masks_main(argv[1:], prog=f'{PROG} masks')
+        return
+
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
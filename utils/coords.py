@@ -0,0 +1,285 @@
+# Standard Libs
+import hashlib
+import json
+import os
+
+# Third-party Libs
+import numpy as np
+
+# Custom Libs
+from storage import open_array, read_header, write_array
+
+# Bump this when the way the coordinates are computed changes; older caches become stale
+COORDS_CACHE_VERSION = 1
+
+# A patch (slide_index, x, y) is packed into an int64 key; slide_index << 48 | x << 24 | y
+COORD_BITS = 24
+SLIDE_BITS = 15
+
+
+def pack_keys(rows) -> np.ndarray:
+    '''Pack patches into int64 keys.
+
+    - Args
+        rows: Patches of shape (n, 3); (slide_index, x, y)
+
+    - Returns
+        An int64 array of shape (n,)
+    '''
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+    assert (rows >= 0).all(), 'Slide indices and coordinates must be non-negative'
+    assert (rows[:, 0] < (1 << SLIDE_BITS)).all() and (rows[:, 1:] < (1 << COORD_BITS)).all(), \
+        'Slide indices or coordinates are too large to be packed'
+
+    return (rows[:, 0] << (2 * COORD_BITS)) | (rows[:, 1] << COORD_BITS) | rows[:, 2]
+
+
+def unpack_keys(keys) -> np.ndarray:
+    '''Unpack int64 keys made by pack_keys().
+
+    - Args
+        keys: An int64 array of shape (n,)
+
+    - Returns
+        An int64 array of shape (n, 3); (slide_index, x, y)
+    '''
+    keys = np.asarray(keys, dtype=np.int64).reshape(-1)
+    coord_mask = (1 << COORD_BITS) - 1
+
+    rows = np.empty((len(keys), 3), dtype=np.int64)
+    rows[:, 0] = keys >> (2 * COORD_BITS)
+    rows[:, 1] = (keys >> COORD_BITS) & coord_mask
+    rows[:, 2] = keys & coord_mask
+
+    return rows
+
+
+class CoordinateIndex:
+    '''Candidate center coordinates of every slide, kept in memory as int32 arrays.'''
+
+    def __init__(self, classes: tuple = ('tumor', 'normal'), seed: int = None) -> None:
+        '''Initialize the CoordinateIndex.
+
+        - Args
+            classes: Names of the classes to sample from
+            seed: Seed of the random generator; not reproducible if None
+
+        - Returns
+            None
+        '''
+        self.classes = list(classes)
+        self.rng = np.random.default_rng(seed)
+
+        self.patient_ids = [] # slide index -> patient id
+        self.coords = [] # slide index -> int32 array of shape (n, 2)
+        self.class_slides_dict = {class_: [] for class_ in self.classes} # class -> slide indices
+
+    def add(self, class_: str, patient_id: str, coords) -> None:
+        '''Add the candidate coordinates of a slide.
+
+        - Args
+            class_: Class of the coordinates
+            patient_id: Patient id of the slide
+            coords: Candidate center coordinates of shape (n, 2)
+
+        - Returns
+            None
+        '''
+        coords = np.asarray(coords, dtype=np.int32).reshape(-1, 2)
+        # Slides without any candidate can not be sampled from
+        if len(coords) == 0:
+            return
+
+        slide_index = len(self.patient_ids)
+        self.patient_ids.append(patient_id)
+        self.coords.append(coords)
+        self.class_slides_dict[class_].append(slide_index)
+
+    def class_index(self, slide_index: int) -> int:
+        '''Return the index of the class the given slide belongs to.'''
+        for (i, class_) in enumerate(self.classes):
+            if slide_index in self.class_slides_dict[class_]:
+                return i
+
+        raise KeyError(slide_index)
+
+    @property
+    def num_coords(self) -> int:
+        '''Total number of candidate coordinates'''
+        return sum(len(coords) for coords in self.coords)
+
+    def draw(self, num_draws: int, rng: np.random.Generator = None) -> np.ndarray:
+        '''Draw coordinates with replacement; class first, slide next and coordinate last.
+
+        Every class has the same probability and so does every slide of a class,
+        regardless of how many candidates they have.
+
+        - Args
+            num_draws: Number of coordinates to draw
+            rng: Random generator to draw with; the generator of the index if None
+
+        - Returns
+            An int64 array of shape (num_draws, 3); (slide_index, x, y)
+        '''
+        if rng is None:
+            rng = self.rng
+
+        classes = [class_ for class_ in self.classes if self.class_slides_dict[class_]]
+        assert classes, 'CoordinateIndex is empty'
+
+        picked_classes = rng.integers(len(classes), size=num_draws)
+        picked_slides = np.empty(num_draws, dtype=np.int64)
+        for (i, class_) in enumerate(classes):
+            class_mask = picked_classes == i
+            class_slides = np.asarray(self.class_slides_dict[class_])
+            picked = rng.integers(len(class_slides), size=class_mask.sum())
+            picked_slides[class_mask] = class_slides[picked]
+
+        draws = np.empty((num_draws, 3), dtype=np.int64)
+        draws[:, 0] = picked_slides
+        for slide_index in np.unique(picked_slides):
+            slide_mask = picked_slides == slide_index
+            slide_coords = self.coords[slide_index]
+            picked = rng.integers(len(slide_coords), size=slide_mask.sum())
+            draws[slide_mask, 1:] = slide_coords[picked]
+
+        return draws
+
+    def sample(self, num_patches: int, max_rounds: int = 100, exclude: np.ndarray = None) -> np.ndarray:
+        '''Sample unique coordinates.
+
+        Duplicated draws are dropped and only the missing number of patches is redrawn.
+
+        - Args
+            num_patches: Number of unique coordinates to sample
+            max_rounds: Maximum number of redraws
+            exclude: Already sampled coordinates not to sample again; (slide_index, x, y) of shape (m, 3)
+
+        - Returns
+            An int64 array of shape (num_patches, 3); (slide_index, x, y)
+        '''
+        if exclude is None:
+            exclude = np.empty((0, 3), dtype=np.int64)
+        exclude_keys = np.unique(pack_keys(exclude))
+        num_excluded = len(exclude_keys)
+
+        if num_patches + num_excluded > self.num_coords:
+            raise ValueError(f'Can not sample {num_patches} unique patches '
+                             f'from {self.num_coords - num_excluded} candidates')
+
+        # Excluded keys come first, so that the draws duplicating them are dropped
+        sample_keys = exclude_keys
+        for _ in range(max_rounds):
+            num_missing = num_excluded + num_patches - len(sample_keys)
+            if num_missing <= 0:
+                break
+
+            draws = self.draw(num_missing)
+            sample_keys = np.concatenate([sample_keys, pack_keys(draws)])
+            # Keep the first occurrence of every key in the order of the draws
+            _, first_indices = np.unique(sample_keys, return_index=True)
+            sample_keys = sample_keys[np.sort(first_indices)]
+
+        sample_keys = sample_keys[num_excluded:]
+        if len(sample_keys) < num_patches:
+            raise RuntimeError(f'Only {len(sample_keys)}/{num_patches} unique patches '
+                               f'were sampled in {max_rounds} rounds')
+
+        return unpack_keys(sample_keys[:num_patches])
+
+    def __len__(self) -> int:
+        return len(self.patient_ids)
+
+    def __repr__(self) -> str:
+        num_slides = ', '.join(f'{class_}={len(self.class_slides_dict[class_])}'
+                               for class_ in self.classes)
+        return f'CoordinateIndex(slides: {num_slides}, coords={self.num_coords})'
+
+
+def source_fingerprint(*source_paths, **params) -> str:
+    '''Fingerprint the sources of a cache; name, size and modification time of each file.
+
+    - Args
+        source_paths: Paths to the files the cache is computed from
+        params: Parameters the cache is computed with, e.g. wsi_level
+
+    - Returns
+        A hex digest which changes when any source or parameter changes
+    '''
+    sources = []
+    for source_path in source_paths:
+        stat = os.stat(source_path)
+        sources.append([os.path.basename(source_path), stat.st_size, stat.st_mtime_ns])
+
+    source_json = json.dumps({'sources': sources, 'params': params}, sort_keys=True)
+
+    return hashlib.sha1(source_json.encode('utf-8')).hexdigest()
+
+
+def save_coords_cache(cache_path: str, coords, fingerprint: str) -> None:
+    '''Save coordinates as a binary cache.
+
+    - Args
+        cache_path: Path to save the cache
+        coords: Coordinates of shape (n, 2)
+        fingerprint: Fingerprint of the sources; see source_fingerprint()
+
+    - Returns
+        None
+    '''
+    coords = np.asarray(coords, dtype=np.int32).reshape(-1, 2)
+    meta = {
+        'kind': 'coords',
+        'version': COORDS_CACHE_VERSION,
+        'fingerprint': fingerprint,
+    }
+    write_array(cache_path, coords, meta)
+
+
+def load_coords_cache(cache_path: str, fingerprint: str = None) -> np.ndarray:
+    '''Memory-map a binary coordinates cache.
+
+    - Args
+        cache_path: Path to the cache
+        fingerprint: Expected fingerprint of the sources; not checked if None
+
+    - Returns
+        Read-only int32 array of shape (n, 2), None if the cache does not exist or is stale
+    '''
+    if not os.path.exists(cache_path):
+        return None
+
+    header_dict, _ = read_header(cache_path)
+    if header_dict.get('version') != COORDS_CACHE_VERSION:
+        return None
+    if (fingerprint is not None) and (header_dict.get('fingerprint') != fingerprint):
+        return None
+
+    coords, _ = open_array(cache_path, mmap=True)
+
+    return coords
+
+
+def migrate_json_cache(json_path: str, cache_path: str, fingerprint: str) -> int:
+    '''Convert a json coordinates cache to a binary cache.
+
+    - Args
+        json_path: Path to the json cache; {'tumor_coords': [...]} or {'normal_coords': [...]}
+        cache_path: Path to save the binary cache
+        fingerprint: Fingerprint of the sources the json cache was computed from
+
+    - Returns
+        The number of migrated coordinates
+    '''
+    with open(json_path, 'r', encoding='utf-8') as f:
+        coords_dict = json.load(f)
+
+    if 'tumor_coords' in coords_dict:
+        coords = coords_dict['tumor_coords']
+    else:
+        coords = coords_dict.get('normal_coords', [])
+
+    coords = np.asarray(coords, dtype=np.int32).reshape(-1, 2)
+    save_coords_cache(cache_path, coords, fingerprint)
+
+    return len(coords)
@@ -1,27 +1,38 @@
 import json
 import os
-import shutil
-import time
 from collections import defaultdict
 from zipfile import ZipFile
 
-import wget
+from download import download_file, download_files
+from manifest import update_manifest, verify_manifest
+from split import SPLITS_DIRNAME, list_class_slides, make_folds, materialize_split, save_split
+
+BASE_URL = 'ftp://parrot.genomics.cn/gigadb/pub/10.5524/100001_101000/100439/CAMELYON16'
 
 
 class Camelyon16:
     '''Camelyon16 dataset downloader'''
 
-    def __init__(self, urls_dir_in: str, wsi_dir_out: str, annots_dir_out: str) -> None:
+    def __init__(self, urls_dir_in: str, wsi_dir_out: str, annots_dir_out: str, base_url: str = BASE_URL,
+                 num_workers: int = 4, max_retries: int = 5, retry_wait: float = 10.0) -> None:
         '''Initialize Camelyon16.
 
         - Args
             urls_dir_in: Path to the directory to cache the wsi download urls
             wsi_dir_out: Path to the directory to save the downloaded wsi
+            annots_dir_out: Path to the directory to save the annotations
+            base_url: ftp or http(s) url of the CAMELYON16 directory; e.g. a mirror or a local server
+            num_workers: Number of concurrent transfers
+            max_retries: Number of retries of a file; each resumes the partial file
+            retry_wait: Seconds to wait before the first retry of a file; doubled at every retry
 
         - Returns
             None
         '''
-        self.base_url = u'ftp://parrot.genomics.cn/gigadb/pub/10.5524/100001_101000/100439/CAMELYON16'
+        self.base_url = base_url.rstrip('/')
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
         self.urls_dir_in = urls_dir_in
         self.wsi_dir_out = wsi_dir_out
         self.annots_dir_out = annots_dir_out
@@ -42,14 +53,29 @@ class Camelyon16:
         # Do not use test_049.tif; the same as tumor_036.tif
         self.test_wsi_range = (1, 131)
 
-    def download_trainset(self) -> None:
-        '''Download Camelyon16 training dataset'''
+    def load_url_cache(self, urls_path: str) -> dict:
+        '''Load a url cache and join its paths with base_url; None if there is none.
+
+        The cache keeps the paths relative to base_url, so a mirror given later is used for every file.
+        Caches of absolute urls saved by the older versions are made again.
+        '''
+        if not os.path.exists(urls_path):
+            return None
+
+        with open(urls_path, 'r', encoding='utf-8') as f:
+            paths_dict = json.load(f)
+        if any('://' in path for paths in paths_dict.values() for path in paths):
+            return None
+
+        return {key: [f'{self.base_url}/{path}' for path in paths] for (key, paths) in paths_dict.items()}
 
+    def train_wsi_urls(self) -> dict:
+        '''Return the urls of the training wsi of each class; the paths are cached in train_wsi_urls.json.'''
         os.makedirs(self.urls_dir_in, exist_ok=True)
 
         # Path to the url cache file(train_wsi_urls.json) to downlod training wsi
         train_wsi_urls_path = os.path.join(self.urls_dir_in, 'train_wsi_urls.json')
-        if not os.path.exists(train_wsi_urls_path):
+        if self.load_url_cache(train_wsi_urls_path) is None:
             # Make urls to download train wsi
             train_wsi_urls_dict = defaultdict(list)
             for (class_, wsi_range) in self.train_wsi_range_dict.items():
@@ -58,64 +84,22 @@ class Camelyon16:
                     if (class_ == 'normal') and (i in (86, 144)):
                         continue
 
-                    train_wsi_url = f'{self.base_url}/training/{class_}/{class_}_{i:03}.tif'
-                    train_wsi_urls_dict[class_].append(train_wsi_url)
+                    train_wsi_path = f'training/{class_}/{class_}_{i:03}.tif'
+                    train_wsi_urls_dict[class_].append(train_wsi_path)
                 # inner for-statement ended
             # outer for-statement ended
             with open(train_wsi_urls_path, 'w+', encoding='utf-8') as f:
-                json.dump(train_wsi_urls_dict, f, indent=4)  
+                json.dump(train_wsi_urls_dict, f, indent=4)
         # if-statement ended
-        with open(train_wsi_urls_path, 'r', encoding='utf-8') as f:
-            train_wsi_urls_dict = json.load(f)
-
-        # Download lesion_annotations.zip
-        annot_zip_fname = 'lesion_annotations.zip'
-        annot_zip_url = f'{self.base_url}/training/{annot_zip_fname}'
-        os.makedirs(self.train_annots_dir, exist_ok=True)
-        wget.download(url=annot_zip_url, out=self.train_annots_dir)
-
-        annot_zip_path = os.path.join(self.train_annots_dir, annot_zip_fname)
-        with ZipFile(annot_zip_path, 'r') as zf:
-            xml_annot_path = os.path.join(self.train_annots_dir, 'xml')
-            zf.extractall(xml_annot_path)
-        os.remove(annot_zip_path) # remove the lesion_annotations.zip file
-
-        os.makedirs(self.train_wsi_dir, exist_ok=True)
-        # Wsi file names in train wsi directory
-        # TODO: In-test code; repair this line if the behavior is wierd
-        # wsi_fnames = os.listdir(self.train_wsi_dir)
-        for (class_, urls) in train_wsi_urls_dict.items():
-            dirname = class_
-            # Path to the directory to save training wsi
-            train_wsi_dir_out = os.path.join(self.train_wsi_dir, dirname) # (1)
-            # TODO: To save tumor/normal wsi separately, keep this code,
-            #       to save tumor/normal wsi together, remove `dirname` from (1)
-            os.makedirs(train_wsi_dir_out, exist_ok=True)
-            wsi_fnames = os.listdir(train_wsi_dir_out)
+        return self.load_url_cache(train_wsi_urls_path)
 
-            # Download every wsi to the directory
-            for url in urls:
-                wsi_fname = url.split('/')[-1]
-                if wsi_fname not in wsi_fnames:
-                    print(f'\nStart downloading {wsi_fname}')
-                    print(f'Url: {url}')
-                    print(f'Save dir: {train_wsi_dir_out}')
-                    try:
-                        wget.download(url=url, out=train_wsi_dir_out)
-                    except Exception:
-                        print('FTP server is busy, try downloading after 10 sec')
-                        time.sleep(10)
-                        wget.download(url=url, out=train_wsi_dir_out)
-                    finally:
-                        print('Problem occured with Gigadb ftp server connection, \
-                               not the error of the program.\n Please try again after a while.')
-
-    def download_testset(self) -> None:
-        '''Download Camelyon16 test dataset'''
+    def test_wsi_urls(self) -> dict:
+        '''Return the urls of the test wsi; the paths are cached in test_wsi_urls.json.'''
+        os.makedirs(self.urls_dir_in, exist_ok=True)
 
         # Path to the url cache file(test_wsi_urls.jon) to download test wsi
         test_wsi_urls_path = os.path.join(self.urls_dir_in, 'test_wsi_urls.json')
-        if not os.path.exists(test_wsi_urls_path):
+        if self.load_url_cache(test_wsi_urls_path) is None:
             # Make urls to download test wsi
             test_wsi_urls_dict = defaultdict(list)
             for i in range(*self.test_wsi_range):
@@ -123,94 +107,151 @@ class Camelyon16:
                 if i == 49:
                     continue
 
-                test_wsi_url = f'{self.base_url}/testing/images/test_{i:03}.tif'
-                test_wsi_urls_dict['images'].append(test_wsi_url)
+                test_wsi_path = f'testing/images/test_{i:03}.tif'
+                test_wsi_urls_dict['images'].append(test_wsi_path)
             # for-statement ended
             with open(test_wsi_urls_path, 'w+', encoding='utf-8') as f:
                 json.dump(test_wsi_urls_dict, f, indent=4)
         # outer if-statement ended
 
-        with open(test_wsi_urls_path, 'r', encoding='utf-8') as f:
-            test_wsi_urls_dict = json.load(f)
+        return self.load_url_cache(test_wsi_urls_path)
 
-        # Download lesion_annotations.zip
+    def download_annotations(self, split: str, annots_dir_out: str) -> None:
+        '''Download lesion_annotations.zip of training or testing and extract the xml annotations.
+
+        - Args
+            split: 'training' or 'testing'; directory of the zip on the server
+            annots_dir_out: Path to the directory to extract the xml annotations into; {annots_dir_out}/xml
+
+        - Returns
+            None
+        '''
         annot_zip_fname = 'lesion_annotations.zip'
-        annot_zip_url = f'{self.base_url}/testing/{annot_zip_fname}'
-        os.makedirs(self.test_annots_dir, exist_ok=True)
-        wget.download(url=annot_zip_url, out=self.test_annots_dir)
+        annot_zip_url = f'{self.base_url}/{split}/{annot_zip_fname}'
+        annot_zip_path = os.path.join(annots_dir_out, annot_zip_fname)
+        os.makedirs(annots_dir_out, exist_ok=True)
+        download_file(annot_zip_url, annot_zip_path, max_retries=self.max_retries, retry_wait=self.retry_wait)
 
-        annot_zip_path = os.path.join(self.test_annots_dir, annot_zip_fname)
         with ZipFile(annot_zip_path, 'r') as zf:
-            xml_annot_path = os.path.join(self.test_annots_dir, 'xml')
+            xml_annot_path = os.path.join(annots_dir_out, 'xml')
             zf.extractall(xml_annot_path)
-        os.remove(annot_zip_path) # remove lesion_annotations.zip file
-
-        os.makedirs(self.test_wsi_dir, exist_ok=True)
-        # Wsi file names in train wsi directory
-        wsi_fnames = os.listdir(self.test_wsi_dir)
-
-        test_wsi_urls = test_wsi_urls_dict['images']
-        for url in test_wsi_urls:
-            wsi_fname = url.split('/')[-1]
-            if wsi_fname not in wsi_fnames:
-                print(f'\nStart downloading {wsi_fname}')
-                wget.download(url=url, out=self.test_wsi_dir)
-
-                print(f'\nStart downloading {wsi_fname}')
-                print(f'Url: {url}')
-                print(f'Save dir: {self.test_wsi_dir}')
-                try:
-                    wget.download(url=url, out=self.test_wsi_dir)
-                except Exception:
-                    print('FTP server is busy, try downloading after 10 sec')
-                    time.sleep(10)
-                    wget.download(url=url, out=self.test_wsi_dir)
-                finally:
-                    print('Sorry, problem occured with GigaDB FTP server, \
-                           not the error of the program.\n Please try again after a while.')
-
-    def split_train_valid(self, ratio: float = 0.2) -> None:
-        '''Split training wsi into trainset/validset according to the given ratio
+        # lesion_annotations.zip is kept; the manifest of annots_dir_out tracks it and the next run skips it
+
+    def download_trainset(self) -> dict:
+        '''Download Camelyon16 training dataset
+
+        Incomplete files are resumed and complete ones are skipped; see download.download_files().
+        Wsi moved to the validation directory by the older split_train_valid() are checked there.
+
+        - Returns
+            A dict of the stats of the wsi downloads
+        '''
+        train_wsi_urls_dict = self.train_wsi_urls()
+
+        # Download lesion_annotations.zip
+        self.download_annotations('training', self.train_annots_dir)
+
+        jobs = []
+        for (class_, urls) in train_wsi_urls_dict.items():
+            dirname = class_
+            # Path to the directory to save training wsi
+            train_wsi_dir_out = os.path.join(self.train_wsi_dir, dirname) # (1)
+            # TODO: To save tumor/normal wsi separately, keep this code,
+            #       to save tumor/normal wsi together, remove `dirname` from (1)
+            valid_wsi_dir = os.path.join(self.valid_wsi_dir, dirname)
+
+            for url in urls:
+                wsi_fname = url.split('/')[-1]
+                wsi_path = os.path.join(train_wsi_dir_out, wsi_fname)
+                valid_wsi_path = os.path.join(valid_wsi_dir, wsi_fname)
+                if os.path.exists(valid_wsi_path):
+                    wsi_path = valid_wsi_path
+                jobs.append((url, wsi_path))
+
+        return download_files(jobs, num_workers=self.num_workers,
+                              max_retries=self.max_retries, retry_wait=self.retry_wait)
+
+    def download_testset(self) -> dict:
+        '''Download Camelyon16 test dataset
+
+        - Returns
+            A dict of the stats of the wsi downloads
+        '''
+        test_wsi_urls_dict = self.test_wsi_urls()
+
+        # Download lesion_annotations.zip
+        self.download_annotations('testing', self.test_annots_dir)
+
+        jobs = [(url, os.path.join(self.test_wsi_dir, url.split('/')[-1])) for url in test_wsi_urls_dict['images']]
+
+        return download_files(jobs, num_workers=self.num_workers,
+                              max_retries=self.max_retries, retry_wait=self.retry_wait)
+
+    def split_train_valid(self, ratio: float = 0.2, seed: int = 0, num_folds: int = 1, link: str = None) -> list:
+        '''Split training wsi into trainset/validset, stratified by class, with split manifests
+
+        No wsi is moved; every split is saved as {wsi_dir_out}/splits/{name}.json which PatchSampler and
+        the mask tools read instead of the directories. See split.py.
 
         - Args
-            ratio: Ratio to split the training dataset; percentage of validation set
+            ratio: Ratio to split the training dataset; percentage of validation set, used if num_folds is 1
+            seed: Seed of the shuffle of the wsi
+            num_folds: Number of folds; a manifest per fold whose validation set is the fold
+            link: 'hardlink' or 'symlink' to also link the wsi of every split into {wsi_dir_out}/splits/{name}/
+                  {train,valid}/{class}; no links if None
 
         - Returns
-            None
+            A list of the paths to the split manifests
         '''
-        # Split training tumor wsi into train/valid
-        train_tumor_wsi_dir = os.path.join(self.train_wsi_dir, 'tumor')
-        valid_tumor_wsi_dir = os.path.join(self.valid_wsi_dir, 'tumor')
-        train_tumor_wsi_fnames = os.listdir(train_tumor_wsi_dir)
-        train_tumor_wsi_fnames = sorted(train_tumor_wsi_fnames)
-
-        num_train_tumor_wsi = len(train_tumor_wsi_fnames)
-        num_valid_tumor_wsi = round(num_train_tumor_wsi * ratio)
-
-        valid_tumor_start = num_train_tumor_wsi - num_valid_tumor_wsi 
-        valid_tumor_wsi_fnames = train_tumor_wsi_fnames[valid_tumor_start:]
-        # Move validation wsi from *train_tumor_wsi_dir* to  *valid_tumor_wsi_dir*
-        for fname in valid_tumor_wsi_fnames:
-            train_tumor_wsi_path = os.path.join(train_tumor_wsi_dir, fname) # from here
-            valid_tumor_wsi_path = os.path.join(valid_tumor_wsi_dir, fname) # to here
-            shutil.move(train_tumor_wsi_path, valid_tumor_wsi_path)
-
-        # Split training normal wsi into train/valid
-        train_normal_wsi_dir = os.path.join(self.train_wsi_dir, 'normal')
-        valid_normal_wsi_dir = os.path.join(self.valid_wsi_dir, 'normal')
-        train_normal_wsi_fnames = os.listdir(train_normal_wsi_dir)
-        train_normal_wsi_fnames = sorted(train_normal_wsi_fnames)
-
-        num_train_normal_wsi = len(train_normal_wsi_fnames)
-        num_valid_normal_wsi = round(num_train_normal_wsi * ratio)
-
-        valid_normal_start = num_train_normal_wsi - num_valid_normal_wsi
-        valid_normal_wsi_fnames = train_normal_wsi_fnames[valid_normal_start:]
-        # Move validation wsi from *train_normal_wsi_dir* to *valid_normal_wsi_dir*
-        for fname in valid_normal_wsi_fnames:
-            train_normal_wsi_path = os.path.join(train_normal_wsi_dir, fname) # from here
-            valid_normal_wsi_path = os.path.join(valid_normal_wsi_dir, fname) # to here
-            shutil.move(train_normal_wsi_path, valid_normal_wsi_path)
+        # Wsi moved to the validation directory by the older versions are split again
+        slides = list_class_slides([self.train_wsi_dir, self.valid_wsi_dir])
+        splits_dir = os.path.join(self.wsi_dir_out, SPLITS_DIRNAME)
+
+        split_paths = []
+        for (fold, subsets) in enumerate(make_folds(slides, valid_ratio=ratio, num_folds=num_folds, seed=seed)):
+            if num_folds == 1:
+                name = f'valid{ratio:g}_seed{seed}'
+            else:
+                name = f'fold{fold}of{num_folds}_seed{seed}'
+            split_path = os.path.join(splits_dir, f'{name}.json')
+            save_split(split_path, slides, subsets, ratio=ratio, seed=seed, num_folds=num_folds, fold=fold)
+            if link is not None:
+                materialize_split(split_path, os.path.join(splits_dir, name), link=link)
+            print(f'{split_path}: {len(subsets["train"])} train, {len(subsets["valid"])} valid wsi')
+            split_paths.append(split_path)
+
+        return split_paths
+
+    def update_manifests(self) -> dict:
+        '''Record the size, modification time and content hash of the wsi and the annotation archives.
+
+        manifest.json is saved in wsi_dir_out and annots_dir_out; only new or changed files are hashed,
+        and moved wsi keep their hash. See manifest.update_manifest().
+
+        - Returns
+            A dict of the stats of each directory; {'wsi': ..., 'annots': ...}
+        '''
+        return {
+            'wsi': update_manifest(self.wsi_dir_out, num_workers=self.num_workers),
+            'annots': update_manifest(self.annots_dir_out, num_workers=self.num_workers),
+        }
+
+    def verify(self, full: bool = False) -> dict:
+        '''Verify the wsi and the annotation archives against the manifests.
+
+        Files whose size and modification time are unchanged are not read unless full is True;
+        see manifest.verify_manifest(). Raises FileNotFoundError if a directory has no manifest.
+
+        - Args
+            full: Hash every file
+
+        - Returns
+            A dict of the stats of each directory; {'wsi': ..., 'annots': ...}
+        '''
+        return {
+            'wsi': verify_manifest(self.wsi_dir_out, num_workers=self.num_workers, full=full),
+            'annots': verify_manifest(self.annots_dir_out, num_workers=self.num_workers, full=full),
+        }
 
 
 if __name__ == '__main__':
@@ -228,3 +269,4 @@ if __name__ == '__main__':
     downloader.split_train_valid(ratio=0.2)
 
     downloader.download_testset()
+    downloader.update_manifests()
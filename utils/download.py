@@ -0,0 +1,220 @@
+# Standard Libs
+import ftplib
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote, urlparse
+
+PART_EXT = '.part' # suffix of a file being downloaded; renamed once its size matches the server
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 60 # seconds to wait for the server before a transfer is retried
+
+
+def open_ftp(url: str, timeout: float = TIMEOUT) -> tuple:
+    '''Connect to the ftp server of the url in binary mode.
+
+    - Args
+        url: ftp url; ftp://[user[:password]@]host[:port]/path
+        timeout: Seconds to wait for the server
+
+    - Returns
+        A tuple of (ftplib.FTP, path on the server)
+    '''
+    parsed = urlparse(url)
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(parsed.hostname, parsed.port or 21)
+    ftp.login(unquote(parsed.username or 'anonymous'), unquote(parsed.password or ''))
+    ftp.voidcmd('TYPE I') # SIZE and REST count bytes in binary mode
+
+    return ftp, unquote(parsed.path)
+
+
+def remote_size(url: str, timeout: float = TIMEOUT) -> int:
+    '''Return the size of the file on the server in bytes; None if the server does not tell.'''
+    if urlparse(url).scheme == 'ftp':
+        ftp, path = open_ftp(url, timeout)
+        try:
+            return ftp.size(path)
+        finally:
+            ftp.close()
+
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        content_length = response.headers.get('Content-Length')
+
+    return int(content_length) if content_length is not None else None
+
+
+def probe_size(url: str, timeout: float = TIMEOUT) -> int:
+    '''Return the size of the file on the server; None if the server does not tell or rejects the request.
+
+    Some servers reject HEAD or SIZE but serve the file; the size is then taken from the transfer.
+    '''
+    try:
+        return remote_size(url, timeout)
+    except (OSError, EOFError, ftplib.Error) as e:
+        print(f'{url}: size is unknown ({e})')
+        return None
+
+
+def fetch(url: str, part_path: str, offset: int = 0, timeout: float = TIMEOUT,
+          chunk_size: int = CHUNK_SIZE) -> int:
+    '''Append the file on the server from the byte offset to the partial file.
+
+    ftp resumes with REST, http with a Range request; the partial file is truncated and written from
+    the start if the http server ignores the range.
+
+    - Args
+        url: ftp or http(s) url of the file
+        part_path: Path to the partial file; offset bytes of it are kept
+        offset: Number of bytes already downloaded
+        timeout: Seconds to wait for the server
+        chunk_size: Bytes read from the server at once
+
+    - Returns
+        Size of the whole file told by the http server(Content-Range or Content-Length); None if unknown
+    '''
+    if urlparse(url).scheme == 'ftp':
+        ftp, path = open_ftp(url, timeout)
+        try:
+            with open(part_path, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                ftp.retrbinary(f'RETR {path}', f.write, blocksize=chunk_size, rest=offset or None)
+        finally:
+            ftp.close()
+        return None
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', f'bytes={offset}-')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if response.status != 206:
+            offset = 0 # the server sends the whole file
+        # bytes {first}-{last}/{size} of a range, the length of the rest otherwise
+        content_range = response.headers.get('Content-Range', '')
+        content_length = response.headers.get('Content-Length')
+        if '/' in content_range and not content_range.endswith('/*'):
+            size = int(content_range.rsplit('/', 1)[1])
+        elif content_length is not None:
+            size = offset + int(content_length)
+        else:
+            size = None
+        with open(part_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+    return size
+
+
+def download_file(url: str, path_out: str, size: int = None, max_retries: int = 5, retry_wait: float = 10.0,
+                  timeout: float = TIMEOUT) -> bool:
+    '''Download a file into {path_out}.part, resuming it, and rename it once its size matches the server.
+
+    - Args
+        url: ftp or http(s) url of the file
+        path_out: Path to save the file
+        size: Size of the file in bytes; asked to the server if None, taken from the transfer if it does not tell
+        max_retries: Number of retries of a failed or incomplete transfer; each resumes from the partial file
+        retry_wait: Seconds to wait before the first retry; doubled at every retry
+        timeout: Seconds to wait for the server
+
+    - Returns
+        True if the file was downloaded, False if it was already complete
+    '''
+    part_path = f'{path_out}{PART_EXT}'
+    if size is None:
+        size = probe_size(url, timeout)
+    for retry in range(max_retries + 1):
+        try:
+            # A complete file is only trusted if the server size is unknown or the same
+            if os.path.exists(path_out) and (size is None or os.path.getsize(path_out) == size):
+                return False
+
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if size is not None and offset > size:
+                offset = 0 # not a prefix of the file on the server
+            if size is None or offset < size:
+                fetched_size = fetch(url, part_path, offset, timeout)
+                size = size if size is not None else fetched_size
+
+            part_size = os.path.getsize(part_path)
+            if size is not None and part_size != size:
+                raise OSError(f'{url}: {part_size} of {size} bytes are downloaded')
+            os.replace(part_path, path_out)
+
+            return True
+        except (OSError, EOFError, ftplib.Error) as e:
+            # Missing files and denied transfers(GET/RETR) are not retried
+            permanent = isinstance(e, ftplib.error_perm) or \
+                (isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500 and e.code not in (408, 429))
+            if permanent or retry == max_retries:
+                raise
+            wait = retry_wait * 2 ** retry
+            print(f'{url}: {e}; retry {retry + 1}/{max_retries} in {wait:.0f}s')
+            time.sleep(wait)
+
+
+def download_files(jobs: list, num_workers: int = 4, max_retries: int = 5, retry_wait: float = 10.0,
+                   timeout: float = TIMEOUT) -> dict:
+    '''Download the files with concurrent transfers; see download_file().
+
+    A failed file does not stop the others; the failures are reported at the end.
+
+    - Args
+        jobs: A list of tuples; (url, path to save the file)
+        num_workers: Number of concurrent transfers
+        max_retries: Number of retries of a file
+        retry_wait: Seconds to wait before the first retry of a file; doubled at every retry
+        timeout: Seconds to wait for the server
+
+    - Returns
+        A dict of the number of downloaded, skipped and failed files, the urls failed, the downloaded bytes,
+        the elapsed seconds and the throughput in MB/s
+    '''
+    start_time = time.perf_counter()
+    lock = threading.Lock()
+    stats = {'num_downloaded': 0, 'num_skipped': 0, 'num_failed': 0, 'failed_urls': [], 'bytes': 0}
+
+    def run(job: tuple) -> None:
+        url, path_out = job
+        os.makedirs(os.path.dirname(os.path.abspath(path_out)), exist_ok=True)
+        try:
+            downloaded = download_file(url, path_out, max_retries=max_retries,
+                                       retry_wait=retry_wait, timeout=timeout)
+        except Exception as e:
+            with lock:
+                stats['num_failed'] += 1
+                stats['failed_urls'].append(url)
+            print(f'Failed to download {url}: {e}')
+            return
+
+        with lock:
+            if downloaded:
+                stats['num_downloaded'] += 1
+                stats['bytes'] += os.path.getsize(path_out)
+            else:
+                stats['num_skipped'] += 1
+            num_done = stats['num_downloaded'] + stats['num_skipped'] + stats['num_failed']
+        if downloaded:
+            print(f'{num_done}/{len(jobs)} Downloaded {os.path.basename(path_out)}')
+
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        for future in as_completed([executor.submit(run, job) for job in jobs]):
+            future.result()
+
+    elapsed = time.perf_counter() - start_time
+    stats['seconds'] = elapsed
+    stats['mb_per_sec'] = stats['bytes'] / 2 ** 20 / elapsed if elapsed > 0 else 0.0
+    print(f'Downloaded {stats["num_downloaded"]} files({stats["mb_per_sec"]:.1f}MB/s), '
+          f'{stats["num_skipped"]} complete, {stats["num_failed"]} failed')
+
+    return stats
@@ -0,0 +1,391 @@
+# Standard Libs
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Third-party Libs
+import numpy as np
+from PIL import Image
+
+# Custom Libs
+from patch_list import PatchList, patch_fname
+from shards import create_shard, list_shards, shard_fname, write_shards_index
+from storage import read_header
+from slide import SlidePool
+
+# Names of the png patches already saved, appended after each task; shards are indexed by their headers
+PROGRESS_FNAME = 'patches_done.txt'
+
+# Slides kept open by the current worker process; created by _init_worker()
+_worker_slide_pool = None
+
+
+def parse_patch_fname(patch_fname: str) -> tuple:
+    '''Parse a patch name; (patient_id,center_x,center_y).
+
+    - Args
+        patch_fname: Name of the patch without extension
+
+    - Returns
+        A tuple of (patient_id, center_x, center_y)
+    '''
+    patient_id, center_x, center_y = patch_fname.strip('\n').split(',')
+
+    return patient_id, int(center_x), int(center_y)
+
+
+def plan_extraction(patch_list: PatchList, wsi_paths: dict, patch_size: int = 300,
+                    tile_size: int = 512, chunk_size: int = 256) -> list:
+    '''Partition patches by slide and sort them by tile locality.
+
+    - Args
+        patch_list: Patches to extract
+        wsi_paths: A dict mapping patient id to the path of its wsi
+        patch_size: Size of the patch
+        tile_size: Size of the tiles stored in the wsi
+        chunk_size: Maximum number of patches in a task
+
+    - Returns
+        A list of tasks; (wsi_path, patient_id, center coordinates of shape (n, 2)),
+        tasks of the same slide are adjacent
+    '''
+    rows = patch_list.rows()
+    # Top left coordinate of patch
+    start_x = rows[:, 1] - (patch_size // 2)
+    start_y = rows[:, 2] - (patch_size // 2)
+    # Patches sharing the same tiles are read one after another; the last key is the primary one
+    order = np.lexsort((start_x, start_y, start_x // tile_size, start_y // tile_size, rows[:, 0]))
+    rows = rows[order]
+
+    tasks = []
+    slide_indices, slide_starts = np.unique(rows[:, 0], return_index=True)
+    slide_ends = np.append(slide_starts[1:], len(rows))
+    for (slide_index, slide_start, slide_end) in zip(slide_indices, slide_starts, slide_ends):
+        patient_id = patch_list.slide_names[slide_index]
+        wsi_path = wsi_paths[patient_id]
+        for start in range(slide_start, slide_end, chunk_size):
+            coords = rows[start:min(start + chunk_size, slide_end), 1:].astype(np.int32)
+            tasks.append((wsi_path, patient_id, coords))
+
+    return tasks
+
+
+def task_fnames(patient_id: str, coords: np.ndarray) -> list:
+    '''Return the names of the patches of a task.'''
+    return [patch_fname(patient_id, center_x, center_y) for (center_x, center_y) in coords.tolist()]
+
+
+def segments_fnames(segments: list) -> list:
+    '''Return the names of the patches of a list of tasks, in order.'''
+    return [fname for (_, patient_id, coords) in segments for fname in task_fnames(patient_id, coords)]
+
+
+def plan_shards(tasks: list, shard_size: int = 4096) -> list:
+    '''Pack the tasks of plan_extraction() into shards of shard_size patches; only the last one may be smaller.
+
+    The tail of a slide is packed with the patches of the next slides, so every shard has the same size.
+
+    - Args
+        tasks: Tasks made by plan_extraction()
+        shard_size: Number of patches in a shard
+
+    - Returns
+        A list of shards; lists of tasks (wsi_path, patient_id, coords) whose patches fill the shard in order
+    '''
+    assert shard_size > 0, f'Invalid shard size: {shard_size}'
+
+    shards = [[]]
+    num_filled = 0
+    for (wsi_path, patient_id, coords) in tasks:
+        start = 0
+        while start < len(coords):
+            if num_filled == shard_size:
+                shards.append([])
+                num_filled = 0
+            end = min(start + shard_size - num_filled, len(coords))
+            shards[-1].append((wsi_path, patient_id, coords[start:end]))
+            num_filled += end - start
+            start = end
+
+    return shards if shards[0] else []
+
+
+def plan_regions(coords: np.ndarray, patch_size: int = 300, max_region_size: int = 2048,
+                 min_coverage: float = 0.25) -> list:
+    '''Cluster nearby patches into regions read at once.
+
+    Patches are binned into square cells so that the bounding box of a cell never exceeds max_region_size.
+    A cell whose patches cover less than min_coverage of its bounding box is read patch by patch.
+
+    - Args
+        coords: Center coordinates of the patches of shape (n, 2)
+        patch_size: Size of the patch
+        max_region_size: Maximum width/height of a region; every patch is read alone if <= patch_size
+        min_coverage: Minimum ratio of the patch area to the region area to read a region
+
+    - Returns
+        A list of regions; ((start_x, start_y, width, height), indices of the patches in the region)
+    '''
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    # Top left coordinates of patches
+    starts = coords - (patch_size // 2)
+
+    cell_size = max_region_size - patch_size
+    if cell_size <= 0:
+        return [((x, y, patch_size, patch_size), [i]) for (i, (x, y)) in enumerate(starts.tolist())]
+
+    cells = starts // cell_size
+    _, cell_ids = np.unique(cells, axis=0, return_inverse=True)
+    cell_ids = cell_ids.reshape(-1)
+
+    regions = []
+    # Cells in the order of their first patch, so that the tile order of the plan is kept
+    _, first_indices = np.unique(cell_ids, return_index=True)
+    for cell_id in cell_ids[np.sort(first_indices)]:
+        indices = np.flatnonzero(cell_ids == cell_id)
+        cell_starts = starts[indices]
+        start_x, start_y = cell_starts.min(axis=0)
+        end_x, end_y = cell_starts.max(axis=0) + patch_size
+        width, height = int(end_x - start_x), int(end_y - start_y)
+
+        coverage = len(indices) * patch_size * patch_size / (width * height)
+        if (len(indices) > 1) and (coverage >= min_coverage):
+            regions.append(((int(start_x), int(start_y), width, height), indices.tolist()))
+        else:
+            for i in indices.tolist():
+                x, y = starts[i].tolist()
+                regions.append(((x, y, patch_size, patch_size), [i]))
+
+    return regions
+
+
+def read_patches(slide, coords: np.ndarray, wsi_level: int = 0, patch_size: int = 300,
+                 max_region_size: int = 2048):
+    '''Read patches from an opened wsi; nearby patches are cut out of one larger region.
+
+    - Args
+        slide: Opened wsi
+        coords: Center coordinates of the patches of shape (n, 2)
+        wsi_level: Level of the wsi
+        patch_size: Size of the patch
+        max_region_size: Maximum width/height of a region read at once
+
+    - Returns
+        A generator of tuples; (index of the patch in coords, RGB uint8 array of (patch_size, patch_size, 3)),
+        patches of a region are views of the region
+    '''
+    # Locations are level 0 coordinates, so regions can be sliced only at a level without downsampling
+    if slide.level_downsamples[wsi_level] != 1:
+        max_region_size = 0
+
+    regions = plan_regions(coords, patch_size, max_region_size)
+    for ((start_x, start_y, width, height), indices) in regions:
+        region = slide.read_region(location=(start_x, start_y),
+                                   level=wsi_level,
+                                   size=(width, height))
+        region = np.asarray(region.convert('RGB'))
+
+        for i in indices:
+            offset_x = int(coords[i][0]) - (patch_size // 2) - start_x
+            offset_y = int(coords[i][1]) - (patch_size // 2) - start_y
+            yield i, region[offset_y:offset_y + patch_size, offset_x:offset_x + patch_size]
+
+
+def extract_patches(slide_pool: SlidePool, segments: list, patches_dir_out: str, wsi_level: int = 0,
+                    patch_size: int = 300, max_region_size: int = 2048) -> int:
+    '''Read patches from wsi and save them as png images.
+
+    - Args
+        slide_pool: Pool of opened slides
+        segments: Tasks of plan_extraction(); (wsi_path, patient_id, center coordinates of shape (n, 2))
+        patches_dir_out: Path to the directory to save the patches
+        wsi_level: Level of the wsi
+        patch_size: Size of the patch
+        max_region_size: Maximum width/height of a region read at once
+
+    - Returns
+        The number of saved patches
+    '''
+    num_saved = 0
+    for (wsi_path, patient_id, coords) in segments:
+        slide = slide_pool.get(wsi_path)
+        fnames = task_fnames(patient_id, coords)
+        for (i, patch) in read_patches(slide, coords, wsi_level, patch_size, max_region_size):
+            patch_path = os.path.join(patches_dir_out, f'{fnames[i]}.png')
+            Image.fromarray(patch).save(patch_path)
+        num_saved += len(coords)
+
+    return num_saved
+
+
+def extract_shard(slide_pool: SlidePool, segments: list, shard_path: str, wsi_level: int = 0,
+                  patch_size: int = 300, max_region_size: int = 2048) -> int:
+    '''Read patches from wsi and save them together as a shard.
+
+    Patches are written into the memory-mapped shard as they are read, so a shard is never held in memory.
+
+    - Args
+        slide_pool: Pool of opened slides
+        segments: Tasks of plan_extraction() filling the shard in order; see plan_shards()
+        shard_path: Path to save the shard
+        wsi_level: Level of the wsi
+        patch_size: Size of the patch
+        max_region_size: Maximum width/height of a region read at once
+
+    - Returns
+        The number of saved patches
+    '''
+    patch_fnames = segments_fnames(segments)
+    tmp_path = f'{shard_path}.tmp'
+    shard = create_shard(tmp_path, patch_fnames, patch_size)
+
+    offset = 0
+    for (wsi_path, _, coords) in segments:
+        slide = slide_pool.get(wsi_path)
+        for (i, patch) in read_patches(slide, coords, wsi_level, patch_size, max_region_size):
+            shard[offset + i] = patch
+        offset += len(coords)
+
+    shard.flush()
+    del shard
+    os.replace(tmp_path, shard_path)
+
+    return len(patch_fnames)
+
+
+# Output format -> function saving the patches of a task
+EXTRACTORS = {
+    'png': extract_patches,
+    'shard': extract_shard,
+}
+
+
+def task_path_out(patches_dir_out: str, task_index: int, output_format: str = 'png') -> str:
+    '''Return where a task saves its patches; the directory for png, a shard file for shard.'''
+    if output_format == 'shard':
+        return os.path.join(patches_dir_out, shard_fname(task_index))
+
+    return patches_dir_out
+
+
+def load_progress(patches_dir_out: str, output_format: str = 'png') -> set:
+    '''Return the names of the patches already saved in the directory.
+
+    - Args
+        patches_dir_out: Path to the directory of the saved patches
+        output_format: 'png' or 'shard'
+
+    - Returns
+        A set of patch names; (patient_id,center_x,center_y)
+    '''
+    done_patch_fnames = set()
+    if not os.path.isdir(patches_dir_out):
+        return done_patch_fnames
+
+    # Shards are saved atomically, so every shard on the disk is complete
+    if output_format == 'shard':
+        for fname in list_shards(patches_dir_out):
+            header_dict, _ = read_header(os.path.join(patches_dir_out, fname))
+            done_patch_fnames.update(header_dict['patch_fnames'])
+
+        return done_patch_fnames
+
+    progress_path = os.path.join(patches_dir_out, PROGRESS_FNAME)
+    if os.path.exists(progress_path):
+        with open(progress_path, 'r', encoding='utf-8') as f:
+            done_patch_fnames.update(line.strip('\n') for line in f if line.strip())
+
+    return done_patch_fnames
+
+
+def _checkpoint(progress_path: str, patch_fnames: list) -> None:
+    '''Append the names of the saved patches to the progress file.'''
+    if progress_path is None:
+        return
+
+    with open(progress_path, 'a', encoding='utf-8') as f:
+        f.writelines(f'{fname}\n' for fname in patch_fnames)
+
+
+def _init_worker(max_open_slides: int) -> None:
+    '''Create the slide pool of a worker process.'''
+    global _worker_slide_pool
+    _worker_slide_pool = SlidePool(max_open=max_open_slides)
+
+
+def _run_task(task: tuple) -> int:
+    '''Extract the patches of a task in a worker process.'''
+    output_format, segments, path_out, wsi_level, patch_size, max_region_size = task
+    extractor = EXTRACTORS[output_format]
+
+    return extractor(_worker_slide_pool, segments, path_out, wsi_level, patch_size, max_region_size)
+
+
+def run_extraction(tasks: list, patches_dir_out: str, wsi_level: int = 0, patch_size: int = 300,
+                   num_workers: int = 1, slide_pool: SlidePool = None, max_open_slides: int = 4,
+                   output_format: str = 'png', first_task_index: int = 0, resume: bool = False,
+                   max_region_size: int = 2048, shard_size: int = 4096) -> int:
+    '''Extract the planned patches serially or over a process pool.
+
+    - Args
+        tasks: Tasks made by plan_extraction()
+        patches_dir_out: Path to the directory to save the patches
+        wsi_level: Level of the wsi
+        patch_size: Size of the patch
+        num_workers: Number of worker processes; extract in this process if 1
+        slide_pool: Pool of opened slides used when num_workers is 1
+        max_open_slides: Maximum number of slides kept open by each worker process
+        output_format: 'png' to save each patch as an image, 'shard' to pack the tasks into shards
+        first_task_index: Index of the first shard; shards are numbered from it
+        resume: Keep the progress of the previous runs if True, start a new progress file otherwise
+        max_region_size: Maximum width/height of a region read at once; bounds the memory of a read
+        shard_size: Number of patches in a shard; only the last shard may be smaller, see plan_shards()
+
+    - Returns
+        The number of saved patches
+    '''
+    assert output_format in EXTRACTORS, f'Unknown output format: {output_format}'
+
+    num_total = sum(len(coords) for (_, _, coords) in tasks)
+    num_done = 0
+
+    # Patches saved together; a shard, or a task of png patches
+    if output_format == 'shard':
+        units = plan_shards(tasks, shard_size)
+    else:
+        units = [[task] for task in tasks]
+
+    # Saved png patches are checkpointed after each task
+    progress_path = None
+    if output_format == 'png':
+        progress_path = os.path.join(patches_dir_out, PROGRESS_FNAME)
+        if (not resume) and os.path.exists(progress_path):
+            os.remove(progress_path)
+
+    if num_workers <= 1:
+        if slide_pool is None:
+            slide_pool = SlidePool(max_open=max_open_slides)
+
+        extractor = EXTRACTORS[output_format]
+        for (task_index, segments) in enumerate(units, first_task_index):
+            path_out = task_path_out(patches_dir_out, task_index, output_format)
+            num_done += extractor(slide_pool, segments, path_out, wsi_level, patch_size, max_region_size)
+            _checkpoint(progress_path, segments_fnames(segments))
+            print(f'{num_done}/{num_total} patches are saved in {patches_dir_out}')
+    else:
+        worker_tasks = [(output_format, segments, task_path_out(patches_dir_out, task_index, output_format),
+                         wsi_level, patch_size, max_region_size)
+                        for (task_index, segments) in enumerate(units, first_task_index)]
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 initializer=_init_worker,
+                                 initargs=(max_open_slides,)) as executor:
+            futures = {executor.submit(_run_task, task): task for task in worker_tasks}
+            for future in as_completed(futures):
+                num_done += future.result()
+                _, segments, *_ = futures[future]
+                _checkpoint(progress_path, segments_fnames(segments))
+                print(f'{num_done}/{num_total} patches are saved in {patches_dir_out}')
+
+    if output_format == 'shard':
+        write_shards_index(patches_dir_out)
+
+    return num_done
@@ -0,0 +1,95 @@
+'''Measure the import time of the modules and check that they do not import heavy dependencies.
+
+Every worker process pays the import of the modules it uses; run this after adding an import:
+    python import_benchmark.py [--repeat 5] [--max-ms 500]
+Exits with 1 if a module imports a forbidden dependency or takes longer than --max-ms.
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Imported by the commands which need them, never at import time
+HEAVY_MODULES = ('matplotlib', 'skimage', 'scipy', 'wget', 'torch', 'torchvision')
+
+# module -> modules it must not import
+FORBIDDEN_IMPORTS = {
+    'cli': HEAVY_MODULES + ('numpy', 'openslide', 'PIL'),
+    'storage': HEAVY_MODULES,
+    'coords': HEAVY_MODULES,
+    'patch_list': HEAVY_MODULES,
+    'shards': HEAVY_MODULES,
+    'packed_mask': HEAVY_MODULES,
+    'tissue': HEAVY_MODULES,
+    'tissue_index': HEAVY_MODULES,
+    'annotation': HEAVY_MODULES,
+    'mask': HEAVY_MODULES + ('openslide',),
+    'slide': HEAVY_MODULES,
+    'extraction': HEAVY_MODULES,
+    'sampling': HEAVY_MODULES,
+    'download': HEAVY_MODULES + ('numpy',),
+    'dataset': HEAVY_MODULES + ('numpy',),
+    'manifest': HEAVY_MODULES + ('numpy',),
+    'split': HEAVY_MODULES + ('numpy',),
+}
+
+
+def measure_import(module: str) -> tuple:
+    '''Import the module in a fresh interpreter.
+
+    - Args
+        module: Name of the module in this directory
+
+    - Returns
+        A tuple of (cumulative import time in ms, names of the top-level modules imported with it)
+    '''
+    code = f'import sys; import {module}; print(" ".join(sorted(name for name in sys.modules if "." not in name)))'
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                      env.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, env=env, check=True)
+
+    # Lines of -X importtime; "import time: self [us] | cumulative | imported package"
+    import_us = 0
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            import_us = int(fields[1])
+
+    return import_us / 1000, set(result.stdout.split())
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Measure the import time of the modules.')
+    parser.add_argument('modules', nargs='*', default=sorted(FORBIDDEN_IMPORTS),
+                        help='modules to measure; every module with an import budget if none')
+    parser.add_argument('--repeat', type=int, default=5, help='number of imports of each module; the median is reported')
+    parser.add_argument('--max-ms', type=float, default=None, help='fail if a module takes longer to import')
+    args = parser.parse_args(argv)
+
+    num_failures = 0
+    for module in args.modules:
+        import_times = []
+        for _ in range(args.repeat):
+            import_ms, imported_modules = measure_import(module)
+            import_times.append(import_ms)
+        import_ms = statistics.median(import_times)
+
+        forbidden = sorted(imported_modules & set(FORBIDDEN_IMPORTS.get(module, HEAVY_MODULES)))
+        too_slow = (args.max_ms is not None) and (import_ms > args.max_ms)
+        status = 'ok'
+        if forbidden:
+            status = f'imports {", ".join(forbidden)}'
+        elif too_slow:
+            status = f'slower than {args.max_ms:.0f}ms'
+        num_failures += int(bool(forbidden) or too_slow)
+
+        print(f'{module:<14} {import_ms:8.1f}ms  {status}')
+
+    return 1 if num_failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# Standard Libs
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom Libs
+from split import SPLITS_DIRNAME
+
+MANIFEST_FNAME = 'manifest.json'
+MANIFEST_VERSION = 1
+MANIFEST_EXTS = ('.tif', '.zip') # files tracked by the manifests; slides and annotation archives
+HASH_ALGORITHM = 'sha256'
+BUFFER_SIZE = 8 << 20 # bytes read at once; hashlib releases the GIL on large updates, so threads hash in parallel
+
+
+def hash_file(path: str, algorithm: str = HASH_ALGORITHM, buffer_size: int = BUFFER_SIZE) -> str:
+    '''Hash the content of a file with large reads into a reused buffer.'''
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            num_bytes = f.readinto(buffer)
+            if not num_bytes:
+                break
+            digest.update(view[:num_bytes])
+
+    return digest.hexdigest()
+
+
+def file_entry(path: str) -> dict:
+    '''Return the size and the modification time of a file; the content hash is added by hashing it.'''
+    stat = os.stat(path)
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def file_entry_matches(entry: dict, current: dict) -> bool:
+    '''Check whether a file has the size and the modification time recorded in the manifest.'''
+    return entry['size'] == current['size'] and entry['mtime_ns'] == current['mtime_ns']
+
+
+def list_files(root_dir: str, exts: tuple = MANIFEST_EXTS) -> list:
+    '''List the files of the extensions under the directory; sorted paths relative to it.
+
+    Links of the materialized splits({root_dir}/splits) are not content of the directory and are skipped.
+    '''
+    rel_paths = []
+    for (dir_path, dir_names, fnames) in os.walk(root_dir):
+        if os.path.samefile(dir_path, root_dir) and SPLITS_DIRNAME in dir_names:
+            dir_names.remove(SPLITS_DIRNAME)
+        for fname in fnames:
+            if os.path.splitext(fname)[1] in exts:
+                rel_paths.append(os.path.relpath(os.path.join(dir_path, fname), root_dir))
+
+    return sorted(rel_paths)
+
+
+def load_manifest(root_dir: str) -> dict:
+    '''Load the manifest of the directory; relative path -> {size, mtime_ns, sha256}, empty if there is none.'''
+    manifest_path = os.path.join(root_dir, MANIFEST_FNAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    assert manifest.get('version') == MANIFEST_VERSION, f'Unsupported manifest version: {manifest.get("version")}'
+
+    return manifest['files']
+
+
+def save_manifest(root_dir: str, files: dict) -> None:
+    '''Save the manifest of the directory; the file is replaced atomically.'''
+    manifest_path = os.path.join(root_dir, MANIFEST_FNAME)
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': MANIFEST_VERSION, 'algorithm': HASH_ALGORITHM, 'files': files},
+                  f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def hash_files(root_dir: str, rel_paths: list, num_workers: int = 8) -> dict:
+    '''Hash the files over a thread pool.
+
+    - Args
+        root_dir: Path to the directory of the files
+        rel_paths: Paths to the files relative to root_dir
+        num_workers: Number of concurrent reads
+
+    - Returns
+        A dict; relative path -> {size, mtime_ns, sha256}
+    '''
+    def run(rel_path: str) -> tuple:
+        path = os.path.join(root_dir, rel_path)
+        entry = file_entry(path)
+        entry[HASH_ALGORITHM] = hash_file(path)
+
+        return rel_path, entry
+
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        return dict(executor.map(run, rel_paths))
+
+
+def update_manifest(root_dir: str, num_workers: int = 8) -> dict:
+    '''Add the files of the directory to its manifest; only new or changed files are hashed.
+
+    Files moved inside the directory, e.g. by the older Camelyon16.split_train_valid(), keep their hash if
+    their name, size and modification time are the same. Changed files are recorded with their new hash, so
+    verify_manifest() first if they may be corrupt.
+
+    - Args
+        root_dir: Path to the directory of the files; the manifest is saved in it
+        num_workers: Number of concurrent reads
+
+    - Returns
+        A dict of the number of tracked and hashed files, the hashed bytes and the elapsed seconds
+    '''
+    start_time = time.perf_counter()
+    previous = load_manifest(root_dir)
+    # (name, size, mtime) -> entry of the files which may have been moved
+    moved = {(os.path.basename(rel_path), entry['size'], entry['mtime_ns']): entry
+             for (rel_path, entry) in previous.items()}
+
+    files = {}
+    to_hash = []
+    for rel_path in list_files(root_dir):
+        entry = file_entry(os.path.join(root_dir, rel_path))
+        key = (os.path.basename(rel_path), entry['size'], entry['mtime_ns'])
+        if rel_path in previous and file_entry_matches(previous[rel_path], entry):
+            files[rel_path] = previous[rel_path]
+        elif key in moved:
+            files[rel_path] = moved[key]
+        else:
+            to_hash.append(rel_path)
+
+    hashed = hash_files(root_dir, to_hash, num_workers)
+    files.update(hashed)
+    save_manifest(root_dir, files)
+
+    stats = {
+        'num_files': len(files),
+        'num_hashed': len(hashed),
+        'bytes_hashed': sum(entry['size'] for entry in hashed.values()),
+        'seconds': time.perf_counter() - start_time,
+    }
+    print(f'{root_dir}: {stats["num_files"]} files in the manifest, {stats["num_hashed"]} hashed '
+          f'({stats["bytes_hashed"] / 2 ** 30:.2f}GB in {stats["seconds"]:.1f}s)')
+
+    return stats
+
+
+def verify_manifest(root_dir: str, num_workers: int = 8, full: bool = False) -> dict:
+    '''Verify the files of the directory against its manifest.
+
+    Files whose size and modification time are unchanged are not read unless full is True; the others
+    are hashed again. A file with the recorded hash but a new modification time is recorded again.
+    A directory without manifest is an error rather than a directory of untracked files.
+
+    - Args
+        root_dir: Path to the directory of the files and the manifest
+        num_workers: Number of concurrent reads
+        full: Hash every file
+
+    - Returns
+        A dict of the relative paths of the missing, corrupt(content differs from the manifest) and untracked
+        files, the number of verified and hashed files, the hashed bytes and the elapsed seconds
+    '''
+    start_time = time.perf_counter()
+    manifest_path = os.path.join(root_dir, MANIFEST_FNAME)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f'No manifest to verify: {manifest_path}; see update_manifest()')
+
+    manifest = load_manifest(root_dir)
+    rel_paths = set(list_files(root_dir))
+
+    missing = sorted(rel_path for rel_path in manifest if rel_path not in rel_paths)
+    untracked = sorted(rel_path for rel_path in rel_paths if rel_path not in manifest)
+    to_hash = []
+    for rel_path in sorted(rel_paths & set(manifest)):
+        entry = file_entry(os.path.join(root_dir, rel_path))
+        if full or not file_entry_matches(manifest[rel_path], entry):
+            to_hash.append(rel_path)
+
+    hashed = hash_files(root_dir, to_hash, num_workers)
+    corrupt = sorted(rel_path for (rel_path, entry) in hashed.items()
+                     if entry[HASH_ALGORITHM] != manifest[rel_path][HASH_ALGORITHM])
+
+    # Touched but intact files are not hashed again by the next verification
+    touched = [rel_path for rel_path in hashed
+               if rel_path not in corrupt and not file_entry_matches(manifest[rel_path], hashed[rel_path])]
+    if touched:
+        for rel_path in touched:
+            manifest[rel_path] = hashed[rel_path]
+        save_manifest(root_dir, manifest)
+
+    stats = {
+        'missing': missing,
+        'corrupt': corrupt,
+        'untracked': untracked,
+        'num_verified': len(rel_paths & set(manifest)) - len(corrupt),
+        'num_hashed': len(hashed),
+        'bytes_hashed': sum(entry['size'] for entry in hashed.values()),
+        'seconds': time.perf_counter() - start_time,
+    }
+    print(f'{root_dir}: {stats["num_verified"]} files verified, {len(missing)} missing, {len(corrupt)} corrupt, '
+          f'{len(untracked)} untracked; {stats["num_hashed"]} hashed '
+          f'({stats["bytes_hashed"] / 2 ** 30:.2f}GB in {stats["seconds"]:.1f}s)')
+
+    return stats
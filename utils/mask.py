@@ -1,27 +1,54 @@
+import argparse
+import json
 import logging
 import ntpath
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import matplotlib.pyplot as plt
 import numpy as np
-import skimage.filters
-from openslide import OpenSlide
-from skimage.color import rgb2hsv
+from PIL import Image, ImageDraw
 
+from annotation import LesionAnnotations, annotation_path
+from coords import source_fingerprint
+from packed_mask import (PACKED_MASK_EXT, ROWS_PER_CHUNK, PackedMask, create_packed_mask, open_mask,
+                         save_packed_mask)
+from patch_list import PatchList
+from split import SPLITS_DIRNAME, load_split
+from tissue import TissueHistograms, tissue_mask
+from tissue_index import TissueIndex, build_tissue_index
 
-def generate_roi_mask(wsi_path_in: str, mask_path_out: str,
-                      wsi_level: int=6, min_rgb: int=50) -> None:
+MASKS_INDEX_FNAME = 'masks_index.json' # patient id -> fingerprint of the wsi and parameters of its mask
+MASK_EXTS = {'npy': '.npy', 'packed': PACKED_MASK_EXT} # output format -> extension of the mask file
+
+
+def generate_roi_mask(wsi_path_in: str, mask_path_out: str, wsi_level: int=6,
+                      min_rgb: int=50, tile_size: int=None, output_format: str='npy') -> None:
     '''Generate binary mask to extract roi(tissue region) from whole slide image.
 
     - Args
-        wsi_path_in:
-        wsi_level:
-        mask_path_out:
-        min_rgb:
+        wsi_path_in: Path to the wsi
+        mask_path_out: Path to save the mask; shape of (width, height)
+        wsi_level: Level of the wsi to generate the mask at
+        min_rgb: Minimum value of every channel of a tissue pixel
+        tile_size: Read the level tile by tile with bounded memory if given; see generate_roi_mask_tiled()
+        output_format: 'npy' to save with np.save(), 'packed' to save 1 bit per pixel; see packed_mask.py
 
     - Returns
         None
     '''
+    assert output_format in MASK_EXTS, f'Unknown output format: {output_format}'
+
+    if tile_size is not None:
+        generate_roi_mask_tiled(wsi_path_in=wsi_path_in,
+                                mask_path_out=mask_path_out,
+                                wsi_level=wsi_level,
+                                min_rgb=min_rgb,
+                                tile_size=tile_size,
+                                output_format=output_format)
+        return
+
+    from openslide import OpenSlide
 
     logging.basicConfig(level=logging.INFO)
 
@@ -36,153 +63,767 @@ def generate_roi_mask(wsi_path_in: str, mask_path_out: str,
                               size=(slide_width, slide_height))
 
     rgb_image = image.convert('RGB')
-    rgb_image = np.transpose(rgb_image, axes=[1, 0, 2]) # shape of (height, width, channels); transpose of (1)
+    rgb_image = np.transpose(rgb_image, axes=[1, 0, 2]) # shape of (width, height, channels); transpose of (1)
 
-    hsv_image = rgb2hsv(rgb_image)
+    # Otsu thresholds of r, g, b and saturation from histograms built in a single pass
+    tissue_histograms = TissueHistograms()
+    tissue_histograms.update(rgb_image)
 
-    r_channel = rgb_image[:, :, 0]
-    g_channel = rgb_image[:, :, 1]
-    b_channel = rgb_image[:, :, 2]
-    h_channel = hsv_image[:, :, 1]
+    # ROI: Tissue reion in the slide
+    roi_mask = tissue_mask(rgb_image, tissue_histograms.thresholds(), min_rgb)
 
-    r_threshold = skimage.filters.threshold_otsu(r_channel)
-    g_threshold = skimage.filters.threshold_otsu(g_channel)
-    b_threshold = skimage.filters.threshold_otsu(b_channel)
-    h_threshold = skimage.filters.threshold_otsu(h_channel)
+    if output_format == 'packed':
+        save_packed_mask(mask_path_out, roi_mask, wsi_level, slide.level_downsamples[wsi_level])
+    else:
+        np.save(mask_path_out, roi_mask)
 
-    r_channel_mask = r_channel > r_threshold
-    g_channel_mask = g_channel > g_threshold
-    b_channel_mask = b_channel > b_threshold
 
-    rgb_tissue_mask = r_channel_mask & b_channel_mask & g_channel_mask
-    rgb_tissue_mask = np.logical_not(rgb_tissue_mask)
+def iter_level_tiles(slide, wsi_level: int, tile_size: int):
+    '''Read a level of the wsi tile by tile.
 
-    h_tissue_mask = h_channel > h_threshold
+    - Args
+        slide: Opened wsi; OpenSlide
+        wsi_level: Level of the wsi to read
+        tile_size: Width/height of a tile in pixels of the level
 
-    min_r_mask = r_channel > min_rgb
-    min_g_mask = g_channel > min_rgb
-    min_b_mask = b_channel > min_rgb
+    - Returns
+        A generator of tuples; (x, y, RGB tile of shape (width, height, 3)) with (x, y) in pixels of the level
+    '''
+    level_width, level_height = slide.level_dimensions[wsi_level]
+    downsample = slide.level_downsamples[wsi_level]
 
-    # ROI: Tissue reion in the slide
-    roi_mask = h_tissue_mask & rgb_tissue_mask & min_r_mask & min_g_mask & min_b_mask
+    for y in range(0, level_height, tile_size):
+        for x in range(0, level_width, tile_size):
+            width = min(tile_size, level_width - x)
+            height = min(tile_size, level_height - y)
+            # read_region() takes the location in level 0
+            tile = slide.read_region(location=(round(x * downsample), round(y * downsample)),
+                                     level=wsi_level,
+                                     size=(width, height))
+            rgb_tile = np.transpose(tile.convert('RGB'), axes=[1, 0, 2])
+
+            yield x, y, rgb_tile
+
+
+def generate_roi_mask_tiled(wsi_path_in: str, mask_path_out: str, wsi_level: int=6,
+                            min_rgb: int=50, tile_size: int=2048, output_format: str='npy') -> None:
+    '''Generate the mask of generate_roi_mask() with memory independent of the size of the slide.
+
+    The level is read tile by tile twice;
+    (1) histograms of r, g, b and saturation for the Otsu thresholds
+    (2) thresholding, written tile by tile into the memory-mapped mask file
+
+    - Args
+        wsi_path_in: Path to the wsi
+        mask_path_out: Path to save the mask; shape of (width, height)
+        wsi_level: Level of the wsi to generate the mask at
+        min_rgb: Minimum value of every channel of a tissue pixel
+        tile_size: Width/height of a tile in pixels of the level
+        output_format: 'npy' to save with np.save(), 'packed' to save 1 bit per pixel; see packed_mask.py
+
+    - Returns
+        None
+    '''
+    from openslide import OpenSlide
+
+    assert output_format in MASK_EXTS, f'Unknown output format: {output_format}'
+
+    slide = OpenSlide(wsi_path_in)
+    level_width, level_height = slide.level_dimensions[wsi_level]
+
+    # (1) Histograms of r, g, b and saturation
+    tissue_histograms = TissueHistograms()
+    for (_, _, rgb_tile) in iter_level_tiles(slide, wsi_level, tile_size):
+        tissue_histograms.update(rgb_tile)
+    thresholds = tissue_histograms.thresholds()
+
+    # (2) Threshold every tile into the mask on disk
+    if output_format == 'packed':
+        # Tiles start at a multiple of 8 in y to be packed into whole bytes
+        tile_size = -(-tile_size // 8) * 8
+        tmp_path = f'{mask_path_out}.tmp'
+        roi_mask = create_packed_mask(tmp_path, (level_width, level_height),
+                                      wsi_level, slide.level_downsamples[wsi_level])
+    else:
+        if not mask_path_out.endswith('.npy'):
+            mask_path_out = f'{mask_path_out}.npy' # same as np.save()
+        tmp_path = f'{mask_path_out}.tmp'
+        roi_mask = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=bool,
+                                             shape=(level_width, level_height))
+    for (x, y, rgb_tile) in iter_level_tiles(slide, wsi_level, tile_size):
+        tile_width, tile_height, _ = rgb_tile.shape
+        if output_format == 'packed':
+            tile_mask = tissue_mask(rgb_tile, thresholds, min_rgb)
+            roi_mask[x:x + tile_width, y // 8:-(-(y + tile_height) // 8)] = np.packbits(tile_mask, axis=1)
+        else:
+            tissue_mask(rgb_tile, thresholds, min_rgb, out=roi_mask[x:x + tile_width, y:y + tile_height])
+    roi_mask.flush()
+    del roi_mask
+    os.replace(tmp_path, mask_path_out)
+
+    slide.close()
+
+
+def tissue_fractions(mask, points: np.ndarray, footprint: int,
+                     tissue_index: TissueIndex = None) -> np.ndarray:
+    '''Compute the fraction of tissue under the footprint centered at each point.
+
+    Pixels outside the mask count as background.
+
+    - Args
+        mask: Binary roi mask of shape (width, height) or a PackedMask
+        points: Center points in mask pixels of shape (n, 2); (x, y)
+        footprint: Width/height of the window in mask pixels
+        tissue_index: Index of the mask saved by build_tissue_index(); built in memory if None
+
+    - Returns
+        A float array of shape (n,) in [0, 1]
+    '''
+    if tissue_index is None:
+        tissue_index = TissueIndex.from_mask(mask, downsample=1.0)
 
-    np.save(mask_path_out, roi_mask)
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    footprint = max(int(footprint), 1)
+
+    # Windows in level 0 coordinates of the index
+    rects = np.empty((len(points), 4), dtype=np.float64)
+    rects[:, :2] = (points - (footprint // 2)) * tissue_index.downsample
+    rects[:, 2:] = footprint * tissue_index.downsample
+
+    return tissue_index.fractions(rects)
+
+
+def list_slides(wsi_dirs: list) -> list:
+    '''List the wsi under the directories, searched recursively.
+
+    - Args
+        wsi_dirs: Paths to the directories of wsi; e.g. train, valid and test, or the dataset root whose
+                  {wsi_dir}/splits links are skipped
+
+    - Returns
+        A sorted list of tuples; (patient_id, wsi_path)
+    '''
+    wsi_paths = {}
+    for wsi_dir in wsi_dirs:
+        for (dir_path, dir_names, fnames) in os.walk(wsi_dir):
+            # Links of the materialized splits would list every wsi again
+            if os.path.samefile(dir_path, wsi_dir) and SPLITS_DIRNAME in dir_names:
+                dir_names.remove(SPLITS_DIRNAME)
+            for fname in fnames:
+                patient_id, ext = os.path.splitext(fname)
+                if ext != '.tif':
+                    continue
+                if patient_id in wsi_paths:
+                    raise ValueError(f'Duplicated patient id {patient_id}: '
+                                     f'{wsi_paths[patient_id]}, {os.path.join(dir_path, fname)}')
+                wsi_paths[patient_id] = os.path.join(dir_path, fname)
+
+    return sorted(wsi_paths.items())
+
+
+def select_slides(wsi_dirs: list, split_path: str = None, subsets: list = None) -> list:
+    '''List the wsi under the directories and of a split manifest.
+
+    - Args
+        wsi_dirs: Paths to the directories of wsi, searched recursively; e.g. test
+        split_path: Path to a split manifest; see split.py
+        subsets: Subsets of the split manifest; every subset if None
+
+    - Returns
+        A sorted list of tuples; (patient_id, wsi_path)
+    '''
+    wsi_paths = dict(list_slides(wsi_dirs or []))
+    if split_path is not None:
+        for (patient_id, (_, wsi_path)) in load_split(split_path, subsets).items():
+            if os.path.abspath(wsi_paths.get(patient_id, wsi_path)) != os.path.abspath(wsi_path):
+                raise ValueError(f'Duplicated patient id {patient_id}: {wsi_paths[patient_id]}, {wsi_path}')
+            wsi_paths[patient_id] = wsi_path
+
+    return sorted(wsi_paths.items())
+
+
+def load_masks_index(masks_dir: str) -> dict:
+    '''Load the index of the masks in the directory; empty if there is none.'''
+    masks_index_path = os.path.join(masks_dir, MASKS_INDEX_FNAME)
+    if not os.path.exists(masks_index_path):
+        return {}
+
+    with open(masks_index_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_masks_index(masks_dir: str, masks_index: dict) -> None:
+    '''Save the index of the masks in the directory; the file is replaced atomically.'''
+    masks_index_path = os.path.join(masks_dir, MASKS_INDEX_FNAME)
+    tmp_path = f'{masks_index_path}.tmp'
+    with open(tmp_path, 'w+', encoding='utf-8') as f:
+        json.dump(masks_index, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, masks_index_path)
+
+
+def mask_is_up_to_date(mask_path: str, wsi_path: str, fingerprint: str, indexed_fingerprint: str = None) -> bool:
+    '''Check whether the mask was generated from the current wsi with the current parameters.
+
+    - Args
+        mask_path: Path to the mask
+        wsi_path: Path to the wsi of the mask
+        fingerprint: Fingerprint of the wsi and the parameters; see coords.source_fingerprint()
+        indexed_fingerprint: Fingerprint recorded in the index when the mask was generated, if any
+
+    - Returns
+        True if the mask does not need to be generated again
+    '''
+    if not os.path.exists(mask_path):
+        return False
+
+    if indexed_fingerprint is not None:
+        return indexed_fingerprint == fingerprint
+
+    # Masks generated before the index; kept if they are newer than their wsi
+    return os.stat(mask_path).st_mtime_ns >= os.stat(wsi_path).st_mtime_ns
+
+
+def mask_params(wsi_level: int = 6, min_rgb: int = 50, output_format: str = 'npy',
+                tissue_index_levels: int = 0) -> dict:
+    '''Return the parameters the roi masks are generated with; part of their fingerprint.'''
+    params = {'wsi_level': wsi_level, 'min_rgb': min_rgb}
+    # Masks indexed with the defaults before these options stay valid
+    if output_format != 'npy':
+        params['output_format'] = output_format
+    if tissue_index_levels > 0:
+        params['tissue_index_levels'] = tissue_index_levels
+
+    return params
+
+
+def _generate_mask_task(task: tuple) -> tuple:
+    '''Generate a mask in a worker process; task of (patient_id, wsi_path, mask_path, wsi_level,
+    min_rgb, tile_size, output_format, tissue_index_levels).'''
+    patient_id, wsi_path, mask_path, wsi_level, min_rgb, tile_size, output_format, tissue_index_levels = task
+    generate_roi_mask(wsi_path_in=wsi_path,
+                      mask_path_out=mask_path,
+                      wsi_level=wsi_level,
+                      min_rgb=min_rgb,
+                      tile_size=tile_size,
+                      output_format=output_format)
+
+    if tissue_index_levels > 0:
+        from openslide import OpenSlide
+
+        slide = OpenSlide(wsi_path)
+        build_tissue_index(mask_path,
+                           downsample=slide.level_downsamples[wsi_level],
+                           num_levels=tissue_index_levels)
+        slide.close()
+
+    return patient_id
+
+
+def generate_roi_masks(wsi_dirs: list, masks_dir_out: str, wsi_level: int=6, min_rgb: int=50,
+                       tile_size: int=None, num_workers: int=1, force: bool=False,
+                       output_format: str='npy', tissue_index_levels: int=0, split_path: str=None,
+                       subsets: list=None) -> dict:
+    '''Generate the masks of every wsi in the directories over a process pool.
+
+    Masks already generated from the same wsi with the same parameters are skipped.
+
+    - Args
+        wsi_dirs: Paths to the directories of wsi, searched recursively; e.g. train, valid and test
+        masks_dir_out: Path to the directory to save the masks; {patient_id}.npy or {patient_id}.mask
+        wsi_level: Level of the wsi to generate the masks at
+        min_rgb: Minimum value of every channel of a tissue pixel
+        tile_size: Read each level tile by tile if given; see generate_roi_mask_tiled()
+        num_workers: Number of worker processes; generate in this process if 1
+        force: Generate every mask again if True
+        output_format: 'npy' to save with np.save(), 'packed' to save 1 bit per pixel; see packed_mask.py
+        tissue_index_levels: Levels of the tissue index built next to every mask; no index if 0
+        split_path: Path to a split manifest whose wsi are also generated; see split.py
+        subsets: Subsets of the split manifest; every subset if None
+
+    - Returns
+        A dict of the number of generated and skipped masks, the elapsed seconds and the slides per minute
+    '''
+    os.makedirs(masks_dir_out, exist_ok=True)
+    masks_index = load_masks_index(masks_dir_out)
+
+    tasks = []
+    fingerprints = {}
+    num_skipped = 0
+    for (patient_id, wsi_path) in select_slides(wsi_dirs, split_path, subsets):
+        mask_path = os.path.join(masks_dir_out, f'{patient_id}{MASK_EXTS[output_format]}')
+        fingerprint = source_fingerprint(wsi_path, **mask_params(wsi_level, min_rgb, output_format,
+                                                                 tissue_index_levels))
+        if (not force) and mask_is_up_to_date(mask_path, wsi_path, fingerprint, masks_index.get(patient_id)):
+            masks_index[patient_id] = fingerprint
+            num_skipped += 1
+            continue
+
+        fingerprints[patient_id] = fingerprint
+        tasks.append((patient_id, wsi_path, mask_path, wsi_level, min_rgb,
+                      tile_size, output_format, tissue_index_levels))
+
+    return run_mask_tasks(_generate_mask_task, tasks, fingerprints, masks_index, masks_dir_out,
+                          num_skipped, num_workers)
+
+
+def run_mask_tasks(run_task, tasks: list, fingerprints: dict, masks_index: dict, masks_dir_out: str,
+                   num_skipped: int = 0, num_workers: int = 1) -> dict:
+    '''Run the tasks of the masks of a directory over a process pool, recording every saved mask in its index.
+
+    - Args
+        run_task: Picklable function of a task returning the patient id of the saved mask
+        tasks: Tasks of the masks to generate; the first item of a task is the patient id
+        fingerprints: Patient id -> fingerprint of the mask to record in the index
+        masks_index: Index of the masks of the directory; see load_masks_index()
+        masks_dir_out: Path to the directory of the masks
+        num_skipped: Number of masks which are up to date; reported in the stats
+        num_workers: Number of worker processes; generate in this process if 1
+
+    - Returns
+        A dict of the number of generated and skipped masks, the elapsed seconds and the slides per minute
+    '''
+    print(f'{num_skipped} masks are up to date, {len(tasks)} masks to generate')
+
+    start_time = time.perf_counter()
+    num_done = 0
+
+    def checkpoint(patient_id: str) -> None:
+        nonlocal num_done
+        num_done += 1
+        # Record the mask as soon as it is saved; an interrupted run resumes from here
+        masks_index[patient_id] = fingerprints[patient_id]
+        save_masks_index(masks_dir_out, masks_index)
+
+        slides_per_min = num_done / (time.perf_counter() - start_time) * 60
+        print(f'{num_done}/{len(tasks)} masks are saved in {masks_dir_out} ({slides_per_min:.2f} slides/min)')
+
+    if num_workers <= 1:
+        for task in tasks:
+            checkpoint(run_task(task))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(run_task, task) for task in tasks]
+            for future in as_completed(futures):
+                checkpoint(future.result())
+
+    save_masks_index(masks_dir_out, masks_index)
+
+    elapsed = time.perf_counter() - start_time
+    stats = {
+        'num_generated': num_done,
+        'num_skipped': num_skipped,
+        'seconds': elapsed,
+        'slides_per_min': num_done / elapsed * 60 if elapsed > 0 else 0.0,
+    }
+    print(f'Generated {num_done} masks in {elapsed:.1f}s ({stats["slides_per_min"]:.2f} slides/min)')
+
+    return stats
+
+
+def generate_tumor_mask(wsi_path_in: str, annot_path: str, mask_path_out: str, wsi_level: int=6,
+                        tile_size: int=None, output_format: str='packed') -> None:
+    '''Generate the ground truth tumor mask of a wsi; positive annotations minus negative ones.
+
+    The mask has the shape of the roi mask of generate_roi_mask() at the same level. Pixel (x, y) is tumor
+    if (x, y) * downsample of the level is inside the annotations; see LesionAnnotations.tumor_mask().
+
+    - Args
+        wsi_path_in: Path to the wsi
+        annot_path: Path to the json annotation or annotation store of the wsi; an empty mask if None
+        mask_path_out: Path to save the mask; shape of (width, height)
+        wsi_level: Level of the wsi to generate the mask at
+        tile_size: Rasterize tile by tile with bounded memory if given; the whole level at once otherwise
+        output_format: 'npy' to save with np.save(), 'packed' to save 1 bit per pixel; see packed_mask.py
+
+    - Returns
+        None
+    '''
+    from openslide import OpenSlide
+
+    assert output_format in MASK_EXTS, f'Unknown output format: {output_format}'
+
+    slide = OpenSlide(wsi_path_in)
+    level_width, level_height = slide.level_dimensions[wsi_level]
+    downsample = slide.level_downsamples[wsi_level]
+    slide.close()
+
+    lesion_annots = LesionAnnotations(annot_path) if annot_path is not None else None
+
+    if tile_size is None:
+        tile_size = max(level_width, level_height)
+    if output_format == 'packed':
+        # Tiles start at a multiple of 8 in y to be packed into whole bytes
+        tile_size = -(-tile_size // 8) * 8
+        tmp_path = f'{mask_path_out}.tmp'
+        tumor_mask = create_packed_mask(tmp_path, (level_width, level_height), wsi_level, downsample)
+    else:
+        if not mask_path_out.endswith('.npy'):
+            mask_path_out = f'{mask_path_out}.npy' # same as np.save()
+        tmp_path = f'{mask_path_out}.tmp'
+        tumor_mask = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=bool, shape=(level_width, level_height))
+
+    # Files are created zero-filled; only the tiles with tumor are written
+    if lesion_annots is not None and lesion_annots.pos_annots:
+        for y in range(0, level_height, tile_size):
+            for x in range(0, level_width, tile_size):
+                tile_shape = (min(tile_size, level_width - x), min(tile_size, level_height - y))
+                tile_mask = lesion_annots.tumor_mask(tile_shape, downsample, origin=(x, y))
+                if not tile_mask.any():
+                    continue
+                if output_format == 'packed':
+                    tumor_mask[x:x + tile_shape[0], y // 8:-(-(y + tile_shape[1]) // 8)] = np.packbits(tile_mask, axis=1)
+                else:
+                    tumor_mask[x:x + tile_shape[0], y:y + tile_shape[1]] = tile_mask
+    tumor_mask.flush()
+    del tumor_mask
+    os.replace(tmp_path, mask_path_out)
+
+
+def _generate_tumor_mask_task(task: tuple) -> str:
+    '''Generate a tumor mask in a worker process; task of (patient_id, wsi_path, annot_path, mask_path,
+    wsi_level, tile_size, output_format).'''
+    patient_id, wsi_path, annot_path, mask_path, wsi_level, tile_size, output_format = task
+    generate_tumor_mask(wsi_path_in=wsi_path,
+                        annot_path=annot_path,
+                        mask_path_out=mask_path,
+                        wsi_level=wsi_level,
+                        tile_size=tile_size,
+                        output_format=output_format)
+
+    return patient_id
+
+
+def generate_tumor_masks(wsi_dirs: list, annots_dir_in: str, masks_dir_out: str, wsi_level: int=6,
+                         tile_size: int=None, num_workers: int=1, force: bool=False,
+                         output_format: str='packed', split_path: str=None, subsets: list=None) -> dict:
+    '''Generate the ground truth tumor masks of every wsi in the directories over a process pool.
+
+    Slides without annotation, e.g. normal slides, get an empty mask. Masks already generated from
+    the same wsi and annotation with the same parameters are skipped.
+
+    - Args
+        wsi_dirs: Paths to the directories of wsi, searched recursively; e.g. train, valid and test
+        annots_dir_in: Path to the directory of the json annotations or annotation stores
+        masks_dir_out: Path to the directory to save the masks; {patient_id}.npy or {patient_id}.mask
+        wsi_level: Level of the wsi to generate the masks at
+        tile_size: Rasterize tile by tile if given; see generate_tumor_mask()
+        num_workers: Number of worker processes; generate in this process if 1
+        force: Generate every mask again if True
+        output_format: 'npy' to save with np.save(), 'packed' to save 1 bit per pixel; see packed_mask.py
+        split_path: Path to a split manifest whose wsi are also generated; see split.py
+        subsets: Subsets of the split manifest; every subset if None
+
+    - Returns
+        A dict of the number of generated and skipped masks, the elapsed seconds and the slides per minute
+    '''
+    os.makedirs(masks_dir_out, exist_ok=True)
+    masks_index = load_masks_index(masks_dir_out)
+
+    tasks = []
+    fingerprints = {}
+    num_skipped = 0
+    for (patient_id, wsi_path) in select_slides(wsi_dirs, split_path, subsets):
+        mask_path = os.path.join(masks_dir_out, f'{patient_id}{MASK_EXTS[output_format]}')
+        annot_path = annotation_path(annots_dir_in, patient_id)
+        if not os.path.exists(annot_path):
+            annot_path = None
+        source_paths = [wsi_path] if annot_path is None else [wsi_path, annot_path]
+        fingerprint = source_fingerprint(*source_paths, kind='tumor', wsi_level=wsi_level,
+                                         output_format=output_format)
+        if (not force) and mask_is_up_to_date(mask_path, wsi_path, fingerprint, masks_index.get(patient_id)):
+            masks_index[patient_id] = fingerprint
+            num_skipped += 1
+            continue
+
+        fingerprints[patient_id] = fingerprint
+        tasks.append((patient_id, wsi_path, annot_path, mask_path, wsi_level, tile_size, output_format))
+
+    return run_mask_tasks(_generate_tumor_mask_task, tasks, fingerprints, masks_index, masks_dir_out,
+                          num_skipped, num_workers)
+
+
+def cmap_colors(cmap: str = 'gray') -> tuple:
+    '''Return the RGB colors of the background and the tissue of a binary mask in the colormap.'''
+    if cmap == 'gray':
+        return (0, 0, 0), (255, 255, 255)
+
+    # Only other colormaps need matplotlib; matplotlib.colormaps is new in 3.5, get_cmap() is removed in 3.9
+    try:
+        from matplotlib import colormaps
+        colormap = colormaps[cmap]
+    except ImportError:
+        from matplotlib.cm import get_cmap
+        colormap = get_cmap(cmap)
+    background, tissue = (tuple(int(round(channel * 255)) for channel in colormap(value)[:3])
+                          for value in (0.0, 1.0))
+
+    return background, tissue
+
+
+def mask_thumbnail(mask, downsample: int = 1, cmap: str = 'gray') -> Image.Image:
+    '''Render a mask to an RGB image; the tissue fraction of every block of downsample x downsample pixels.
+
+    - Args
+        mask: Binary mask of shape (width, height) or a PackedMask
+        downsample: Mask pixels per pixel of the image along each axis
+        cmap: Colormap of the mask; colors of matplotlib colormaps other than gray are looked up in matplotlib
+
+    - Returns
+        A PIL RGB image of size (ceil(width / downsample), ceil(height / downsample))
+    '''
+    if not isinstance(mask, PackedMask):
+        mask = PackedMask.from_array(mask)
+    mask_width, mask_height = mask.shape
+    thumbnail_width = -(-mask_width // downsample)
+    thumbnail_height = -(-mask_height // downsample)
+
+    # Fractions are averaged block by block over chunks of whole blocks of rows
+    fractions = np.empty((thumbnail_width, thumbnail_height), dtype=np.float32)
+    rows_per_chunk = max(ROWS_PER_CHUNK // downsample, 1) * downsample
+    for x in range(0, mask_width, rows_per_chunk):
+        chunk = mask.region(x, 0, rows_per_chunk, mask_height)
+        chunk_width = len(chunk)
+        padded = np.zeros((-(-chunk_width // downsample) * downsample, thumbnail_height * downsample), dtype=np.float32)
+        padded[:chunk_width, :mask_height] = chunk
+        blocks = padded.reshape(len(padded) // downsample, downsample, thumbnail_height, downsample)
+        fractions[x // downsample:x // downsample + len(blocks)] = blocks.mean(axis=(1, 3))
+
+    background, tissue = (np.array(color, dtype=np.float32) for color in cmap_colors(cmap))
+    # Shape of (height, width, 3) for the image; transpose of the mask
+    pixels = background + fractions.T[:, :, np.newaxis] * (tissue - background)
+
+    return Image.fromarray(np.round(pixels).astype(np.uint8), 'RGB')
+
+
+def draw_overlays(image: Image.Image, scale: float, annot_path: str = None,
+                  patch_coords: np.ndarray = None, patch_size: int = 300) -> None:
+    '''Draw annotations and sampled patches on a thumbnail in place.
+
+    - Args
+        image: Thumbnail of the mask; see mask_thumbnail()
+        scale: Level 0 pixels per pixel of the thumbnail
+        annot_path: Path to the json annotation or annotation store of the slide; positive annotations in red, negative in blue
+        patch_coords: Level 0 centers of the sampled patches of shape (n, 2); drawn in green
+        patch_size: Size of the patch in level 0 pixels
+
+    - Returns
+        None
+    '''
+    draw = ImageDraw.Draw(image)
+
+    if annot_path is not None:
+        lesion_annots = LesionAnnotations(annot_path)
+        for (annots, color) in ((lesion_annots.pos_annots, (255, 0, 0)), (lesion_annots.neg_annots, (0, 0, 255))):
+            for annot in annots:
+                vertices = np.asarray(annot.coordinates(), dtype=np.float64) / scale
+                if len(vertices) > 1:
+                    draw.polygon([tuple(vertex) for vertex in vertices.tolist()], outline=color)
+
+    if patch_coords is not None:
+        half_size = patch_size / 2
+        for (center_x, center_y) in np.asarray(patch_coords, dtype=np.float64).reshape(-1, 2).tolist():
+            draw.rectangle([(center_x - half_size) / scale, (center_y - half_size) / scale,
+                            (center_x + half_size) / scale, (center_y + half_size) / scale],
+                           outline=(0, 255, 0))
+
+
+def render_mask_image(mask_path_in: str, image_path_out: str, downsample: int = 1, cmap: str = 'gray',
+                      annot_path: str = None, patch_coords: np.ndarray = None, patch_size: int = 300,
+                      mask_downsample: float = None) -> str:
+    '''Save a mask as an image with optional overlays of annotations and sampled patches.
+
+    - Args
+        mask_path_in: Path to the mask; packed or saved by np.save()
+        image_path_out: Path to save the image; the format follows the extension
+        downsample: Mask pixels per pixel of the image along each axis
+        cmap: Colormap of the mask
+        annot_path: Path to the json annotation or annotation store of the slide to draw
+        patch_coords: Level 0 centers of the sampled patches of the slide to draw
+        patch_size: Size of the patch in level 0 pixels
+        mask_downsample: Level 0 pixels per mask pixel; taken from the packed mask if None
+
+    - Returns
+        Path to the image
+    '''
+    roi_mask = open_mask(mask_path_in)
+    image = mask_thumbnail(roi_mask, downsample, cmap)
+
+    if (annot_path is not None) or (patch_coords is not None):
+        if mask_downsample is None:
+            mask_downsample = roi_mask.downsample
+        if mask_downsample is None:
+            raise ValueError(f'Downsample of {mask_path_in} is unknown; needed to draw the overlays')
+        draw_overlays(image, mask_downsample * downsample, annot_path, patch_coords, patch_size)
+
+    image.save(image_path_out)
+
+    return image_path_out
 
 
 def mask_to_image(mask_path_in: str, save_dir_out: str,
-                  cmap: str = 'gray', format: str = 'png') -> None:
+                  cmap: str = 'gray', format: str = 'png', **kwargs) -> None:
     '''Save the given mask(np.ndarray) to image.
     
     - Args
-        mask_path_in:
-        save_dir_out:
-        cmap: 
-        format:
+        mask_path_in: Path to the mask; packed or saved by np.save()
+        save_dir_out: Path to the directory to save the image; {patient_id}.{format}
+        cmap: Colormap of the mask
+        format: Format of the image
+        kwargs: Downsampling and overlays; see render_mask_image()
 
     - Returns
         None
     '''
-    if not os.path.exists(save_dir_out):
-        os.mkdir(save_dir_out)
+    os.makedirs(save_dir_out, exist_ok=True)
 
-    mask = np.load(mask_path_in)
-    mask = np.transpose(mask) # becuase openslide's shape is (width, height); numpy (height, width)
     mask_fname = ntpath.basename(mask_path_in)
 
-    patient_id = mask_fname.rstrip('.npy')
+    patient_id = os.path.splitext(mask_fname)[0]
 
-    image_fname = f'{patient_id}.png'
+    image_fname = f'{patient_id}.{format}'
     image_path = os.path.join(save_dir_out, image_fname) # path to save image
-    plt.imsave(fname=image_path,
-               arr=mask,
-               cmap=cmap,
-               format=format)
+    render_mask_image(mask_path_in, image_path, cmap=cmap, **kwargs)
 
     print(f'Mask of {patient_id} was converted to image and saved to {image_path}')
 
 
-if __name__ == '__main__':
-    ROOT_DIR = os.path.abspath('.')
-    DATA_DIR = '/ssd-ext/dataset'
-    TRAIN_WSI_DIR = os.path.join(DATA_DIR, 'train')
-    VALID_WSI_DIR = os.path.join(DATA_DIR, 'valid')
-    MASKS_DIR = os.path.join(ROOT_DIR, 'results', 'masks')
-    IMAGES_DIR = os.path.join(MASKS_DIR, 'images')
-
-    os.makedirs(MASKS_DIR, exist_ok=True)
-
-    # Generate training tumor slide masks
-    train_tumor_wsi_dir = os.path.join(TRAIN_WSI_DIR, 'tumor')
-    train_tumor_wsi_fnames = os.listdir(train_tumor_wsi_dir)
-    train_tumor_wsi_fnames = sorted(train_tumor_wsi_fnames)
-    for fname in train_tumor_wsi_fnames:
-        wsi_path = os.path.join(train_tumor_wsi_dir, fname)
-
-        patient_id = fname.rstrip('.tif')
-
-        mask_fname = f'{patient_id}.npy'
-        mask_fnames = os.listdir(MASKS_DIR)
-        mask_path = os.path.join(MASKS_DIR, mask_fname)
-        if mask_fname not in mask_fnames:
-            generate_roi_mask(wsi_path_in=wsi_path,
-                            mask_path_out=mask_path)
-            print(f'Mask of {patient_id} was saved at {MASKS_DIR}')
-
-    # Generate training normal slide masks
-    train_normal_wsi_dir = os.path.join(TRAIN_WSI_DIR, 'normal')
-    train_normal_wsi_fnames = os.listdir(train_normal_wsi_dir)
-    train_normal_wsi_fnames = sorted(train_normal_wsi_fnames)
-    for fname in train_normal_wsi_fnames:
-        wsi_path = os.path.join(train_normal_wsi_dir, fname)
-
-        patient_id = fname.rstrip('.tif')
-
-        mask_fname = f'{patient_id}.npy'
-        mask_fnames = os.listdir(MASKS_DIR)
-        mask_path = os.path.join(MASKS_DIR, mask_fname)
-        if mask_fname not in mask_fnames:
-            generate_roi_mask(wsi_path_in=wsi_path,
-                            mask_path_out=mask_path)
-        print(f'Mask of {patient_id} was saved at {MASKS_DIR}')
-
-    # Generate validation tumor slide masks
-    valid_tumor_wsi_dir = os.path.join(VALID_WSI_DIR, 'tumor')
-    valid_tumor_wsi_fnames = os.listdir(valid_tumor_wsi_dir)
-    valid_tumor_wsi_fnames = sorted(valid_tumor_wsi_fnames)
-    for fname in valid_tumor_wsi_fnames:
-        wsi_path = os.path.join(valid_tumor_wsi_dir, fname)
-
-        patient_id = fname.rstrip('.tif')
-
-        mask_fname = f'{patient_id}.npy'
-        mask_fnames = os.listdir(MASKS_DIR)
-        mask_path = os.path.join(MASKS_DIR, mask_fname)
-        if mask_fname not in mask_fnames:
-            generate_roi_mask(wsi_path_in=wsi_path,
-                            mask_path_out=mask_path)
-            print(f'Mask of {patient_id} was saved at {MASKS_DIR}')
-
-    # Generate validation normal slide masks
-    valid_normal_wsi_dir = os.path.join(VALID_WSI_DIR, 'normal')
-    valid_normal_wsi_fnames = os.listdir(valid_normal_wsi_dir)
-    valid_normal_wsi_fnames = sorted(valid_normal_wsi_fnames)
-    for fname in valid_normal_wsi_fnames:
-        wsi_path = os.path.join(valid_normal_wsi_dir, fname)
-
-        patient_id = fname.rstrip('.tif')
-
-        mask_fname = f'{patient_id}.npy'
-        mask_path = os.path.join(MASKS_DIR, mask_fname)
-        generate_roi_mask(wsi_path_in=wsi_path,
-                          mask_path_out=mask_path)
-        print(f'Mask of {patient_id} was saved at {MASKS_DIR}')
+def _render_mask_task(task: tuple) -> str:
+    '''Render a mask in a worker process; task of (mask_path, image_path, kwargs of render_mask_image()).'''
+    mask_path, image_path, kwargs = task
+
+    return render_mask_image(mask_path, image_path, **kwargs)
+
+
+def masks_to_images(masks_dir_in: str, save_dir_out: str, downsample: int = 1, cmap: str = 'gray',
+                    format: str = 'png', annots_dir_in: str = None, patch_list_path: str = None,
+                    patch_size: int = 300, mask_downsample: float = None, num_workers: int = 1) -> int:
+    '''Save every mask of the directory as an image over a process pool.
+
+    - Args
+        masks_dir_in: Path to the directory of the masks; packed or saved by np.save()
+        save_dir_out: Path to the directory to save the images; {patient_id}.{format}
+        downsample: Mask pixels per pixel of the images along each axis
+        cmap: Colormap of the masks
+        format: Format of the images
+        annots_dir_in: Path to the directory of the json annotations or annotation stores to draw, if any
+        patch_list_path: Path to the list of sampled patches to draw, if any; centers at level 0
+        patch_size: Size of the patch in level 0 pixels
+        mask_downsample: Level 0 pixels per mask pixel; taken from the packed masks if None
+        num_workers: Number of worker processes; render in this process if 1
+
+    - Returns
+        The number of saved images
+    '''
+    os.makedirs(save_dir_out, exist_ok=True)
+
+    patch_coords = {}
+    if patch_list_path is not None:
+        patch_list = PatchList.load(patch_list_path)
+        rows = patch_list.rows()
+        for (slide_index, patient_id) in enumerate(patch_list.slide_names):
+            patch_coords[patient_id] = rows[rows[:, 0] == slide_index, 1:]
+
+    # One mask per slide; the packed mask if both exist, as PatchSampler.mask_path()
+    mask_exts = set(MASK_EXTS.values())
+    mask_fnames = {}
+    for fname in sorted(os.listdir(masks_dir_in)):
+        patient_id, ext = os.path.splitext(fname)
+        if ext not in mask_exts:
+            continue
+        if (patient_id not in mask_fnames) or (ext == PACKED_MASK_EXT):
+            mask_fnames[patient_id] = fname
+
+    tasks = []
+    for (patient_id, fname) in sorted(mask_fnames.items()):
+        kwargs = {'downsample': downsample, 'cmap': cmap, 'patch_size': patch_size,
+                  'mask_downsample': mask_downsample}
+        annot_path = annotation_path(annots_dir_in, patient_id) if annots_dir_in is not None else None
+        if (annot_path is not None) and os.path.exists(annot_path):
+            kwargs['annot_path'] = annot_path
+        if patient_id in patch_coords:
+            kwargs['patch_coords'] = patch_coords[patient_id]
+        tasks.append((os.path.join(masks_dir_in, fname), os.path.join(save_dir_out, f'{patient_id}.{format}'), kwargs))
+
+    num_done = 0
+    if num_workers <= 1:
+        for task in tasks:
+            _render_mask_task(task)
+            num_done += 1
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for _ in executor.map(_render_mask_task, tasks):
+                num_done += 1
+    print(f'{num_done} masks were converted to images and saved to {save_dir_out}')
+
+    return num_done
+
+
+def main(argv: list = None, prog: str = None) -> None:
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Generate the roi masks of every wsi in the given directories.')
+    parser.add_argument('wsi_dirs', nargs='*',
+                        help='directories of wsi searched recursively; e.g. train valid test')
+    parser.add_argument('--split', default=None, help='split manifest whose wsi are also used; see split.py')
+    parser.add_argument('--subsets', nargs='+', default=None,
+                        help='subsets of the split manifest; e.g. train valid, every subset if not given')
+    parser.add_argument('--masks-dir', required=True, help='directory to save the masks')
+    parser.add_argument('--images-dir', default=None, help='also save every mask as an image to this directory')
+    parser.add_argument('--image-downsample', type=int, default=1, help='mask pixels per pixel of the images')
+    parser.add_argument('--annots-dir', default=None,
+                        help='directory of json annotations to draw on the images and to generate the tumor masks')
+    parser.add_argument('--tumor-masks-dir', default=None,
+                        help='also generate the ground truth tumor masks from --annots-dir to this directory')
+    parser.add_argument('--patch-list', default=None, help='list of sampled patches to draw on the images')
+    parser.add_argument('--mask-downsample', type=float, default=None,
+                        help='level 0 pixels per mask pixel to draw on .npy masks; stored in packed masks')
+    parser.add_argument('--wsi-level', type=int, default=6, help='level of the wsi to generate the masks at')
+    parser.add_argument('--min-rgb', type=int, default=50, help='minimum value of every channel of a tissue pixel')
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help='read each level tile by tile; needed for finer levels')
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='generate the up-to-date masks again')
+    parser.add_argument('--output-format', choices=sorted(MASK_EXTS), default='npy',
+                        help="'packed' saves 1 bit per pixel")
+    parser.add_argument('--tissue-index-levels', type=int, default=0,
+                        help='levels of the tissue index built next to every mask; no index if 0')
+    args = parser.parse_args(argv)
+    if not args.wsi_dirs and args.split is None:
+        parser.error('give wsi directories or --split')
+
+    generate_roi_masks(wsi_dirs=args.wsi_dirs,
+                       masks_dir_out=args.masks_dir,
+                       wsi_level=args.wsi_level,
+                       min_rgb=args.min_rgb,
+                       tile_size=args.tile_size,
+                       num_workers=args.num_workers,
+                       force=args.force,
+                       output_format=args.output_format,
+                       tissue_index_levels=args.tissue_index_levels,
+                       split_path=args.split,
+                       subsets=args.subsets)
+
+    if args.tumor_masks_dir is not None:
+        assert args.annots_dir is not None, '--tumor-masks-dir needs --annots-dir'
+        generate_tumor_masks(wsi_dirs=args.wsi_dirs,
+                             annots_dir_in=args.annots_dir,
+                             masks_dir_out=args.tumor_masks_dir,
+                             wsi_level=args.wsi_level,
+                             tile_size=args.tile_size,
+                             num_workers=args.num_workers,
+                             force=args.force,
+                             output_format=args.output_format,
+                             split_path=args.split,
+                             subsets=args.subsets)
 
     # Convert the masks to images and save them all
-    mask_fnames = os.listdir(MASKS_DIR)
-    mask_fnames = [fname for fname in mask_fnames if fname.endswith('.npy')]
-    mask_fnames = sorted(mask_fnames)
-    
-    for fname in mask_fnames:
-        mask_path = os.path.join(MASKS_DIR, fname)
-        mask_to_image(mask_path_in=mask_path,
-                      save_dir_out=IMAGES_DIR)
\ No newline at end of file
+    if args.images_dir is not None:
+        masks_to_images(masks_dir_in=args.masks_dir,
+                        save_dir_out=args.images_dir,
+                        downsample=args.image_downsample,
+                        annots_dir_in=args.annots_dir,
+                        patch_list_path=args.patch_list,
+                        mask_downsample=args.mask_downsample,
+                        num_workers=args.num_workers)
+
+if __name__ == '__main__':
+    main()
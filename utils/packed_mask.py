@@ -0,0 +1,200 @@
+# Standard Libs
+import os
+
+# Third-party Libs
+import numpy as np
+
+# Custom Libs
+from storage import create_array, open_array, write_array
+
+PACKED_MASK_VERSION = 1
+PACKED_MASK_EXT = '.mask'
+ROWS_PER_CHUNK = 4096 # rows unpacked at once by the queries over the whole mask
+
+# Number of set bits of every byte
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+
+
+def packed_mask_meta(mask_shape: tuple, wsi_level: int = None, downsample: float = None) -> dict:
+    '''Return the header of a packed mask.'''
+    return {
+        'kind': 'packed_mask',
+        'version': PACKED_MASK_VERSION,
+        'mask_shape': [int(size) for size in mask_shape],
+        'wsi_level': wsi_level,
+        'downsample': downsample,
+    }
+
+
+def save_packed_mask(path: str, mask: np.ndarray, wsi_level: int = None, downsample: float = None) -> None:
+    '''Save a binary mask with 1 bit per pixel; every row(x) is packed along y.
+
+    - Args
+        path: Path to save the mask
+        mask: Binary mask of shape (width, height)
+        wsi_level: Level of the wsi the mask was generated at
+        downsample: Downsample factor of that level
+
+    - Returns
+        None
+    '''
+    packed = np.packbits(np.asarray(mask, dtype=bool), axis=1)
+    write_array(path, packed, packed_mask_meta(mask.shape, wsi_level, downsample))
+
+
+def create_packed_mask(path: str, mask_shape: tuple, wsi_level: int = None,
+                       downsample: float = None) -> np.memmap:
+    '''Create an empty packed mask on disk to be filled in place; see storage.create_array().
+
+    A band of rows [y, y + height) is written with np.packbits(band, axis=1) at bytes [y // 8, ...),
+    so y must be a multiple of 8 for every band but the last one.
+
+    - Args
+        path: Path to create the mask
+        mask_shape: Shape of the mask; (width, height)
+        wsi_level: Level of the wsi the mask was generated at
+        downsample: Downsample factor of that level
+
+    - Returns
+        A writable memory-mapped uint8 array of shape (width, ceil(height / 8))
+    '''
+    mask_width, mask_height = mask_shape
+    packed_shape = (mask_width, -(-mask_height // 8))
+
+    return create_array(path, packed_shape, np.uint8, packed_mask_meta(mask_shape, wsi_level, downsample))
+
+
+class PackedMask:
+    '''A binary mask packed to 1 bit per pixel; memory-mapped and queried without unpacking the whole mask.'''
+
+    def __init__(self, packed: np.ndarray, mask_shape: tuple,
+                 wsi_level: int = None, downsample: float = None) -> None:
+        '''Initialize the PackedMask.
+
+        - Args
+            packed: Packed mask of shape (width, ceil(height / 8)); see save_packed_mask()
+            mask_shape: Shape of the mask; (width, height)
+            wsi_level: Level of the wsi the mask was generated at
+            downsample: Downsample factor of that level
+
+        - Returns
+            None
+        '''
+        self.packed = packed
+        self.shape = tuple(mask_shape)
+        self.wsi_level = wsi_level
+        self.downsample = downsample
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'PackedMask':
+        '''Open a mask saved by save_packed_mask(); memory-mapped if mmap is True.'''
+        packed, header_dict = open_array(path, mmap=mmap)
+        assert header_dict.get('kind') == 'packed_mask', f'{path} is not a packed mask'
+        assert header_dict.get('version') == PACKED_MASK_VERSION, \
+            f'Unsupported packed mask version: {header_dict.get("version")}'
+
+        return cls(packed, header_dict['mask_shape'], header_dict['wsi_level'], header_dict['downsample'])
+
+    @classmethod
+    def from_array(cls, mask: np.ndarray, wsi_level: int = None, downsample: float = None) -> 'PackedMask':
+        '''Pack a binary mask of shape (width, height) in memory.'''
+        return cls(np.packbits(np.asarray(mask, dtype=bool), axis=1), mask.shape, wsi_level, downsample)
+
+    def row(self, x: int) -> np.ndarray:
+        '''Return the row of the given x; a binary array of shape (height,).'''
+        _, mask_height = self.shape
+
+        return np.unpackbits(self.packed[x], count=mask_height).astype(bool)
+
+    def region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        '''Return the region of the mask; clipped to the mask.
+
+        - Args
+            x: Top left x of the region
+            y: Top left y of the region
+            width: Width of the region
+            height: Height of the region
+
+        - Returns
+            A binary array of shape (width, height) or smaller if the region crosses the border
+        '''
+        mask_width, mask_height = self.shape
+        x0, x1 = max(x, 0), min(x + width, mask_width)
+        y0, y1 = max(y, 0), min(y + height, mask_height)
+        if x0 >= x1 or y0 >= y1:
+            return np.zeros((max(x1 - x0, 0), max(y1 - y0, 0)), dtype=bool)
+
+        # Unpack only the bytes covering [y0, y1)
+        byte_start = y0 // 8
+        byte_end = -(-y1 // 8)
+        bits = np.unpackbits(self.packed[x0:x1, byte_start:byte_end], axis=1)
+
+        return bits[:, y0 - byte_start * 8:y1 - byte_start * 8].astype(bool)
+
+    def to_array(self) -> np.ndarray:
+        '''Unpack the whole mask; a binary array of shape (width, height).'''
+        _, mask_height = self.shape
+
+        return np.unpackbits(self.packed, axis=1, count=mask_height).astype(bool)
+
+    def count_nonzero(self) -> int:
+        '''Return the number of set pixels.'''
+        num_pixels = 0
+        for x in range(0, self.shape[0], ROWS_PER_CHUNK):
+            num_pixels += int(POPCOUNT[self.packed[x:x + ROWS_PER_CHUNK]].sum())
+
+        return num_pixels
+
+    def argwhere(self) -> np.ndarray:
+        '''Return the coordinates of the set pixels in the order of np.argwhere(); int64 array of shape (n, 2).
+
+        Only the non-zero bytes are unpacked, so the cost follows the tissue, not the size of the mask.
+        '''
+        chunks = [np.empty((0, 2), dtype=np.int64)]
+        for x in range(0, self.shape[0], ROWS_PER_CHUNK):
+            packed_chunk = np.asarray(self.packed[x:x + ROWS_PER_CHUNK])
+            xs, byte_indices = np.nonzero(packed_chunk)
+            if not len(xs):
+                continue
+
+            # 8 bits of every non-zero byte; most significant bit first as np.packbits()
+            bits = np.unpackbits(packed_chunk[xs, byte_indices][:, np.newaxis], axis=1)
+            byte_positions, bit_indices = np.nonzero(bits)
+
+            chunk = np.empty((len(byte_positions), 2), dtype=np.int64)
+            chunk[:, 0] = xs[byte_positions] + x
+            chunk[:, 1] = byte_indices[byte_positions].astype(np.int64) * 8 + bit_indices
+            chunks.append(chunk)
+
+        return np.concatenate(chunks)
+
+    def __repr__(self) -> str:
+        return f'PackedMask(shape={self.shape}, wsi_level={self.wsi_level}, downsample={self.downsample})'
+
+
+def open_mask(mask_path: str) -> PackedMask:
+    '''Open a packed mask, or pack a mask saved by np.save() in memory.'''
+    if os.path.splitext(mask_path)[1] == '.npy':
+        return PackedMask.from_array(np.load(mask_path))
+
+    return PackedMask.load(mask_path)
+
+
+def pack_npy_mask(npy_path: str, mask_path: str = None, wsi_level: int = None,
+                  downsample: float = None) -> str:
+    '''Convert a mask saved by np.save() to a packed mask.
+
+    - Args
+        npy_path: Path to the .npy mask
+        mask_path: Path to save the packed mask; next to the .npy mask if None
+        wsi_level: Level of the wsi the mask was generated at
+        downsample: Downsample factor of that level
+
+    - Returns
+        Path to the packed mask
+    '''
+    if mask_path is None:
+        mask_path = f'{os.path.splitext(npy_path)[0]}{PACKED_MASK_EXT}'
+    save_packed_mask(mask_path, np.load(npy_path), wsi_level, downsample)
+
+    return mask_path
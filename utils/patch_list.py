@@ -0,0 +1,134 @@
+# Standard Libs
+import json
+import os
+
+# Third-party Libs
+import numpy as np
+
+# Custom Libs
+from coords import pack_keys, unpack_keys
+from storage import open_array, write_array
+
+PATCH_LIST_VERSION = 1
+
+
+def patch_fname(patient_id: str, center_x: int, center_y: int) -> str:
+    '''Return the name of a patch; (patient_id,center_x,center_y).'''
+    return f'{patient_id},{center_x},{center_y}'
+
+
+class PatchList:
+    '''Sampled patches packed into int64 keys; (slide index, x, y) with a table of slide names.'''
+
+    def __init__(self, slide_names: list = None, keys: np.ndarray = None) -> None:
+        '''Initialize the PatchList.
+
+        - Args
+            slide_names: Table of slide names; slide index -> patient id
+            keys: Packed keys of the patches; see coords.pack_keys()
+
+        - Returns
+            None
+        '''
+        self.slide_names = list(slide_names) if slide_names is not None else []
+        self.slide_indices = {name: i for (i, name) in enumerate(self.slide_names)}
+        if keys is None:
+            keys = np.empty(0, dtype=np.int64)
+        self.keys = np.asarray(keys, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def slide_index(self, slide_name: str) -> int:
+        '''Return the index of the slide, add it to the table if it is new.'''
+        if slide_name not in self.slide_indices:
+            self.slide_indices[slide_name] = len(self.slide_names)
+            self.slide_names.append(slide_name)
+
+        return self.slide_indices[slide_name]
+
+    def add(self, slide_names: list, rows: np.ndarray) -> int:
+        '''Add patches, the patches already in the list are dropped.
+
+        - Args
+            slide_names: Table of slide names the slide indices of rows refer to
+            rows: Patches of shape (n, 3); (slide_index, x, y)
+
+        - Returns
+            The number of added patches
+        '''
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        # Map the slide indices to the table of this list
+        index_map = np.array([self.slide_index(name) for name in slide_names], dtype=np.int64)
+        if len(rows):
+            rows[:, 0] = index_map[rows[:, 0]]
+
+        keys = pack_keys(rows)
+        _, first_indices = np.unique(keys, return_index=True)
+        keys = keys[np.sort(first_indices)]
+        keys = keys[~np.isin(keys, self.keys)]
+        self.keys = np.concatenate([self.keys, keys])
+
+        return len(keys)
+
+    def rows(self) -> np.ndarray:
+        '''Return the patches as an int64 array of shape (n, 3); (slide_index, x, y).'''
+        return unpack_keys(self.keys)
+
+    def subset(self, mask: np.ndarray) -> 'PatchList':
+        '''Return the patches selected by the boolean mask, sharing the table of slide names.'''
+        return PatchList(self.slide_names, self.keys[mask])
+
+    def fnames(self) -> list:
+        '''Return the names of the patches; (patient_id,center_x,center_y).'''
+        return [patch_fname(self.slide_names[slide_index], center_x, center_y)
+                for (slide_index, center_x, center_y) in self.rows().tolist()]
+
+    def keys_of(self, patch_fnames) -> np.ndarray:
+        '''Return the keys of the named patches; patches of slides not in the table are dropped.'''
+        rows = []
+        for fname in patch_fnames:
+            patient_id, center_x, center_y = fname.strip('\n').split(',')
+            if patient_id in self.slide_indices:
+                rows.append((self.slide_indices[patient_id], int(center_x), int(center_y)))
+
+        return pack_keys(rows)
+
+    @classmethod
+    def from_fnames(cls, patch_fnames) -> 'PatchList':
+        '''Make a PatchList from patch names; (patient_id,center_x,center_y).'''
+        patch_list = cls()
+        rows = []
+        for fname in patch_fnames:
+            patient_id, center_x, center_y = fname.strip('\n').split(',')
+            rows.append((patch_list.slide_index(patient_id), int(center_x), int(center_y)))
+        patch_list.add(patch_list.slide_names, rows)
+
+        return patch_list
+
+    def save(self, path: str) -> None:
+        '''Save the list as a binary file; packed keys with the table of slide names in the header.'''
+        meta = {
+            'kind': 'patch_list',
+            'version': PATCH_LIST_VERSION,
+            'slide_names': self.slide_names,
+        }
+        write_array(path, self.keys, meta)
+
+    @classmethod
+    def load(cls, path: str) -> 'PatchList':
+        '''Load a list saved by save(), or a patches_list.json of the older versions.'''
+        if os.path.splitext(path)[1] == '.json':
+            with open(path, 'r', encoding='utf-8') as f:
+                patches_dict = json.load(f)
+
+            return cls.from_fnames(patches_dict['patches'])
+
+        keys, header_dict = open_array(path, mmap=False)
+        assert header_dict.get('version') == PATCH_LIST_VERSION, \
+            f'Unsupported patch list version: {header_dict.get("version")}'
+
+        return cls(header_dict['slide_names'], keys)
+
+    def __repr__(self) -> str:
+        return f'PatchList(patches={len(self.keys)}, slides={len(self.slide_names)})'
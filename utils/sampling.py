@@ -1,34 +1,56 @@
 # Standard Libs
-import json
 import os
 import random
 
 # Third-party Libs
 import numpy as np
-from openslide import OpenSlide
 
 # Custom Libs
-from annotation import LesionAnnotations
+from annotation import LesionAnnotations, annotation_path, check_tumor_mask
+from coords import (CoordinateIndex, load_coords_cache, migrate_json_cache,
+                    save_coords_cache, source_fingerprint)
+from extraction import load_progress, plan_extraction, run_extraction
+from mask import tissue_fractions
+from packed_mask import PACKED_MASK_EXT, PackedMask, open_mask
+from patch_list import PatchList
+from shards import list_shards, next_shard_index
+from slide import SlidePool
+from split import list_class_slides, load_split
+from tissue_index import load_tissue_index
+
+
+TUMOR_LABELINGS = ('raster', 'check', 'exact')
 
 
 class PatchSampler:
     '''Sample patches from the given wsi'''
 
     def __init__(self, wsi_dir_in: str, masks_dir_in: str, annots_dir_in: str,
-                 tumor_coords_dir_in: str, normal_coords_dir_in: str, patches_dir_out: str) -> None:
+                 tumor_coords_dir_in: str, normal_coords_dir_in: str, patches_dir_out: str,
+                 max_open_slides: int = 16, tumor_labeling: str = 'raster', split_path: str = None,
+                 subset: str = 'train') -> None:
         '''Initialize the PatchSampler
 
         -Args
-            wsi_dir_in:
+            wsi_dir_in: Directory of tumor/ and normal/ wsi; not listed if split_path is given
             masks_dir_in:
             annots_dir_in:
             tumor_coords_dir_in:
             normal_coords_dir_in:
             patches_dir_out:
+            max_open_slides: Maximum number of wsi kept open by the slide pool
+            tumor_labeling: How the roi pixels of the tumor slides are labeled;
+                            'raster' to rasterize the positive minus negative annotations at the mask resolution,
+                            'check' to check the raster against the polygon test too; see check_tumor_mask(),
+                            'exact' to test every roi point against the positive annotations as the older versions
+            split_path: Path to a split manifest to sample the wsi of; see split.py
+            subset: Subset of the split manifest; e.g. 'train' or 'valid'
 
         - Returns
             None
         '''
+        assert tumor_labeling in TUMOR_LABELINGS, f'Unknown tumor labeling: {tumor_labeling}'
+
         self.wsi_dir_in = wsi_dir_in
         self.masks_dir_in = masks_dir_in
         self.annots_dir_in = annots_dir_in
@@ -36,116 +58,199 @@ class PatchSampler:
         self.normal_coords_dir_in = normal_coords_dir_in
         self.patches_dir_out = patches_dir_out
         self.classes = ['tumor', 'normal']
+        self.tumor_labeling = tumor_labeling
 
         self.tumor_wsi_dir_in = os.path.join(self.wsi_dir_in, 'tumor')
         self.normal_wsi_dir_in = os.path.join(self.wsi_dir_in, 'normal')
 
-        self.tumor_wsi_fnames = os.listdir(self.tumor_wsi_dir_in)
-        self.normal_wsi_fnames = os.listdir(self.normal_wsi_dir_in)
+        # class -> {patient_id: wsi_path}
+        if split_path is not None:
+            slides = load_split(split_path, [subset])
+        else:
+            slides = list_class_slides([self.wsi_dir_in], classes=tuple(self.classes))
+        self.wsi_paths = {class_: {} for class_ in self.classes}
+        for (patient_id, (class_, wsi_path)) in slides.items():
+            self.wsi_paths[class_][patient_id] = wsi_path
+
+        # Opened slides shared by the patch extraction and the coordinate builders
+        self.slide_pool = SlidePool(max_open=max_open_slides)
+
+    def sample_patches(self, num_patches: int, wsi_level: int = 0,
+                       patch_size: int = 300, num_workers: int = 1, seed: int = None,
+                       output_format: str = 'png', shard_size: int = 4096,
+                       resume: bool = True, append: bool = False, max_region_size: int = 2048,
+                       min_tissue_fraction: float = 0.0) -> None:
+        '''Sample patches from the wsi and save them as png images or shards.
 
-    def sample_patches(self, num_patches: int, wsi_level: int = 0, patch_size: int = 300) -> None:
+        - Args
+            num_patches: Number of patches to sample
+            wsi_level: Level of the wsi
+            patch_size: Size of the patch
+            num_workers: Number of processes to extract patches; extract serially if 1
+            seed: Seed to sample the patches; not reproducible if None
+            output_format: 'png' to save each patch as an image,
+                           'shard' to save patches in shards read by shards.ShardReader
+            shard_size: Number of patches in a shard; only the last shard of a run may be smaller
+            resume: Skip the patches saved by the previous runs if True, extract every patch otherwise
+            append: Sample more patches if the existing list has less than num_patches
+            max_region_size: Maximum width/height of a region read at once to cut out nearby patches
+            min_tissue_fraction: Drop the candidate patches with less tissue under them than this fraction
 
+        - Returns
+            None
+        '''
         os.makedirs(self.patches_dir_out, exist_ok=True)
 
-        # Path to the .json file to save the list of sampled patches; (patient_id,coord_x,coord_y)
-        patches_list_path = os.path.join(self.patches_dir_out, 'patches_list.json')
-        if not os.path.exists(patches_list_path):
-            patch_fnames = set()
-
-            count = 0
-            while count < num_patches:
-                picked_class = random.choice(self.classes)
-                if picked_class == 'tumor':
-                    picked_wsi_fname = random.choice(self.tumor_wsi_fnames)
-                    picked_patient_id = picked_wsi_fname.rstrip('.tif')
-                    picked_wsi_path = os.path.join(self.tumor_wsi_dir_in, picked_wsi_fname)
-
-                    picked_mask_fname = f'{picked_patient_id}.npy'
-                    picked_mask_path = os.path.join(self.masks_dir_in, picked_mask_fname)
-
-                    picked_annot_fname = f'{picked_patient_id}.json'
-                    picked_annot_path = os.path.join(self.annots_dir_in, picked_annot_fname)
-
-                    os.makedirs(self.tumor_coords_dir_in, exist_ok=True)
-
-                    picked_coords_fname = f'{picked_patient_id}.json'
-                    picked_coords_path = os.path.join(self.tumor_coords_dir_in, picked_coords_fname)
-                    # Sample a tumor coordinate randomly
-                    picked_coord = self.sample_tumor_coord(coords_path=picked_coords_path,
-                                                            wsi_path=picked_wsi_path,
-                                                            mask_path=picked_mask_path,
-                                                            annot_path=picked_annot_path,
-                                                            wsi_level=wsi_level)        
-                elif picked_class == 'normal':
-                    picked_wsi_fname = random.choice(self.normal_wsi_fnames)
-                    picked_wsi_path = os.path.join(self.normal_wsi_dir_in, picked_wsi_fname)
-                    picked_patient_id = picked_wsi_fname.rstrip('.tif')
-
-                    picked_mask_fname = f'{picked_patient_id}.npy'
-                    picked_mask_path = os.path.join(self.masks_dir_in, picked_mask_fname)
-
-                    os.makedirs(self.normal_coords_dir_in, exist_ok=True)
-
-                    picked_coords_fname = f'{picked_patient_id}.json'
-                    picked_coords_path = os.path.join(self.normal_coords_dir_in, picked_coords_fname)
-                    # Sample a normal coordinate randomly
-                    picked_coord = self.sample_normal_coord(coords_path=picked_coords_path,
-                                                            wsi_path=picked_wsi_path,
-                                                            mask_path=picked_mask_path,
-                                                            wsi_level=wsi_level)
-
-                coord_x, coord_y = picked_coord
-                patch_fname = f'{picked_patient_id},{coord_x},{coord_y}'
-                if not patch_fname in patch_fnames:
-                    patch_fnames.add(patch_fname)
-                    count += 1
-                    print(f'{count}-th patch {patch_fname} was added to list')
-            # while-statement ended
-
-            num_patch_fnames = len(patch_fnames)
-            assert num_patch_fnames == num_patches
-            patches_dict = dict()
-            patches_dict['num_patches'] = num_patch_fnames
-            patches_dict['patches'] = list(patch_fnames)
-            with open(patches_list_path, 'w+', encoding='utf-8') as f:
-                json.dump(patches_dict, f, indent=4)
-        # Root if-statement ended
-
-        # Just load patches list if it already exists
-        with open(patches_list_path, 'r', encoding='utf-8') as f:
-            patches_dict = json.load(f)
-
-        patch_fnames = patches_dict['patches']
-        for (i, fname) in enumerate(patch_fnames, 1):
-            patch_fname = fname.strip('\n')
-            patient_id, center_x, center_y = patch_fname.split(',')
-            center_x = int(center_x)
-            center_y = int(center_y)
-            # Top left coordinate of patch
-            start_x = center_x - (patch_size // 2)
-            start_y = center_y - (patch_size // 2)
-
-            if patient_id.startswith('tumor'):
-                wsi_fname = f'{patient_id}.tif'
-                wsi_path = os.path.join(self.tumor_wsi_dir_in, wsi_fname)
+        patch_list = self.sample_patch_list(num_patches=num_patches,
+                                            wsi_level=wsi_level,
+                                            seed=seed,
+                                            append=append,
+                                            patch_size=patch_size,
+                                            min_tissue_fraction=min_tissue_fraction)
+
+        if resume:
+            done_patch_fnames = load_progress(self.patches_dir_out, output_format)
+        else:
+            done_patch_fnames = set()
+            # Shards of the previous runs would be mixed up with the new ones
+            if output_format == 'shard':
+                for fname in list_shards(self.patches_dir_out):
+                    os.remove(os.path.join(self.patches_dir_out, fname))
+
+        done_keys = patch_list.keys_of(done_patch_fnames)
+        patch_list = patch_list.subset(~np.isin(patch_list.keys, done_keys))
+        print(f'{len(done_patch_fnames)} patches are already saved, {len(patch_list)} patches to extract')
+
+        wsi_paths = {patient_id: self.wsi_path(patient_id) for patient_id in patch_list.slide_names}
+
+        # Patches are grouped by slide and read in tile order; shards are packed across slides
+        tasks = plan_extraction(patch_list=patch_list,
+                                wsi_paths=wsi_paths,
+                                patch_size=patch_size)
+        # New shards are numbered after the shards of the previous runs
+        first_task_index = next_shard_index(self.patches_dir_out) if output_format == 'shard' else 0
+        run_extraction(tasks=tasks,
+                       patches_dir_out=self.patches_dir_out,
+                       wsi_level=wsi_level,
+                       patch_size=patch_size,
+                       num_workers=num_workers,
+                       slide_pool=self.slide_pool,
+                       output_format=output_format,
+                       first_task_index=first_task_index,
+                       resume=resume,
+                       max_region_size=max_region_size,
+                       shard_size=shard_size)
+
+        print(f'Slide pool: {self.slide_pool}')
+
+    def sample_patch_list(self, num_patches: int, wsi_level: int = 0, seed: int = None,
+                          append: bool = False, patch_size: int = 300,
+                          min_tissue_fraction: float = 0.0) -> PatchList:
+        '''Sample the list of patches to extract and save it to patches_list.arr.
+
+        An existing list is reused; it grows to num_patches in append mode.
+        If the list is lost, the patches already saved are kept and only the rest are sampled.
+        A patches_list.json of the older versions is converted.
+
+        - Args
+            num_patches: Number of patches to sample
+            wsi_level: Level of the wsi
+            seed: Seed to sample the patches; not reproducible if None
+            append: Sample more patches if the existing list has less than num_patches
+            patch_size: Size of the patch
+            min_tissue_fraction: Drop the candidate patches with less tissue under them than this fraction
+
+        - Returns
+            A PatchList
+        '''
+        # Path to the binary file to save the list of sampled patches; see PatchList.save()
+        patches_list_path = os.path.join(self.patches_dir_out, 'patches_list.arr')
+        json_patches_list_path = os.path.join(self.patches_dir_out, 'patches_list.json')
+        if os.path.exists(patches_list_path) or os.path.exists(json_patches_list_path):
+            if os.path.exists(patches_list_path):
+                patch_list = PatchList.load(patches_list_path)
             else:
-                wsi_fname = f'{patient_id}.tif'
-                wsi_path = os.path.join(self.normal_wsi_dir_in, wsi_fname)
+                patch_list = PatchList.load(json_patches_list_path)
+                patch_list.save(patches_list_path)
+
+            if not append:
+                return patch_list
+        else:
+            png_patch_fnames = load_progress(self.patches_dir_out, 'png')
+            shard_patch_fnames = load_progress(self.patches_dir_out, 'shard')
+            patch_list = PatchList.from_fnames(sorted(png_patch_fnames | shard_patch_fnames))
+
+        num_missing = num_patches - len(patch_list)
+        if num_missing <= 0:
+            return patch_list
+
+        coord_index = self.build_coordinate_index(wsi_level=wsi_level,
+                                                  seed=seed,
+                                                  patch_size=patch_size,
+                                                  min_tissue_fraction=min_tissue_fraction)
+        print(f'Sampling {num_missing} patches from {coord_index}')
+
+        # Patches already in the list are not sampled again; slide indices are mapped to the index
+        index_slides = {patient_id: slide_index
+                        for (slide_index, patient_id) in enumerate(coord_index.patient_ids)}
+        index_map = np.array([index_slides.get(name, -1) for name in patch_list.slide_names], dtype=np.int64)
+        exclude = patch_list.rows()
+        exclude[:, 0] = index_map[exclude[:, 0]]
+        exclude = exclude[exclude[:, 0] >= 0]
+
+        # Draw every patch at once; (slide_index, x, y)
+        samples = coord_index.sample(num_missing, exclude=exclude)
+        patch_list.add(coord_index.patient_ids, samples)
 
-            slide = OpenSlide(wsi_path)
-            patch = slide.read_region(location=(start_x, start_y),
-                                    level=wsi_level,
-                                    size=(patch_size, patch_size))
-            patch = patch.convert('RGB')
-            patch_path = os.path.join(self.patches_dir_out, f'{patch_fname}.png')
-            patch.save(patch_path)
+        assert len(patch_list) == num_patches
+        patch_list.save(patches_list_path)
 
-            print(f'{i}-th {patch_fname} is saved in {self.patches_dir_out}')
+        return patch_list
+
+    def build_coordinate_index(self, wsi_level: int = 0, seed: int = None, patch_size: int = 300,
+                               min_tissue_fraction: float = 0.0) -> CoordinateIndex:
+        '''Load the candidate coordinates of every slide into a CoordinateIndex.
+
+        - Args
+            wsi_level: Level of the wsi
+            seed: Seed of the random generator of the index
+            patch_size: Size of the patch
+            min_tissue_fraction: Drop the candidate patches with less tissue under them than this fraction
+
+        - Returns
+            A CoordinateIndex containing tumor/normal coordinates of every slide
+        '''
+        os.makedirs(self.tumor_coords_dir_in, exist_ok=True)
+        os.makedirs(self.normal_coords_dir_in, exist_ok=True)
+
+        coord_index = CoordinateIndex(classes=self.classes, seed=seed)
+        for (patient_id, wsi_path) in sorted(self.wsi_paths['tumor'].items()):
+            tumor_coords = self.load_tumor_coords(
+                coords_path=os.path.join(self.tumor_coords_dir_in, f'{patient_id}.coords'),
+                wsi_path=wsi_path,
+                mask_path=self.mask_path(patient_id),
+                annot_path=self.annot_path(patient_id),
+                wsi_level=wsi_level,
+                patch_size=patch_size,
+                min_tissue_fraction=min_tissue_fraction)
+            coord_index.add('tumor', patient_id, tumor_coords)
+
+        for (patient_id, wsi_path) in sorted(self.wsi_paths['normal'].items()):
+            normal_coords = self.load_normal_coords(
+                coords_path=os.path.join(self.normal_coords_dir_in, f'{patient_id}.coords'),
+                wsi_path=wsi_path,
+                mask_path=self.mask_path(patient_id),
+                wsi_level=wsi_level,
+                patch_size=patch_size,
+                min_tissue_fraction=min_tissue_fraction)
+            coord_index.add('normal', patient_id, normal_coords)
+
+        return coord_index
 
     def sample_tumor_coord(self, coords_path: str, wsi_path: str, mask_path: str,
-                           annot_path: str, wsi_level: int = 0):
-        '''Sample a center coordinate of a normal patch from
-    
+                           annot_path: str, wsi_level: int = 0) -> tuple:
+        '''Sample a center coordinate of a tumor patch from uniform distribution.
+
         - Args
             coords_path: Path to the pre-sampled tumor coordinates
             wsi_path: Path to the wsi
@@ -156,37 +261,47 @@ class PatchSampler:
         - Returns
             A center coordinate of tumor patch; tuple of int
         '''
-        # If the cache of tumor coordinates(tumor_coords.json) does not exist
-        if not os.path.exists(coords_path):
-            slide = OpenSlide(wsi_path)
-            slide_width, slide_height = slide.level_dimensions[wsi_level]
+        tumor_coords = self.load_tumor_coords(coords_path, wsi_path, mask_path, annot_path, wsi_level)
+        coord_x, coord_y = random.choice(tumor_coords).tolist()
 
-            roi_mask = np.load(mask_path)
-            roi_mask_width, roi_mask_height = roi_mask.shape
+        return coord_x, coord_y
 
-            assert (slide_width // roi_mask_width) == (slide_height // roi_mask_height), \
-                f'Dimension does not match: slide_width({slide_width})//mask_width({roi_mask_width}) != \
-                    slide_height({slide_height})//mask_height({roi_mask_height})'
+    def load_tumor_coords(self, coords_path: str, wsi_path: str, mask_path: str, annot_path: str,
+                          wsi_level: int = 0, patch_size: int = 300,
+                          min_tissue_fraction: float = 0.0) -> np.ndarray:
+        '''Load the tumor coordinates of a wsi, build and cache them if the cache is missing or stale.
 
-            resolution = slide_width // roi_mask_width
-
-            roi_x_coords, roi_y_coords = np.where(roi_mask)
-            roi_coords = zip(roi_x_coords, roi_y_coords)
-            roi_coords = list(roi_coords)
-            roi_coords = [self.scale_coord(coord, resolution) for coord in roi_coords]
-            roi_coords = np.array(roi_coords)
+        - Args
+            coords_path: Path to the pre-sampled tumor coordinates
+            wsi_path: Path to the wsi
+            mask_path: Path to the binary mask of wsi
+            annot_path: Path to the annotations directory
+            wsi_level: Level of the given wsi
+            patch_size: Size of the patch
+            min_tissue_fraction: Drop the candidate patches with less tissue under them than this fraction
 
+        - Returns
+            Center coordinates of tumor patches; int32 array of shape (n, 2)
+        '''
+        params = self.coords_params(wsi_level, patch_size, min_tissue_fraction)
+        # Caches of the polygon test stay valid; 'check' gives the coordinates of 'raster'
+        if self.tumor_labeling != 'exact':
+            params['tumor_labeling'] = 'raster'
+        fingerprint = source_fingerprint(mask_path, annot_path, **params)
+        tumor_coords = load_coords_cache(coords_path, fingerprint)
+        # If the cache of tumor coordinates does not exist or is stale
+        if tumor_coords is None:
             lesion_annots = LesionAnnotations(annot_path)
-            tumor_coords = lesion_annots.filter_tumor_coords(coords_path, roi_coords, is_pos=True)
-        # If the cache of tumor coordinates(tumor_coords.json) exists
-        else:
-            with open(coords_path, 'r', encoding='utf-8') as f:
-                tumor_coords_dict = json.load(f)
-                tumor_coords = tumor_coords_dict['tumor_coords']
-
-        picked_tumor_coord = random.choice(tumor_coords)
+            if self.tumor_labeling == 'exact':
+                roi_coords = self.roi_coords(wsi_path, mask_path, wsi_level, patch_size, min_tissue_fraction)
+                tumor_coords = lesion_annots.filter_tumor_coords(coords_path, roi_coords,
+                                                                 is_pos=True, fingerprint=fingerprint)
+            else:
+                tumor_coords = self.roi_coords(wsi_path, mask_path, wsi_level, patch_size, min_tissue_fraction,
+                                               lesion_annots=lesion_annots)
+                save_coords_cache(coords_path, tumor_coords, fingerprint)
 
-        return picked_tumor_coord
+        return tumor_coords
 
     def sample_normal_coord(self, coords_path: str, wsi_path: str,
                             mask_path: str, wsi_level: int = 0) -> tuple:
@@ -200,46 +315,175 @@ class PatchSampler:
         - Returns
             A center coordinate of a normal patch; tuple of int
         '''
-        # If the cache of normal coordinates(normal_coords.json) does not exist
-        if not os.path.exists(coords_path):
-            slide = OpenSlide(wsi_path)
-            slide_width, slide_height = slide.level_dimensions[wsi_level]
+        normal_coords = self.load_normal_coords(coords_path, wsi_path, mask_path, wsi_level)
+        coord_x, coord_y = random.choice(normal_coords).tolist()
 
-            roi_mask = np.load(mask_path)
-            roi_mask_width, roi_mask_height = roi_mask.shape
+        return coord_x, coord_y
 
-            assert (slide_width // roi_mask_width) == (slide_height // roi_mask_height), \
-                f'Dimension does not match: slide_width({slide_width})//mask_width({roi_mask_width}) != \
-                    slide_height({slide_height})//mask_height({roi_mask_height})'
+    def load_normal_coords(self, coords_path: str, wsi_path: str, mask_path: str,
+                           wsi_level: int = 0, patch_size: int = 300,
+                           min_tissue_fraction: float = 0.0) -> np.ndarray:
+        '''Load the normal coordinates of a wsi, build and cache them if the cache is missing or stale.
 
-            resolution = slide_width // roi_mask_width
+        - Args
+            coords_path: Path to the pre-sampled normal coordinates
+            wsi_path: Path to the wsi
+            mask_path: Path to the binary mask of wsi
+            wsi_level: Level of the given wsi
+            patch_size: Size of the patch
+            min_tissue_fraction: Drop the candidate patches with less tissue under them than this fraction
 
-            roi_x_coords, roi_y_coords = np.where(roi_mask)
-            roi_x_coords = roi_x_coords.tolist()
-            roi_y_coords = roi_y_coords.tolist()
+        - Returns
+            Center coordinates of normal patches; int32 array of shape (n, 2)
+        '''
+        params = self.coords_params(wsi_level, patch_size, min_tissue_fraction)
+        fingerprint = source_fingerprint(mask_path, **params)
+        roi_coords = load_coords_cache(coords_path, fingerprint)
+        # If the cache of normal coordinates does not exist or is stale
+        if roi_coords is None:
+            roi_coords = self.roi_coords(wsi_path, mask_path, wsi_level, patch_size, min_tissue_fraction)
+            save_coords_cache(coords_path, roi_coords, fingerprint)
 
-            # Scale roi coordinates because the level of wsi and its mask can be different
-            roi_coords = zip(roi_x_coords, roi_y_coords)
-            roi_coords = list(roi_coords)
-            roi_coords = [self.scale_coord(coord, resolution) for coord in roi_coords]
-            num_roi_coords = len(roi_coords)
+        return roi_coords
 
-            roi_coords_dict = dict()
-            roi_coords_dict['num_coords'] = num_roi_coords
-            roi_coords_dict['normal_coords'] = roi_coords
+    def roi_coords(self, wsi_path: str, mask_path: str, wsi_level: int = 0,
+                   patch_size: int = 300, min_tissue_fraction: float = 0.0,
+                   lesion_annots: LesionAnnotations = None) -> np.ndarray:
+        '''Scale every roi pixel of the mask to the coordinate of the wsi.
 
-            with open(coords_path, 'w+', encoding='utf-8') as f:
-                json.dump(roi_coords_dict, f, indent=4)
-        # If the cache of normal coordinates(normal_coords.json) exists
-        else:
-            with open(coords_path, 'r', encoding='utf-8') as f:
-                roi_coords_dict = json.load(f)
-                roi_coords = roi_coords_dict['normal_coords']
+        - Args
+            wsi_path: Path to the wsi
+            mask_path: Path to the binary mask of wsi; packed or saved by np.save()
+            wsi_level: Level of the given wsi
+            patch_size: Size of the patch
+            min_tissue_fraction: Drop the roi pixels with less tissue under the patch than this fraction
+            lesion_annots: Keep only the roi pixels on the tumor if given; see LesionAnnotations.tumor_mask()
 
-        # Select an roi coordinate randomly
-        picked_roi_coord = random.choice(roi_coords)
+        - Returns
+            Roi coordinates; int32 array of shape (n, 2)
+        '''
+        slide = self.slide_pool.get(wsi_path)
+        slide_width, slide_height = slide.level_dimensions[wsi_level]
+
+        roi_mask = open_mask(mask_path)
+        roi_mask_width, roi_mask_height = roi_mask.shape
+
+        assert (slide_width // roi_mask_width) == (slide_height // roi_mask_height), \
+            f'Dimension does not match: slide_width({slide_width})//mask_width({roi_mask_width}) != \
+                slide_height({slide_height})//mask_height({roi_mask_height})'
+
+        resolution = slide_width // roi_mask_width
+
+        candidate_mask = roi_mask
+        if lesion_annots is not None:
+            tumor_mask = lesion_annots.tumor_mask(roi_mask.shape, resolution)
+            if self.tumor_labeling == 'check':
+                assert check_tumor_mask(lesion_annots, roi_mask.argwhere() * resolution, roi_mask.shape,
+                                        resolution, tumor_mask), \
+                    f'Tumor mask of {lesion_annots} differs from the polygon test'
+            # Bitwise and of the packed roi mask and the packed tumor mask
+            candidate_mask = PackedMask(roi_mask.packed & np.packbits(tumor_mask, axis=1), roi_mask.shape)
+
+        roi_coords = candidate_mask.argwhere().astype(np.int32)
+        # Drop the patches centered on the edge of the tissue before any of them is read
+        if min_tissue_fraction > 0:
+            footprint = round(patch_size / resolution)
+            fractions = tissue_fractions(roi_mask, roi_coords, footprint, load_tissue_index(mask_path))
+            roi_coords = roi_coords[fractions >= min_tissue_fraction]
+
+        # Scale roi coordinates because the level of wsi and its mask can be different
+        roi_coords *= resolution
+
+        return roi_coords
+
+    def coords_params(self, wsi_level: int = 0, patch_size: int = 300,
+                      min_tissue_fraction: float = 0.0) -> dict:
+        '''Return the parameters the coordinates caches are computed with; part of their fingerprint.'''
+        params = {'wsi_level': wsi_level}
+        # Caches without the tissue filter stay valid
+        if min_tissue_fraction > 0:
+            params['patch_size'] = patch_size
+            params['min_tissue_fraction'] = min_tissue_fraction
+
+        return params
+
+    def migrate_json_caches(self, wsi_level: int = 0, remove_json: bool = False) -> int:
+        '''Convert the json coordinates caches of the slides to binary caches.
+
+        The json caches are assumed to be computed from the current masks and annotations. The tumor caches
+        of the older versions hold the coordinates of the 'exact' labeling, so they are only migrated with
+        tumor_labeling='exact'; the other labelings compute new coordinates and the tumor json caches are kept.
 
-        return picked_roi_coord
+        - Args
+            wsi_level: Level of the wsi the caches were computed at
+            remove_json: Remove the json caches after the conversion if True
+
+        - Returns
+            The number of migrated caches
+        '''
+        num_migrated = 0
+        for class_ in self.classes:
+            if class_ == 'tumor' and self.tumor_labeling != 'exact':
+                print(f'Skipped the tumor coordinates caches; they are of the exact labeling, '
+                      f'not of {self.tumor_labeling}')
+                continue
+
+            for patient_id in sorted(self.wsi_paths[class_]):
+                source_paths = self.coords_source_paths(class_, patient_id)
+                json_path = os.path.join(self.coords_dir(class_), f'{patient_id}.json')
+                if not os.path.exists(json_path):
+                    continue
+
+                fingerprint = source_fingerprint(*source_paths, wsi_level=wsi_level)
+                cache_path = os.path.join(self.coords_dir(class_), f'{patient_id}.coords')
+                num_coords = migrate_json_cache(json_path, cache_path, fingerprint)
+                num_migrated += 1
+                print(f'Migrated {num_coords} {class_} coordinates of {patient_id} to {cache_path}')
+
+                if remove_json:
+                    os.remove(json_path)
+
+        return num_migrated
+
+    def coords_dir(self, class_: str) -> str:
+        '''Return the path to the coordinates cache directory of the given class.'''
+        if class_ == 'tumor':
+            return self.tumor_coords_dir_in
+
+        return self.normal_coords_dir_in
+
+    def coords_source_paths(self, class_: str, patient_id: str) -> list:
+        '''Return the paths to the files the coordinates of a slide are computed from.'''
+        mask_path = self.mask_path(patient_id)
+        if class_ == 'tumor':
+            annot_path = self.annot_path(patient_id)
+            return [mask_path, annot_path]
+
+        return [mask_path]
+
+    def annot_path(self, patient_id: str) -> str:
+        '''Return the path to the annotation of the given patient; the annotation store if there is one.'''
+        return annotation_path(self.annots_dir_in, patient_id)
+
+    def mask_path(self, patient_id: str) -> str:
+        '''Return the path to the mask of the given patient; the packed mask if there is one.'''
+        packed_mask_path = os.path.join(self.masks_dir_in, f'{patient_id}{PACKED_MASK_EXT}')
+        if os.path.exists(packed_mask_path):
+            return packed_mask_path
+
+        return os.path.join(self.masks_dir_in, f'{patient_id}.npy')
+
+    def wsi_path(self, patient_id: str) -> str:
+        '''Return the path to the wsi of the given patient.'''
+        for class_wsi_paths in self.wsi_paths.values():
+            if patient_id in class_wsi_paths:
+                return class_wsi_paths[patient_id]
+
+        wsi_fname = f'{patient_id}.tif'
+        if patient_id.startswith('tumor'):
+            return os.path.join(self.tumor_wsi_dir_in, wsi_fname)
+
+        return os.path.join(self.normal_wsi_dir_in, wsi_fname)
 
     def scale_coord(self, coord: tuple, resolution: int) -> tuple:
         '''Scale the given coordinates correspoding resolution.
@@ -260,7 +504,7 @@ if __name__ == '__main__':
 
     WSI_DIR = r'/ssd-ext/dataset'
     TRAIN_WSI_DIR = os.path.join(WSI_DIR, 'train')
-    VALID_WSI_DIR = os.path.join(WSI_DIR, 'valid')
+    SPLIT_PATH = os.path.join(WSI_DIR, 'splits', 'valid0.2_seed0.json') # see Camelyon16.split_train_valid()
 
     MASKS_DIR = os.path.join(ROOT_DIR, 'results', 'masks')
     ANNOTS_DIR = os.path.join(ROOT_DIR, 'annots')
@@ -283,16 +527,20 @@ if __name__ == '__main__':
                                        annots_dir_in=TRAIN_ANNOTS_DIR,
                                        tumor_coords_dir_in=TUMOR_COORDS_DIR,
                                        normal_coords_dir_in=NORMAL_COORDS_DIR,
-                                       patches_dir_out=TRAIN_PATCHES_DIR)
+                                       patches_dir_out=TRAIN_PATCHES_DIR,
+                                       split_path=SPLIT_PATH,
+                                       subset='train')
 
     train_patch_sampler.sample_patches(num_patches=NUM_TRAIN_PATCHES)
 
-    valid_patch_sampler = PatchSampler(wsi_dir_in=VALID_WSI_DIR,
+    valid_patch_sampler = PatchSampler(wsi_dir_in=TRAIN_WSI_DIR,
                                        masks_dir_in=MASKS_DIR,
                                        annots_dir_in=TRAIN_ANNOTS_DIR,
                                        tumor_coords_dir_in=TUMOR_COORDS_DIR,
                                        normal_coords_dir_in=NORMAL_COORDS_DIR,
-                                       patches_dir_out=VALID_PATCHES_DIR)
+                                       patches_dir_out=VALID_PATCHES_DIR,
+                                       split_path=SPLIT_PATH,
+                                       subset='valid')
                                        
     valid_patch_sampler.sample_patches(num_patches=NUM_VALID_PATCHES)
 
@@ -0,0 +1,172 @@
+# Standard Libs
+import json
+import os
+
+# Third-party Libs
+import numpy as np
+
+# Custom Libs
+from storage import create_array, open_array, read_header
+
+SHARDS_INDEX_FNAME = 'shards_index.json'
+
+
+def shard_fname(shard_index: int) -> str:
+    '''Return the file name of the shard of the given index.'''
+    return f'shard_{shard_index:05}.arr'
+
+
+def list_shards(shards_dir: str) -> list:
+    '''Return the sorted file names of the shards in the directory.'''
+    return sorted(fname for fname in os.listdir(shards_dir)
+                  if fname.startswith('shard_') and fname.endswith('.arr'))
+
+
+def next_shard_index(shards_dir: str) -> int:
+    '''Return the index following the last shard in the directory.'''
+    shard_fnames = list_shards(shards_dir)
+    if not shard_fnames:
+        return 0
+
+    return int(shard_fnames[-1][len('shard_'):-len('.arr')]) + 1
+
+
+def create_shard(shard_path: str, patch_fnames: list, patch_size: int) -> np.memmap:
+    '''Create a zero-filled shard of square patches and memory-map it for writing; see storage.create_array().
+
+    - Args
+        shard_path: Path to create the shard; a temporary path renamed once the shard is filled
+        patch_fnames: Names of the patches; (patient_id,center_x,center_y)
+        patch_size: Size of the patch
+
+    - Returns
+        A writable memory-mapped array of shape (n, patch_size, patch_size, 3)
+    '''
+    meta = {
+        'kind': 'patches',
+        'patch_fnames': list(patch_fnames),
+    }
+
+    return create_array(shard_path, (len(patch_fnames), patch_size, patch_size, 3), np.uint8, meta)
+
+
+def write_shards_index(shards_dir: str) -> dict:
+    '''Index every shard of the directory.
+
+    - Args
+        shards_dir: Path to the directory containing the shards
+
+    - Returns
+        A dict containing the patch shape and the file name and size of every shard
+    '''
+    shard_fnames = list_shards(shards_dir)
+
+    shards_index = {'patch_shape': None, 'num_patches': 0, 'shards': []}
+    for fname in shard_fnames:
+        header_dict, _ = read_header(os.path.join(shards_dir, fname))
+        num_patches, *patch_shape = header_dict['shape']
+        shards_index['patch_shape'] = patch_shape
+        shards_index['num_patches'] += num_patches
+        shards_index['shards'].append({'fname': fname, 'num_patches': num_patches})
+
+    shards_index_path = os.path.join(shards_dir, SHARDS_INDEX_FNAME)
+    with open(shards_index_path, 'w+', encoding='utf-8') as f:
+        json.dump(shards_index, f, indent=4)
+
+    return shards_index
+
+
+class ShardReader:
+    '''Read patches saved as shards; random access and sequential streaming.'''
+
+    def __init__(self, shards_dir: str) -> None:
+        '''Initialize the ShardReader.
+
+        - Args
+            shards_dir: Path to the directory containing the shards and their index
+
+        - Returns
+            None
+        '''
+        self.shards_dir = shards_dir
+
+        shards_index_path = os.path.join(shards_dir, SHARDS_INDEX_FNAME)
+        with open(shards_index_path, 'r', encoding='utf-8') as f:
+            self.shards_index = json.load(f)
+
+        self.shard_fnames = [shard['fname'] for shard in self.shards_index['shards']]
+        shard_sizes = [shard['num_patches'] for shard in self.shards_index['shards']]
+        # Global index of the first patch of each shard
+        self.offsets = np.concatenate([[0], np.cumsum(shard_sizes)]).astype(np.int64)
+
+        self.shards = {} # shard index -> memory-mapped shard, opened on demand
+        self.patch_indices = None # patch name -> global index, built on demand
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def shard(self, shard_index: int) -> np.ndarray:
+        '''Return the memory-mapped shard of the given index.'''
+        if shard_index not in self.shards:
+            shard_path = os.path.join(self.shards_dir, self.shard_fnames[shard_index])
+            self.shards[shard_index], _ = open_array(shard_path, mmap=True)
+
+        return self.shards[shard_index]
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        '''Return the patch of the given global index; a read-only view of shape (height, width, 3).'''
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        shard_index = int(np.searchsorted(self.offsets, index, side='right')) - 1
+
+        return self.shard(shard_index)[index - self.offsets[shard_index]]
+
+    def get(self, patch_fname: str) -> np.ndarray:
+        '''Return the patch of the given name; (patient_id,center_x,center_y).'''
+        if self.patch_indices is None:
+            self.patch_indices = {}
+            for (index, fname) in enumerate(self.patch_fnames()):
+                self.patch_indices[fname] = index
+
+        return self[self.patch_indices[patch_fname]]
+
+    def patch_fnames(self) -> list:
+        '''Return the names of every patch in the order of the global index.'''
+        patch_fnames = []
+        for fname in self.shard_fnames:
+            header_dict, _ = read_header(os.path.join(self.shards_dir, fname))
+            patch_fnames.extend(header_dict['patch_fnames'])
+
+        return patch_fnames
+
+    def iter_shards(self, shuffle: bool = False, seed: int = None):
+        '''Read the shards one by one with a single sequential read each.
+
+        - Args
+            shuffle: Shuffle the order of the shards and the patches in each shard if True
+            seed: Seed to shuffle
+
+        - Returns
+            A generator of tuples; (patch names, patches of shape (n, height, width, 3))
+        '''
+        rng = np.random.default_rng(seed)
+        shard_indices = np.arange(len(self.shard_fnames))
+        if shuffle:
+            rng.shuffle(shard_indices)
+
+        for shard_index in shard_indices:
+            shard_path = os.path.join(self.shards_dir, self.shard_fnames[shard_index])
+            patches, header_dict = open_array(shard_path, mmap=False)
+            patch_fnames = header_dict['patch_fnames']
+            if shuffle:
+                order = rng.permutation(len(patches))
+                patches = patches[order]
+                patch_fnames = [patch_fnames[i] for i in order]
+
+            yield patch_fnames, patches
+
+    def __iter__(self):
+        '''Stream every patch in order; a tuple of (patch name, patch).'''
+        for (patch_fnames, patches) in self.iter_shards():
+            yield from zip(patch_fnames, patches)
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+from openslide import OpenSlide
+
+
+class SlidePool:
+    '''Keep whole slide images open and reuse them; least recently used slide is closed first.'''
+
+    def __init__(self, max_open: int = 16) -> None:
+        '''Initialize the SlidePool.
+
+        - Args
+            max_open: Maximum number of slides kept open at the same time
+
+        - Returns
+            None
+        '''
+        assert max_open > 0, f'max_open must be positive, got {max_open}'
+
+        self.max_open = max_open
+        self.slides = OrderedDict() # wsi_path -> OpenSlide; the last one is the most recently used
+
+        # Counters to monitor how well the pool works
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_opens = 0
+        self.num_closes = 0
+
+    def get(self, wsi_path: str) -> OpenSlide:
+        '''Return the opened slide of the given path, open it if it is not in the pool.
+
+        - Args
+            wsi_path: Path to the wsi
+
+        - Returns
+            An OpenSlide object
+        '''
+        slide = self.slides.get(wsi_path)
+        if slide is not None:
+            self.slides.move_to_end(wsi_path)
+            self.num_hits += 1
+            return slide
+
+        self.num_misses += 1
+        # Evict the least recently used slides to keep the number of open files bounded
+        while len(self.slides) >= self.max_open:
+            self._evict()
+
+        slide = OpenSlide(wsi_path)
+        self.num_opens += 1
+        self.slides[wsi_path] = slide
+
+        return slide
+
+    def close(self) -> None:
+        '''Close every slide in the pool.'''
+        while self.slides:
+            self._evict()
+
+    def _evict(self) -> None:
+        '''Close the least recently used slide.'''
+        _, slide = self.slides.popitem(last=False)
+        slide.close()
+        self.num_closes += 1
+
+    @property
+    def hit_rate(self) -> float:
+        '''Ratio of requests served by an already opened slide'''
+        num_requests = self.num_hits + self.num_misses
+        if num_requests == 0:
+            return 0.0
+
+        return self.num_hits / num_requests
+
+    @property
+    def stats(self) -> dict:
+        '''Return the counters of the pool.
+
+        - Returns
+            A dict containing hits, misses, opens, closes and hit rate
+        '''
+        stats_dict = {
+            'num_open': len(self.slides),
+            'num_hits': self.num_hits,
+            'num_misses': self.num_misses,
+            'num_opens': self.num_opens,
+            'num_closes': self.num_closes,
+            'hit_rate': self.hit_rate,
+        }
+
+        return stats_dict
+
+    def __len__(self) -> int:
+        return len(self.slides)
+
+    def __enter__(self) -> 'SlidePool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return (f'SlidePool(open={len(self.slides)}/{self.max_open}, '
+                f'hit_rate={self.hit_rate:.3f}, opens={self.num_opens}, closes={self.num_closes})')
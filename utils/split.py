@@ -0,0 +1,179 @@
+# Standard Libs
+import json
+import os
+import random
+
+SPLIT_VERSION = 1
+SPLITS_DIRNAME = 'splits' # directory of the split manifests and their materialized links in the wsi directory
+SUBSETS = ('train', 'valid')
+LINKS = ('hardlink', 'symlink')
+
+
+def list_class_slides(wsi_dirs: list, classes: tuple = ('tumor', 'normal')) -> dict:
+    '''List the wsi of each class under the directories; the class is the name of the directory of a wsi.
+
+    - Args
+        wsi_dirs: Paths to the directories of {class}/{patient_id}.tif; e.g. train and valid
+        classes: Names of the class directories
+
+    - Returns
+        A dict; patient id -> (class, wsi_path)
+    '''
+    slides = {}
+    for wsi_dir in wsi_dirs:
+        for class_ in classes:
+            class_dir = os.path.join(wsi_dir, class_)
+            if not os.path.isdir(class_dir):
+                continue
+
+            for fname in sorted(os.listdir(class_dir)):
+                patient_id, ext = os.path.splitext(fname)
+                if ext != '.tif':
+                    continue
+                if patient_id in slides:
+                    raise ValueError(f'Duplicated patient id {patient_id}: '
+                                     f'{slides[patient_id][1]}, {os.path.join(class_dir, fname)}')
+                slides[patient_id] = (class_, os.path.join(class_dir, fname))
+
+    return slides
+
+
+def make_folds(slides: dict, valid_ratio: float = 0.2, num_folds: int = 1, seed: int = 0) -> list:
+    '''Split the slides into train/valid folds, stratified by class.
+
+    The slides of each class are shuffled with the seed. With num_folds > 1 they are dealt to the folds in
+    turn and every fold is the validation set once; otherwise valid_ratio of each class is the validation set.
+
+    - Args
+        slides: A dict; patient id -> (class, wsi_path)
+        valid_ratio: Ratio of the validation set of each class; used if num_folds is 1
+        num_folds: Number of folds
+        seed: Seed of the shuffle
+
+    - Returns
+        A list of dicts, one per fold; {'train': [patient ids], 'valid': [patient ids]}
+    '''
+    assert num_folds >= 1, f'Invalid number of folds: {num_folds}'
+    rng = random.Random(seed)
+
+    class_ids = {}
+    for patient_id in sorted(slides):
+        class_ids.setdefault(slides[patient_id][0], []).append(patient_id)
+
+    valid_folds = [[] for _ in range(num_folds)]
+    num_dealt = 0
+    for class_ in sorted(class_ids):
+        patient_ids = class_ids[class_]
+        rng.shuffle(patient_ids)
+        if num_folds == 1:
+            valid_folds[0].extend(patient_ids[:round(len(patient_ids) * valid_ratio)])
+            continue
+
+        # Continue the turn of the previous class so that the folds differ by at most one slide
+        for patient_id in patient_ids:
+            valid_folds[num_dealt % num_folds].append(patient_id)
+            num_dealt += 1
+
+    folds = []
+    for valid_ids in valid_folds:
+        valid_set = set(valid_ids)
+        folds.append({'train': sorted(patient_id for patient_id in slides if patient_id not in valid_set),
+                      'valid': sorted(valid_ids)})
+
+    return folds
+
+
+def save_split(split_path: str, slides: dict, subsets: dict, **params) -> None:
+    '''Save a split manifest; the file is replaced atomically.
+
+    The wsi paths are saved relative to the directory of the manifest, so the manifest moves with the dataset.
+
+    - Args
+        split_path: Path to save the manifest
+        slides: A dict; patient id -> (class, wsi_path)
+        subsets: A dict; subset name -> patient ids
+        params: Parameters of the split saved with it; e.g. seed, num_folds, fold
+
+    - Returns
+        None
+    '''
+    split_dir = os.path.dirname(os.path.abspath(split_path))
+    os.makedirs(split_dir, exist_ok=True)
+    patient_ids = sorted({patient_id for ids in subsets.values() for patient_id in ids})
+    split = {
+        'version': SPLIT_VERSION,
+        'params': params,
+        'slides': {patient_id: {'class': slides[patient_id][0],
+                                'path': os.path.relpath(os.path.abspath(slides[patient_id][1]), split_dir)}
+                   for patient_id in patient_ids},
+        'subsets': {name: sorted(ids) for (name, ids) in subsets.items()},
+    }
+
+    tmp_path = f'{split_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(split, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, split_path)
+
+
+def load_split(split_path: str, subsets: list = None) -> dict:
+    '''Load the slides of a split manifest.
+
+    - Args
+        split_path: Path to the manifest
+        subsets: Names of the subsets to load; e.g. ['valid'], every subset if None
+
+    - Returns
+        A dict; patient id -> (class, wsi_path)
+    '''
+    with open(split_path, 'r', encoding='utf-8') as f:
+        split = json.load(f)
+    assert split.get('version') == SPLIT_VERSION, f'Unsupported split version: {split.get("version")}'
+
+    if subsets is None:
+        subsets = sorted(split['subsets'])
+    split_dir = os.path.dirname(os.path.abspath(split_path))
+    slides = {}
+    for subset in subsets:
+        if subset not in split['subsets']:
+            raise ValueError(f'{split_path} has no subset {subset}; {sorted(split["subsets"])}')
+        for patient_id in split['subsets'][subset]:
+            slide = split['slides'][patient_id]
+            slides[patient_id] = (slide['class'], os.path.normpath(os.path.join(split_dir, slide['path'])))
+
+    return slides
+
+
+def materialize_split(split_path: str, link_dir_out: str, link: str = 'symlink') -> int:
+    '''Link the wsi of a split manifest into {link_dir_out}/{subset}/{class}/{patient_id}.tif.
+
+    The directories have the layout of the downloaded dataset, for the tools which only read directories.
+    Hard links need the wsi and the links on the same file system; symbolic links point to the wsi.
+
+    - Args
+        split_path: Path to the manifest
+        link_dir_out: Path to the directory of the links; replaced links are removed first
+        link: 'hardlink' or 'symlink'
+
+    - Returns
+        The number of links
+    '''
+    assert link in LINKS, f'Unknown link: {link}'
+
+    with open(split_path, 'r', encoding='utf-8') as f:
+        subsets = json.load(f)['subsets']
+
+    num_links = 0
+    for subset in subsets:
+        for (patient_id, (class_, wsi_path)) in load_split(split_path, [subset]).items():
+            link_path = os.path.join(link_dir_out, subset, class_, os.path.basename(wsi_path))
+            os.makedirs(os.path.dirname(link_path), exist_ok=True)
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+
+            if link == 'hardlink':
+                os.link(wsi_path, link_path)
+            else:
+                os.symlink(os.path.relpath(wsi_path, os.path.dirname(link_path)), link_path)
+            num_links += 1
+
+    return num_links
@@ -0,0 +1,116 @@
+# Standard Libs
+import json
+import os
+import struct
+
+# Third-party Libs
+import numpy as np
+
+# Layout of a file: MAGIC | header length(uint32, little endian) | json header | raw array
+MAGIC = b'FDARRAY1'
+ALIGNMENT = 64 # the raw array starts at a multiple of ALIGNMENT bytes
+
+
+def _header_bytes(dtype: np.dtype, shape: tuple, meta: dict = None) -> bytes:
+    '''Return MAGIC, the header length and the json header, padded so that the raw array is aligned.'''
+    header_dict = dict(meta or {})
+    header_dict['dtype'] = np.dtype(dtype).str
+    header_dict['shape'] = list(shape)
+    header = json.dumps(header_dict).encode('utf-8')
+
+    # Pad the header with spaces so that the raw array is aligned
+    prefix_size = len(MAGIC) + 4
+    padded_size = -(-(prefix_size + len(header)) // ALIGNMENT) * ALIGNMENT
+    header = header + b' ' * (padded_size - prefix_size - len(header))
+
+    return MAGIC + struct.pack('<I', len(header)) + header
+
+
+def write_array(path: str, array: np.ndarray, meta: dict = None) -> None:
+    '''Save an array with a json header; the file is replaced atomically.
+
+    - Args
+        path: Path to save the array
+        array: Array to save
+        meta: Json serializable dict saved in the header
+
+    - Returns
+        None
+    '''
+    array = np.ascontiguousarray(array)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_header_bytes(array.dtype, array.shape, meta))
+        f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def create_array(path: str, shape: tuple, dtype, meta: dict = None) -> np.memmap:
+    '''Create a zero-filled file in the format of write_array() and memory-map its array for writing.
+
+    The array is filled in place, e.g. tile by tile, without holding it in memory.
+    Write to a temporary path and rename it once the array is complete to replace files atomically.
+
+    - Args
+        path: Path to create the file
+        shape: Shape of the array
+        dtype: Data type of the array
+        meta: Json serializable dict saved in the header
+
+    - Returns
+        A writable memory-mapped array; flush() it before renaming the file
+    '''
+    header = _header_bytes(dtype, shape, meta)
+    num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + num_bytes)
+
+    return np.memmap(path, dtype=dtype, mode='r+', offset=len(header), shape=tuple(shape))
+
+
+def read_header(path: str) -> tuple:
+    '''Read the header of a file saved by write_array().
+
+    - Args
+        path: Path to the file
+
+    - Returns
+        A tuple of (header dict, offset of the raw array)
+    '''
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a file saved by write_array()')
+        header_size, = struct.unpack('<I', f.read(4))
+        header_dict = json.loads(f.read(header_size).decode('utf-8'))
+
+    offset = len(MAGIC) + 4 + header_size
+
+    return header_dict, offset
+
+
+def open_array(path: str, mmap: bool = True) -> tuple:
+    '''Open a file saved by write_array().
+
+    - Args
+        path: Path to the file
+        mmap: Memory-map the array (read-only) if True, read it into memory otherwise
+
+    - Returns
+        A tuple of (array, header dict)
+    '''
+    header_dict, offset = read_header(path)
+    dtype = np.dtype(header_dict['dtype'])
+    shape = tuple(header_dict['shape'])
+
+    num_items = int(np.prod(shape))
+    if mmap and num_items > 0:
+        array = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            array = np.fromfile(f, dtype=dtype, count=num_items).reshape(shape)
+
+    return array, header_dict
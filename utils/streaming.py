@@ -0,0 +1,138 @@
+# Third-party Libs
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from torchvision.transforms.functional import to_tensor
+
+# Custom Libs
+from coords import CoordinateIndex
+from slide import SlidePool
+
+
+class WSIPatchDataset(IterableDataset):
+    '''Stream patches read directly from the wsi without saving them as images.'''
+
+    def __init__(self, coord_index: CoordinateIndex, wsi_paths: dict, num_patches: int,
+                 wsi_level: int = 0, patch_size: int = 300, transform=None,
+                 infinite: bool = False, seed: int = None, max_open_slides: int = 4) -> None:
+        '''Initialize the WSIPatchDataset.
+
+        - Args
+            coord_index: Candidate coordinates of every slide; see PatchSampler.build_coordinate_index()
+            wsi_paths: A dict mapping patient id to the path of its wsi
+            num_patches: Number of patches of an epoch, shared by every DataLoader worker; workers beyond
+                         num_patches draw nothing
+            wsi_level: Level of the wsi
+            patch_size: Size of the patch
+            transform: Function applied to each RGB PIL image; converted to tensor if None
+            infinite: Keep drawing patches without ending an epoch if True; num_patches per round of draws
+            seed: Seed to draw patches; call set_epoch() every epoch to draw new patches.
+                  Fresh patches are drawn in every iteration if None
+            max_open_slides: Maximum number of wsi kept open by each worker
+
+        - Returns
+            None
+        '''
+        super().__init__()
+        self.coord_index = coord_index
+        self.wsi_paths = wsi_paths
+        self.num_patches = num_patches
+        self.wsi_level = wsi_level
+        self.patch_size = patch_size
+        self.transform = transform if transform is not None else to_tensor
+        self.infinite = infinite
+        self.seed = seed
+        self.max_open_slides = max_open_slides
+
+        # Class index of every slide; label of the patch
+        self.slide_labels = np.array([coord_index.class_index(slide_index)
+                                      for slide_index in range(len(coord_index))])
+
+        self.epoch = 0
+        self.slide_pool = None # created in each worker process
+
+    @classmethod
+    def from_sampler(cls, patch_sampler, num_patches: int, wsi_level: int = 0, **kwargs) -> 'WSIPatchDataset':
+        '''Make a WSIPatchDataset from the coordinates caches of a PatchSampler.
+
+        - Args
+            patch_sampler: PatchSampler whose slides and coordinates caches are used
+            num_patches: Number of patches of an epoch
+            wsi_level: Level of the wsi
+            kwargs: Other arguments of WSIPatchDataset
+
+        - Returns
+            A WSIPatchDataset
+        '''
+        coord_index = patch_sampler.build_coordinate_index(wsi_level=wsi_level)
+        wsi_paths = {patient_id: patch_sampler.wsi_path(patient_id)
+                     for patient_id in coord_index.patient_ids}
+        # Opened slides can not be shared with the DataLoader workers
+        patch_sampler.slide_pool.close()
+
+        return cls(coord_index, wsi_paths, num_patches, wsi_level=wsi_level, **kwargs)
+
+    def set_epoch(self, epoch: int) -> None:
+        '''Set the epoch to draw a different set of patches in each epoch.'''
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        '''Return the number of patches of an epoch; of a round of draws if infinite, which never ends.'''
+        return self.num_patches
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        if self.slide_pool is None:
+            self.slide_pool = SlidePool(max_open=self.max_open_slides)
+
+        # Every worker draws its own share of the epoch with its own generator
+        num_worker_patches = self.num_patches // num_workers
+        if worker_id < self.num_patches % num_workers:
+            num_worker_patches += 1
+        # Nothing to draw; an infinite worker would loop forever on empty draws
+        if num_worker_patches == 0:
+            return
+
+        if self.seed is None:
+            rng = np.random.default_rng()
+        else:
+            rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+
+        while True:
+            draws = self.coord_index.draw(num_worker_patches, rng=rng)
+            for (slide_index, center_x, center_y) in draws.tolist():
+                yield self.read_patch(slide_index, center_x, center_y)
+
+            if not self.infinite:
+                break
+
+    def read_patch(self, slide_index: int, center_x: int, center_y: int) -> tuple:
+        '''Read a patch centered at the given coordinate.
+
+        - Args
+            slide_index: Index of the slide in the CoordinateIndex
+            center_x: X coordinate of the center of the patch
+            center_y: Y coordinate of the center of the patch
+
+        - Returns
+            A tuple of (transformed patch, label); label is the index of the class in coord_index.classes
+        '''
+        patient_id = self.coord_index.patient_ids[slide_index]
+        slide = self.slide_pool.get(self.wsi_paths[patient_id])
+
+        # Top left coordinate of patch
+        start_x = center_x - (self.patch_size // 2)
+        start_y = center_y - (self.patch_size // 2)
+        patch = slide.read_region(location=(start_x, start_y),
+                                  level=self.wsi_level,
+                                  size=(self.patch_size, self.patch_size))
+        patch = patch.convert('RGB')
+
+        label = torch.tensor(self.slide_labels[slide_index], dtype=torch.long)
+
+        return self.transform(patch), label
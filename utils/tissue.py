@@ -0,0 +1,261 @@
+import argparse
+from functools import lru_cache
+
+import numpy as np
+
+NUM_BINS = 256
+CHUNK_SIZE = 1 << 20 # number of pixels processed at once; bounds the temporaries of a chunk
+
+
+@lru_cache(maxsize=None)
+def saturation_table() -> np.ndarray:
+    '''Saturation of every uint8 (max, min) pair of a pixel; float64 array of shape (256, 256).
+
+    Saturation only depends on the max and min channel of a pixel, so the table is computed
+    with rgb2hsv() itself and a lookup gives the same values as rgb2hsv() on the image.
+    '''
+    from skimage.color import rgb2hsv
+
+    max_values, min_values = np.meshgrid(np.arange(NUM_BINS), np.arange(NUM_BINS), indexing='ij')
+    min_values = np.minimum(min_values, max_values) # pairs with min > max do not occur
+    pixels = np.stack([max_values, min_values, min_values], axis=-1).astype(np.uint8)
+
+    table = rgb2hsv(pixels)[:, :, 1]
+    table.setflags(write=False)
+
+    return table
+
+
+def max_min_index(rgb_chunk: np.ndarray) -> np.ndarray:
+    '''Index of the (max, min) pair of every pixel in saturation_table().ravel(); max * 256 + min.'''
+    r_channel = rgb_chunk[..., 0]
+    g_channel = rgb_chunk[..., 1]
+    b_channel = rgb_chunk[..., 2]
+    max_channel = np.maximum(np.maximum(r_channel, g_channel), b_channel).astype(np.uint16)
+    min_channel = np.minimum(np.minimum(r_channel, g_channel), b_channel)
+
+    max_channel <<= 8
+    max_channel |= min_channel
+
+    return max_channel
+
+
+def iter_chunks(rgb_image: np.ndarray, chunk_size: int = CHUNK_SIZE):
+    '''Split an image of shape (width, height, 3) into chunks of whole columns along the first axis.'''
+    width, height, _ = rgb_image.shape
+    step = max(chunk_size // max(height, 1), 1)
+    for x in range(0, width, step):
+        yield x, rgb_image[x:x + step]
+
+
+def otsu_from_histogram(counts: np.ndarray, bin_centers: np.ndarray) -> float:
+    '''Otsu threshold of a histogram accumulated over the chunks of an image.
+
+    Matches skimage.filters.threshold_otsu() on the whole image when the histogram has
+    the same bins; integer bins for uint8 and 256 bins over [min, max] for floats.
+    Computed here since threshold_otsu() only takes a histogram from scikit-image 0.19.
+    '''
+    occupied = np.flatnonzero(counts)
+    # threshold_otsu() returns the value itself for an image of a single value
+    if len(occupied) == 1:
+        return bin_centers[occupied[0]]
+
+    # threshold_otsu() bins the range of the image; no empty bin at either end
+    counts = counts[occupied[0]:occupied[-1] + 1].astype(np.float64)
+    bin_centers = bin_centers[occupied[0]:occupied[-1] + 1]
+
+    # Class weights and means of every threshold
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * bin_centers) / weight1
+    mean2 = (np.cumsum((counts * bin_centers)[::-1]) / weight2[::-1])[::-1]
+
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+
+    return bin_centers[np.argmax(variance12)]
+
+
+class TissueHistograms:
+    '''Histograms of r, g, b and saturation of a slide, accumulated in a single pass over its tiles.'''
+
+    def __init__(self) -> None:
+        '''Initialize the TissueHistograms.
+
+        - Args
+            None
+
+        - Returns
+            None
+        '''
+        self.rgb_counts = np.zeros((3, NUM_BINS), dtype=np.int64)
+        # Joint histogram of the (max, min) channel of the pixels; saturation is a function of the pair
+        self.max_min_counts = np.zeros(NUM_BINS * NUM_BINS, dtype=np.int64)
+
+    def update(self, rgb_image: np.ndarray, chunk_size: int = CHUNK_SIZE) -> None:
+        '''Add the pixels of an image or a tile of it.
+
+        - Args
+            rgb_image: uint8 RGB image of shape (width, height, 3)
+            chunk_size: Number of pixels processed at once
+
+        - Returns
+            None
+        '''
+        for (_, rgb_chunk) in iter_chunks(rgb_image, chunk_size):
+            for channel in range(3):
+                self.rgb_counts[channel] += np.bincount(rgb_chunk[..., channel].ravel(), minlength=NUM_BINS)
+            self.max_min_counts += np.bincount(max_min_index(rgb_chunk).ravel(),
+                                               minlength=NUM_BINS * NUM_BINS)
+
+    def saturation_histogram(self) -> tuple:
+        '''Histogram of saturation with the bins threshold_otsu() uses for the whole image.
+
+        - Returns
+            A tuple of (counts, bin centers), or None if every pixel has the same saturation
+        '''
+        saturations = saturation_table().ravel()
+        occupied = self.max_min_counts > 0
+        s_min = saturations[occupied].min()
+        s_max = saturations[occupied].max()
+        if s_min == s_max:
+            return None
+
+        counts, bin_edges = np.histogram(saturations[occupied],
+                                         bins=NUM_BINS,
+                                         range=(s_min, s_max),
+                                         weights=self.max_min_counts[occupied])
+        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.0
+
+        return counts, bin_centers
+
+    def thresholds(self) -> tuple:
+        '''Otsu thresholds of the accumulated pixels; (r, g, b, saturation).'''
+        if not self.max_min_counts.any():
+            raise ValueError('No pixel was added')
+
+        rgb_bin_centers = np.arange(NUM_BINS)
+        r_threshold = otsu_from_histogram(self.rgb_counts[0], rgb_bin_centers)
+        g_threshold = otsu_from_histogram(self.rgb_counts[1], rgb_bin_centers)
+        b_threshold = otsu_from_histogram(self.rgb_counts[2], rgb_bin_centers)
+
+        saturation_histogram = self.saturation_histogram()
+        if saturation_histogram is None:
+            s_threshold = saturation_table().ravel()[np.flatnonzero(self.max_min_counts)[0]]
+        else:
+            s_threshold = otsu_from_histogram(*saturation_histogram)
+
+        return r_threshold, g_threshold, b_threshold, s_threshold
+
+
+def tissue_mask(rgb_image: np.ndarray, thresholds: tuple, min_rgb: int = 50,
+                out: np.ndarray = None, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
+    '''Threshold an image or a tile of it into the roi(tissue region) mask.
+
+    A pixel is tissue if it is saturated, not brighter than the thresholds in every channel
+    and brighter than min_rgb in every channel.
+
+    - Args
+        rgb_image: uint8 RGB image of shape (width, height, 3)
+        thresholds: Otsu thresholds of the slide; see TissueHistograms.thresholds()
+        min_rgb: Minimum value of every channel of a tissue pixel
+        out: Binary array of shape (width, height) to write the mask into; allocated if None
+        chunk_size: Number of pixels processed at once
+
+    - Returns
+        Binary roi mask of shape (width, height)
+    '''
+    r_threshold, g_threshold, b_threshold, s_threshold = thresholds
+    # Saturation test of every (max, min) pair
+    saturated = (saturation_table() > s_threshold).ravel()
+
+    if out is None:
+        out = np.empty(rgb_image.shape[:2], dtype=bool)
+
+    for (x, rgb_chunk) in iter_chunks(rgb_image, chunk_size):
+        r_channel = rgb_chunk[..., 0]
+        g_channel = rgb_chunk[..., 1]
+        b_channel = rgb_chunk[..., 2]
+
+        background = (r_channel > r_threshold) & (g_channel > g_threshold) & (b_channel > b_threshold)
+        min_rgb_mask = (r_channel > min_rgb) & (g_channel > min_rgb) & (b_channel > min_rgb)
+
+        out[x:x + len(rgb_chunk)] = saturated[max_min_index(rgb_chunk)] & ~background & min_rgb_mask
+
+    return out
+
+
+def reference_tissue_mask(rgb_image: np.ndarray, min_rgb: int = 50) -> tuple:
+    '''The float64 rgb2hsv and threshold_otsu detector the kernel reproduces; for equivalence checks.
+
+    - Args
+        rgb_image: uint8 RGB image of shape (width, height, 3)
+        min_rgb: Minimum value of every channel of a tissue pixel
+
+    - Returns
+        A tuple of (roi mask, thresholds)
+    '''
+    from skimage.color import rgb2hsv
+    from skimage.filters import threshold_otsu
+
+    r_channel = rgb_image[:, :, 0]
+    g_channel = rgb_image[:, :, 1]
+    b_channel = rgb_image[:, :, 2]
+    s_channel = rgb2hsv(rgb_image)[:, :, 1]
+
+    r_threshold = threshold_otsu(r_channel)
+    g_threshold = threshold_otsu(g_channel)
+    b_threshold = threshold_otsu(b_channel)
+    s_threshold = threshold_otsu(s_channel)
+
+    rgb_tissue_mask = np.logical_not((r_channel > r_threshold) & (b_channel > b_threshold) & (g_channel > g_threshold))
+    s_tissue_mask = s_channel > s_threshold
+    min_rgb_mask = (r_channel > min_rgb) & (g_channel > min_rgb) & (b_channel > min_rgb)
+
+    roi_mask = s_tissue_mask & rgb_tissue_mask & min_rgb_mask
+
+    return roi_mask, (r_threshold, g_threshold, b_threshold, s_threshold)
+
+
+def check_equivalence(rgb_image: np.ndarray, min_rgb: int = 50, chunk_size: int = CHUNK_SIZE) -> bool:
+    '''Compare the thresholds and the mask of the kernel with reference_tissue_mask() on an image.'''
+    tissue_histograms = TissueHistograms()
+    tissue_histograms.update(rgb_image, chunk_size)
+    thresholds = tissue_histograms.thresholds()
+    roi_mask = tissue_mask(rgb_image, thresholds, min_rgb, chunk_size=chunk_size)
+
+    reference_mask, reference_thresholds = reference_tissue_mask(rgb_image, min_rgb)
+
+    same_thresholds = all(threshold == reference_threshold
+                          for (threshold, reference_threshold) in zip(thresholds, reference_thresholds))
+    if not same_thresholds:
+        print(f'Thresholds differ: {thresholds} != {reference_thresholds}')
+    same_mask = np.array_equal(roi_mask, reference_mask)
+    if not same_mask:
+        print(f'Masks differ in {np.count_nonzero(roi_mask != reference_mask)} pixels')
+
+    return same_thresholds and same_mask
+
+
+if __name__ == '__main__':
+    from openslide import OpenSlide
+
+    parser = argparse.ArgumentParser(description='Check the tissue detector against the rgb2hsv reference.')
+    parser.add_argument('wsi_paths', nargs='*', help='wsi to check; random images are checked if none')
+    parser.add_argument('--wsi-level', type=int, default=6, help='level of the wsi to check at')
+    parser.add_argument('--chunk-size', type=int, default=4096, help='small chunks to cross many chunk borders')
+    args = parser.parse_args()
+
+    if args.wsi_paths:
+        images = []
+        for wsi_path in args.wsi_paths:
+            slide = OpenSlide(wsi_path)
+            image = slide.read_region((0, 0), args.wsi_level, slide.level_dimensions[args.wsi_level])
+            images.append((wsi_path, np.transpose(image.convert('RGB'), axes=[1, 0, 2])))
+    else:
+        rng = np.random.default_rng(0)
+        images = [(f'random_{i}', (rng.beta(2, 5, size=(301, 203, 3)) * 255).astype(np.uint8))
+                  for i in range(10)]
+        images.append(('uniform', np.full((64, 48, 3), 200, dtype=np.uint8)))
+
+    for (name, rgb_image) in images:
+        print(f'{name}: {"same" if check_equivalence(rgb_image, chunk_size=args.chunk_size) else "DIFFERENT"}')
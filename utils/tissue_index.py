@@ -0,0 +1,245 @@
+# Standard Libs
+import os
+
+# Third-party Libs
+import numpy as np
+
+# Custom Libs
+from coords import source_fingerprint
+from packed_mask import ROWS_PER_CHUNK, PackedMask, open_mask
+from storage import create_array, open_array
+
+TISSUE_INDEX_VERSION = 1
+TISSUE_INDEX_EXT = '.tissue'
+
+
+def tissue_index_path(mask_path: str) -> str:
+    '''Return the path to the tissue index saved next to the mask.'''
+    return f'{os.path.splitext(mask_path)[0]}{TISSUE_INDEX_EXT}'
+
+
+def table_shapes(mask_shape: tuple, num_levels: int) -> list:
+    '''Return the shape of the summed-area table of every level; level k sums blocks of 2**k x 2**k mask pixels.'''
+    mask_width, mask_height = mask_shape
+    shapes = []
+    for level in range(num_levels):
+        block_size = 2 ** level
+        shapes.append((-(-mask_width // block_size) + 1, -(-mask_height // block_size) + 1))
+
+    return shapes
+
+
+def table_dtype(mask_shape: tuple) -> np.dtype:
+    '''Return the smallest unsigned dtype which holds the tissue count of the whole mask.'''
+    mask_width, mask_height = mask_shape
+    if mask_width * mask_height < 2 ** 32:
+        return np.dtype(np.uint32)
+
+    return np.dtype(np.uint64)
+
+
+def fill_tables(packed_mask: PackedMask, tables: list) -> None:
+    '''Fill the summed-area tables of every level from the mask, a chunk of rows at a time.
+
+    - Args
+        packed_mask: Mask to index
+        tables: Zero-filled tables of the shapes of table_shapes(); table[x, y] = tissue in mask[:x, :y]
+
+    - Returns
+        None
+    '''
+    mask_width, mask_height = packed_mask.shape
+    base_table = tables[0]
+
+    # Level 0; cumulative sums along y in each chunk, carried along x from the last row of the previous chunk
+    for x in range(0, mask_width, ROWS_PER_CHUNK):
+        chunk = packed_mask.region(x, 0, ROWS_PER_CHUNK, mask_height)
+        chunk_sums = np.cumsum(np.cumsum(chunk, axis=1, dtype=base_table.dtype), axis=0, dtype=base_table.dtype)
+        chunk_sums += base_table[x, 1:]
+        base_table[x + 1:x + 1 + len(chunk), 1:] = chunk_sums
+
+    # Coarser levels are the level 0 table sampled at the block borders
+    for (level, table) in enumerate(tables[1:], 1):
+        block_size = 2 ** level
+        xs = np.minimum(np.arange(table.shape[0]) * block_size, mask_width)
+        ys = np.minimum(np.arange(table.shape[1]) * block_size, mask_height)
+        for x in range(0, len(xs), ROWS_PER_CHUNK):
+            table[x:x + ROWS_PER_CHUNK] = base_table[xs[x:x + ROWS_PER_CHUNK]][:, ys]
+
+
+class TissueIndex:
+    '''Summed-area tables of a roi mask; tissue in any rectangle with 4 lookups.'''
+
+    def __init__(self, tables: list, mask_shape: tuple, downsample: float = 1.0,
+                 mask_fingerprint: str = None) -> None:
+        '''Initialize the TissueIndex.
+
+        - Args
+            tables: Summed-area table of every level; see table_shapes()
+            mask_shape: Shape of the mask; (width, height)
+            downsample: Level 0 pixels per mask pixel; 1 to query in mask pixels
+            mask_fingerprint: Fingerprint of the mask file the index was built from
+
+        - Returns
+            None
+        '''
+        self.tables = tables
+        self.mask_shape = tuple(mask_shape)
+        self.downsample = float(downsample)
+        self.mask_fingerprint = mask_fingerprint
+
+    @property
+    def num_levels(self) -> int:
+        return len(self.tables)
+
+    def level_downsample(self, level: int = 0) -> float:
+        '''Return the level 0 pixels per cell of the table of the level.'''
+        return self.downsample * 2 ** level
+
+    @classmethod
+    def from_mask(cls, mask, downsample: float = None, num_levels: int = 1) -> 'TissueIndex':
+        '''Build the index of a mask in memory.
+
+        - Args
+            mask: Binary mask of shape (width, height) or a PackedMask
+            downsample: Level 0 pixels per mask pixel; taken from the PackedMask, or 1 if unknown
+            num_levels: Number of levels of the tables
+
+        - Returns
+            A TissueIndex
+        '''
+        if not isinstance(mask, PackedMask):
+            mask = PackedMask.from_array(mask)
+        if downsample is None:
+            downsample = mask.downsample or 1.0
+
+        dtype = table_dtype(mask.shape)
+        tables = [np.zeros(shape, dtype=dtype) for shape in table_shapes(mask.shape, num_levels)]
+        fill_tables(mask, tables)
+
+        return cls(tables, mask.shape, downsample)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'TissueIndex':
+        '''Open an index saved by build_tissue_index(); memory-mapped if mmap is True.'''
+        array, header_dict = open_array(path, mmap=mmap)
+        assert header_dict.get('kind') == 'tissue_index', f'{path} is not a tissue index'
+        assert header_dict.get('version') == TISSUE_INDEX_VERSION, \
+            f'Unsupported tissue index version: {header_dict.get("version")}'
+
+        tables = []
+        for (offset, shape) in zip(header_dict['offsets'], header_dict['table_shapes']):
+            tables.append(array[offset:offset + shape[0] * shape[1]].reshape(shape))
+
+        return cls(tables, header_dict['mask_shape'], header_dict['downsample'], header_dict['mask_fingerprint'])
+
+    def counts(self, rects, level: int = 0) -> np.ndarray:
+        '''Count the tissue pixels of the mask in every rectangle; pixels outside the mask count as background.
+
+        - Args
+            rects: Rectangles in level 0 coordinates of shape (n, 4); (x, y, width, height)
+            level: Level of the tables; rectangles are snapped to its blocks of 2**level mask pixels
+
+        - Returns
+            An int64 array of shape (n,)
+        '''
+        x0, y0, x1, y1 = self.cells(rects, level)
+        table = self.tables[level]
+        num_cols, num_rows = table.shape
+        x0 = np.clip(x0, 0, num_cols - 1)
+        y0 = np.clip(y0, 0, num_rows - 1)
+        x1 = np.clip(x1, 0, num_cols - 1)
+        y1 = np.clip(y1, 0, num_rows - 1)
+
+        counts = (table[x1, y1].astype(np.int64) - table[x0, y1].astype(np.int64)
+                  - table[x1, y0].astype(np.int64) + table[x0, y0].astype(np.int64))
+
+        return counts
+
+    def fractions(self, rects, level: int = 0) -> np.ndarray:
+        '''Fraction of tissue in every rectangle; see counts().
+
+        - Returns
+            A float array of shape (n,) in [0, 1]
+        '''
+        x0, y0, x1, y1 = self.cells(rects, level)
+        # Area in mask pixels; blocks of coarser levels cover 4**level pixels
+        areas = np.maximum((x1 - x0) * (y1 - y0), 1) * 4 ** level
+
+        return self.counts(rects, level) / areas
+
+    def cells(self, rects, level: int = 0) -> tuple:
+        '''Convert rectangles in level 0 coordinates to the cell borders of the table of the level.'''
+        rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+        cell_size = self.level_downsample(level)
+
+        x0 = np.round(rects[:, 0] / cell_size).astype(np.int64)
+        y0 = np.round(rects[:, 1] / cell_size).astype(np.int64)
+        x1 = np.round((rects[:, 0] + rects[:, 2]) / cell_size).astype(np.int64)
+        y1 = np.round((rects[:, 1] + rects[:, 3]) / cell_size).astype(np.int64)
+
+        return x0, y0, x1, y1
+
+    def __repr__(self) -> str:
+        return (f'TissueIndex(mask_shape={self.mask_shape}, downsample={self.downsample}, '
+                f'levels={self.num_levels})')
+
+
+def build_tissue_index(mask_path: str, index_path: str = None, downsample: float = None,
+                       num_levels: int = 1) -> str:
+    '''Build the index of a mask and save it next to the mask; the tables are filled on disk.
+
+    - Args
+        mask_path: Path to the mask; packed or saved by np.save()
+        index_path: Path to save the index; see tissue_index_path() if None
+        downsample: Level 0 pixels per mask pixel; taken from the packed mask if None
+        num_levels: Number of levels of the tables
+
+    - Returns
+        Path to the index
+    '''
+    if index_path is None:
+        index_path = tissue_index_path(mask_path)
+
+    packed_mask = open_mask(mask_path)
+    if downsample is None:
+        downsample = packed_mask.downsample
+    assert downsample is not None, f'Downsample of {mask_path} is unknown'
+
+    shapes = table_shapes(packed_mask.shape, num_levels)
+    sizes = [num_cols * num_rows for (num_cols, num_rows) in shapes]
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int).tolist()
+    meta = {
+        'kind': 'tissue_index',
+        'version': TISSUE_INDEX_VERSION,
+        'mask_shape': list(packed_mask.shape),
+        'downsample': float(downsample),
+        'table_shapes': [list(shape) for shape in shapes],
+        'offsets': offsets,
+        'mask_fingerprint': source_fingerprint(mask_path),
+    }
+
+    # Every table is a view of the single array of the file
+    tmp_path = f'{index_path}.tmp'
+    array = create_array(tmp_path, (sum(sizes),), table_dtype(packed_mask.shape), meta)
+    tables = [array[offset:offset + size].reshape(shape)
+              for (offset, size, shape) in zip(offsets, sizes, shapes)]
+    fill_tables(packed_mask, tables)
+    array.flush()
+    del array, tables
+    os.replace(tmp_path, index_path)
+
+    return index_path
+
+
+def load_tissue_index(mask_path: str) -> TissueIndex:
+    '''Open the index saved next to the mask; None if there is none or the mask changed since.'''
+    index_path = tissue_index_path(mask_path)
+    if not os.path.exists(index_path):
+        return None
+
+    tissue_index = TissueIndex.load(index_path)
+    if tissue_index.mask_fingerprint != source_fingerprint(mask_path):
+        return None
+
+    return tissue_index